@@ -93,7 +93,10 @@ Rectangle {
                 X1PlusNative.system('while true ; do iwconfig wlan0 power off > /dev/null 2>&1 ; sleep 4 ; done &');
             }
 
-            var rv = X1PlusNative.popen(`mkdir -p /userdata/x1plus && cd /userdata/x1plus && unzip -p /sdcard/${x1pName} payload.tar.gz | gunzip | tar xv`);
+            // x1plusd might have unpacked the payload for us already, while
+            // the printer was idle (see x1plus/services/x1plusd/prestage.py);
+            // if what it unpacked came from this very file, use that.
+            var rv = X1PlusNative.popen(`if [ "$(cat /userdata/x1plus.staged/.x1plus-staged 2>/dev/null)" = "${x1pName} $(stat -c '%s %Y' /sdcard/${x1pName})" ]; then rm -rf /userdata/x1plus && mv /userdata/x1plus.staged /userdata/x1plus && echo "using already unpacked payload"; else rm -rf /userdata/x1plus.staged /userdata/x1plus.staged.new; mkdir -p /userdata/x1plus && cd /userdata/x1plus && unzip -p /sdcard/${x1pName} payload.tar.gz | gunzip | tar xv; fi`);
             let install_path = X1PlusNative.getenv("EMULATION_WORKAROUNDS") + "/userdata/x1plus/install.sh"
             let resp = X1PlusNative.readFile(install_path);
             if (resp.byteLength !== 0 && rv !== 0) { /* verify that install.sh exists and.. isn't blank? */
@@ -14,7 +14,14 @@ Item {
     property var otaEnabled: !!X1Plus.Settings.get("ota.enabled", true)
     property var downloadBaseFirmware: true /* wire up to switch */
     property var otaBusy: ota.status != 'IDLE' && ota.status != 'DISABLED'
-    property var progressString: `${(ota.download.bytes / 1048576).toFixed(2)} MB / ${(ota.download.bytes_total / 1048576).toFixed(2)} MB`
+    property var otaVerifying: (ota.prestage || {}).status == 'VERIFYING'
+    property var telemetry: ota.download.telemetry
+    property var progressString: `${(ota.download.bytes / 1048576).toFixed(2)} MB / ${(ota.download.bytes_total / 1048576).toFixed(2)} MB` +
+                                 (!telemetry ? "" :
+                                  telemetry.stalled ? qsTr(", waiting for the server") :
+                                  telemetry.rate === null ? "" :
+                                  `, ${(telemetry.rate / 1048576).toFixed(2)} MB/s` +
+                                  (telemetry.eta === null ? "" : qsTr(", %1:%2 left").arg(Math.floor(telemetry.eta / 60)).arg(("0" + telemetry.eta % 60).slice(-2))))
 
     property var buttons: SimpleItemModel {
         DialogButtonItem {
@@ -32,11 +39,11 @@ Item {
             keepDialog: true
             onClicked: {
                 var rv = X1Plus.OTA.update();
-                if (rv.status != 'failed') {
+                if (rv && rv.status != 'failure') {
                     otaBusy = true;
                 }
             }
-            visible: otaEnabled && !otaBusy && ota.ota_available && ota.ota_is_downloaded
+            visible: otaEnabled && !otaBusy && !otaVerifying && ota.ota_available && ota.ota_is_downloaded
         }
         DialogButtonItem {
             name: "no"; title: qsTr("Return")
@@ -216,6 +223,15 @@ Item {
                 visible: otaEnabled && ota.ota_available
             }
 
+            Text {
+                text: qsTr("<i>Checking the downloaded update before it can be installed...</i>")
+                font: Fonts.body_26
+                color: Colors.gray_200
+                wrapMode: Text.Wrap
+                Layout.columnSpan: 2
+                visible: otaEnabled && ota.ota_available && otaVerifying
+            }
+
             Text {
                 text: ota.status == 'DOWNLOADING_BASE' ? qsTr("Base firmware download in progress (%1).").arg(progressString) :
                       ota.ota_base_is_downloaded ?
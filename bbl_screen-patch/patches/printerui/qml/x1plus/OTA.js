@@ -25,6 +25,7 @@ var [status, onStatus, _setStatus] = Binding.makeBinding({});
 var _CheckNow = null;
 var _Download = null;
 var _Update = null;
+var _GetDownloadHistory = null;
 
 function checkNow() {
     _CheckNow({});
@@ -38,6 +39,10 @@ function update() {
     return _Update({});
 }
 
+function downloadHistory() {
+    return _GetDownloadHistory({}).downloads;
+}
+
 function awaken() {
     const curStatus = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/ota", "x1plus.ota", "GetStatus")({});
     _setStatus(curStatus);
@@ -49,4 +54,5 @@ function awaken() {
     _CheckNow = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/ota", "x1plus.ota", "CheckNow");
     _Download = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/ota", "x1plus.ota", "Download");
     _Update   = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/ota", "x1plus.ota", "Update"  );
+    _GetDownloadHistory = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/ota", "x1plus.ota", "GetDownloadHistory");
 }
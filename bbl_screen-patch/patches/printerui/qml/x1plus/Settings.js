@@ -20,8 +20,12 @@
 var X1Plus = null;
 
 var _PutSettings = null;
+var _PatchSettings = null;
+var _GetSettingsSince = null;
 var _settings = {};
 var _settingsBindings = {};
+var _epoch = null;
+var _version = null;
 
 function _settingChanged(k, v) {
     _settings[k] = v;
@@ -47,6 +51,96 @@ function put(k, v) {
     _PutSettings({ [k]: v });
 }
 
+/* Unlike put(), we do not apply the patch locally first -- patches are not
+ * idempotent, and x1plusd sends it right back to us in SettingsChanged
+ * before PatchSettings even returns.
+ */
+function patch(k, ops) {
+    var rv = _PatchSettings({ "key": k, "patch": ops });
+    if (!rv || rv.status != "ok") {
+        console.log(`X1Plus.Settings: patch of ${k} failed: ${rv ? rv.reason : "no response"}`);
+    }
+}
+
+function _pointerTokens(p) {
+    if (p === "") {
+        return [];
+    }
+    return p.substring(1).split("/").map((t) => t.replace(/~1/g, "/").replace(/~0/g, "~"));
+}
+
+function _pointerGet(doc, p) {
+    for (const t of _pointerTokens(p)) {
+        doc = doc[t];
+    }
+    return doc;
+}
+
+function _pointerAdd(doc, p, v) {
+    var toks = _pointerTokens(p);
+    if (toks.length == 0) {
+        return v;
+    }
+    var last = toks.pop();
+    var parent = doc;
+    for (const t of toks) {
+        parent = parent[t];
+    }
+    if (Array.isArray(parent)) {
+        parent.splice(last === "-" ? parent.length : parseInt(last), 0, v);
+    } else {
+        parent[last] = v;
+    }
+    return doc;
+}
+
+function _pointerRemove(doc, p) {
+    var toks = _pointerTokens(p);
+    if (toks.length == 0) {
+        return null;
+    }
+    var last = toks.pop();
+    var parent = doc;
+    for (const t of toks) {
+        parent = parent[t];
+    }
+    if (Array.isArray(parent)) {
+        parent.splice(parseInt(last), 1);
+    } else {
+        delete parent[last];
+    }
+    return doc;
+}
+
+/* Applies an RFC 6902 JSON Patch that x1plusd has already checked, so
+ * there is no error handling here to speak of.
+ */
+function _applyPatch(doc, ops) {
+    doc = JSON.parse(JSON.stringify(doc === undefined ? null : doc));
+    for (const op of ops) {
+        var clone = (v) => JSON.parse(JSON.stringify(v));
+        switch (op.op) {
+        case "add":
+            doc = _pointerAdd(doc, op.path, clone(op.value));
+            break;
+        case "remove":
+            doc = _pointerRemove(doc, op.path);
+            break;
+        case "replace":
+            doc = _pointerAdd(_pointerRemove(doc, op.path), op.path, clone(op.value));
+            break;
+        case "move":
+            var v = _pointerGet(doc, op.from);
+            doc = _pointerAdd(_pointerRemove(doc, op.from), op.path, v);
+            break;
+        case "copy":
+            doc = _pointerAdd(doc, op.path, clone(_pointerGet(doc, op.from)));
+            break;
+        }
+    }
+    return doc;
+}
+
 function _migrate(k, newk) {
     var v = X1Plus.DeviceManager.getSetting(k, null);
     if (v !== null) {
@@ -56,22 +150,62 @@ function _migrate(k, newk) {
     }
 }
 
+/* Fetch whatever we have missed since the last version we saw (or
+ * everything, if we have never seen anything, or if x1plusd has restarted
+ * since then).
+ */
+function _resync() {
+    var since = _epoch === null ? null : { "epoch": _epoch, "version": _version };
+    var resp = _GetSettingsSince(since);
+    if (!resp) {
+        return;
+    }
+    if (resp.full) {
+        for (const k in _settings) {
+            if (!(k in resp.settings)) {
+                _settingChanged(k, null);
+            }
+        }
+    }
+    for (const k in resp.settings) {
+        _settingChanged(k, resp.settings[k]);
+    }
+    _epoch = resp.epoch;
+    _version = resp.version;
+}
+
 function awaken() {
     X1Plus.DBus.onSignal("x1plus.settings", "SettingsChanged", (arg) => {
+        if (arg._epoch !== _epoch || arg._version > _version + 1) {
+            console.log(`x1plus.settings.SettingsChanged: at version ${_epoch}/${_version}, got ${arg._epoch}/${arg._version}; resyncing`);
+            _resync();
+            return;
+        }
+        if (arg._version <= _version) {
+            /* we already picked this up from a resync */
+            return;
+        }
+        for (const k in arg._patch || {}) {
+            console.log(`x1plus.settings.SettingsChanged(${k}, patch)`);
+            _settingChanged(k, _applyPatch(_settings[k], arg._patch[k]));
+        }
         for (const k in arg) {
+            if (k.startsWith("_")) {
+                continue;
+            }
             console.log(`x1plus.settings.SettingsChanged(${k})`);
             _settingChanged(k, arg[k]);
         }
+        _version = arg._version;
     });
-    _settings = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/settings", "x1plus.settings", "GetSettings")() || {};
+    _GetSettingsSince = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/settings", "x1plus.settings", "GetSettingsSince");
     _PutSettings = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/settings", "x1plus.settings", "PutSettings");
-    
-    for (const k in _settings) {
-        // did someone beat us to it??
-        if (_settingsBindings[k]) {
-            _settingsBindings[k][2 /* set */](_settings[k]);
-        }
-    }
+    _PatchSettings = X1Plus.DBus.proxyFunction("x1plus.x1plusd", "/x1plus/settings", "x1plus.settings", "PatchSettings");
+
+    /* _settingChanged also takes care of anyone who beat us to it and
+     * already made a binding.
+     */
+    _resync();
 
     _migrate("cfw_passcode", "lockscreen.passcode");
     _migrate("cfw_locktype", "lockscreen.mode");
@@ -1,4 +1,7 @@
 from . import ota
 from . import settings
+from . import statusboard
+from . import daemon
+from . import stats
 
-__all__ = ['ota', 'settings']
+__all__ = ['ota', 'settings', 'statusboard', 'daemon', 'stats']
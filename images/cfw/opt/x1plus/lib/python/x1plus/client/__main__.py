@@ -1,5 +1,5 @@
 import argparse
-from . import ota, settings
+from . import ota, settings, daemon, stats, dds
 
 """
 Basic command-line X1Plus management tool.
@@ -10,6 +10,9 @@ subparsers = parser.add_subparsers(title = 'commands', required = True)
 
 ota.add_subparser(subparsers)
 settings.add_subparser(subparsers)
+daemon.add_subparser(subparsers)
+stats.add_subparser(subparsers)
+dds.add_subparser(subparsers)
 
 args = parser.parse_args()
 args.func(args)
\ No newline at end of file
@@ -10,15 +10,31 @@ if 'x1plus.services.x1plusd' in sys.modules:
     # the jeepney asyncio interface.  don't do this!
     raise ImportError("you cannot import x1plus.client from inside x1plusd!")
 
-if not os.path.exists("/etc/bblap"):
-    # we must be running in emulation
-    dbus_connection = open_dbus_connection('SESSION')
-else:
-    dbus_connection = open_dbus_connection('SYSTEM')
+_dbus_connection = None
+
+def get_dbus_connection():
+    """
+    The DBus connection is opened the first time something needs it, so
+    that clients that only read the status board never have to.
+    """
+    global _dbus_connection
+    if _dbus_connection is None:
+        if not os.path.exists("/etc/bblap"):
+            # we must be running in emulation
+            _dbus_connection = open_dbus_connection('SESSION')
+        else:
+            _dbus_connection = open_dbus_connection('SYSTEM')
+    return _dbus_connection
+
+def __getattr__(name):
+    # base.dbus_connection used to be opened at import time.
+    if name == 'dbus_connection':
+        return get_dbus_connection()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 def call(addr, method, param = None):
     msg = new_method_call(addr, method, 's', (json.dumps(param), ))
-    reply = dbus_connection.send_and_get_reply(msg)
+    reply = get_dbus_connection().send_and_get_reply(msg)
     if reply.header.message_type == MessageType.error:
         error_name = reply.header.fields.get(HeaderFields.error_name, 'unknown-error')
         raise RuntimeError(error_name, reply.body[0] if len(reply.body) > 0 else '')
@@ -0,0 +1,41 @@
+from .base import call
+
+from jeepney import DBusAddress
+
+DAEMON_DBUS_ADDRESS = DBusAddress('/x1plus/daemon', bus_name='x1plus.x1plusd', interface='x1plus.daemon')
+
+def get_startup_trace():
+    return call(DAEMON_DBUS_ADDRESS, 'GetStartupTrace')
+
+def get_tasks():
+    return call(DAEMON_DBUS_ADDRESS, 'GetTasks')
+
+###
+
+from datetime import datetime
+import time
+
+def _cmd_tasks(args):
+    tasks = get_tasks()
+    if not tasks:
+        print("x1plusd is not supervising any tasks.")
+        return
+
+    for name, task in tasks.items():
+        state = task['state']
+        if state == 'backoff' and task['restart_at'] is not None:
+            state = f"restarting in {max(0, task['restart_at'] - time.time()):.0f}s"
+        print(f"{name}: {state}, {task['restarts']} restart{'' if task['restarts'] == 1 else 's'}")
+        if task['last_error'] is not None:
+            print(f"  last error at {datetime.fromtimestamp(task['last_error_time']).ctime()}: {task['last_error']}")
+            if args.verbose:
+                for line in task['last_traceback'].rstrip().split("\n"):
+                    print(f"    {line}")
+
+def add_subparser(subparsers):
+    daemon_parser = subparsers.add_parser('daemon', help="look into x1plusd itself")
+    daemon_subparsers = daemon_parser.add_subparsers(title = 'subcommands', required = True)
+
+    daemon_tasks_parser = daemon_subparsers.add_parser('tasks', help="show how x1plusd's tasks are getting on")
+    daemon_tasks_parser.add_argument('-v', '--verbose', action="store_true", help="show the traceback for each task's last error")
+    daemon_tasks_parser.set_defaults(func=_cmd_tasks)
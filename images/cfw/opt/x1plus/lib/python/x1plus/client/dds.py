@@ -0,0 +1,216 @@
+"""
+Recording and replaying DDS traffic on the printer (see x1plus.ddsrecord),
+and showing what is flowing on which topics.  x1plus.dds is only imported
+by the commands that need it, since it loads libdds_intf.so and starts up
+DDS.
+"""
+
+from datetime import datetime
+import json
+import os
+import sys
+import time
+
+# These are the same as in x1plus.dds, which we cannot import just to read
+# the stats files (see above).
+STATS_DIR = "/tmp/x1plus-dds-stats"
+SIZE_BUCKETS = [64 << i for i in range(11)]
+INTERVAL_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
+PROCESS_NAME_MAX = 60
+
+def _format_bytes(n):
+    for unit in ["B", "KB", "MB"]:
+        if n < 1024:
+            return f"{n:.0f} {unit}"
+        n /= 1024
+    return f"{n:.1f} GB"
+
+def _format_ms(stats):
+    if stats is None:
+        return "n/a"
+    return f"p50 {stats['p50'] * 1000:.2f} ms, p90 {stats['p90'] * 1000:.2f} ms, p99 {stats['p99'] * 1000:.2f} ms, max {stats['max'] * 1000:.2f} ms ({stats['count']} samples)"
+
+def _cmd_record(args):
+    import x1plus.dds
+    from x1plus.ddsrecord import Recorder
+
+    recorder = Recorder(args.file, args.topic, compress = not args.no_compress)
+    recorder.start()
+    print(f"Recording {', '.join(args.topic)} to {args.file}; press Ctrl-C to stop.")
+    t0 = time.monotonic()
+    try:
+        while args.duration is None or time.monotonic() - t0 < args.duration:
+            time.sleep(1)
+            total = sum(recorder.counts.values())
+            print(f"\r  {time.monotonic() - t0:.0f}s: {total} messages, {recorder.dropped} dropped", end = "", file = sys.stderr)
+    except KeyboardInterrupt:
+        pass
+    print("", file = sys.stderr)
+    recorder.stop()
+    for topic in args.topic:
+        print(f"  {topic}: {recorder.writer.counts.get(topic, 0)} messages, {_format_bytes(recorder.writer.bytes.get(topic, 0))}")
+    if recorder.dropped:
+        print(f"  {recorder.dropped} messages were dropped because the disk could not keep up")
+
+def _open_recording(path):
+    from x1plus.ddsrecord import Reader, RecordingError
+
+    try:
+        return Reader(path)
+    except (OSError, RecordingError) as e:
+        print(f"Could not open {path}: {e}", file = sys.stderr)
+        sys.exit(1)
+
+def _cmd_info(args):
+    reader = _open_recording(args.file)
+    info = reader.info
+    print(f"Recorded {datetime.fromtimestamp(info['started']).ctime()}, {info['duration']:.1f} seconds{'' if reader.complete else ' (not stopped cleanly; no index)'}.")
+    for topic in info['topics']:
+        count = info['counts'].get(topic, 0)
+        rate = count / info['duration'] if info['duration'] > 0 else 0
+        print(f"  {topic}: {count} messages ({rate:.1f}/s), {_format_bytes(info['bytes'].get(topic, 0))}")
+
+def _cmd_replay(args):
+    import x1plus.dds
+    from x1plus.ddsrecord import Replayer
+
+    reader = _open_recording(args.file)
+    speed = None if args.fast else args.speed
+    replayer = Replayer(reader, speed = speed, start = args.start, end = args.end, topics = args.topic, response_topic = args.response)
+    def progress(n, t):
+        if n % 100 == 0:
+            print(f"\r  {t:.1f}s into the recording, {n} messages published", end = "", file = sys.stderr)
+    try:
+        results = replayer.run(progress)
+    finally:
+        print("", file = sys.stderr)
+        x1plus.dds.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent = 2))
+        return
+    print(f"Published {results['published']} messages in {results['elapsed']:.2f}s ({results['rate'] or 0:.0f}/s, {'as fast as possible' if speed is None else f'{speed:g}x speed'}).")
+    if speed is not None:
+        print(f"  behind schedule: {_format_ms(results['lateness'])}")
+    print(f"  delivery: {_format_ms(results['delivery'])}")
+    if results['not_delivered']:
+        print(f"  {results['not_delivered']} messages never came back")
+    if args.response is not None:
+        print(f"  response on {args.response}: {_format_ms(results['response'])}")
+
+def _bucket_percentile(counts, bounds, p):
+    "The upper bound of the bucket that the pth percentile falls in."
+    total = sum(counts)
+    if total == 0:
+        return None
+    seen = 0
+    for i, n in enumerate(counts):
+        seen += n
+        if seen >= p / 100 * total and n > 0:
+            return bounds[i] if i < len(bounds) else None
+    return None
+
+def _process_name(pid, argv):
+    try:
+        with open(f"/proc/{pid}/cmdline", "rb") as f:
+            cmdline = f.read().rstrip(b"\0").replace(b"\0", b" ").decode(errors = "replace")
+        return " ".join((cmdline or " ".join(argv)).split())[:PROCESS_NAME_MAX]
+    except OSError:
+        return None
+
+def read_stats(include_exited = False):
+    """
+    Returns the contents of every process's DDS stats file, with a "name"
+    for each (or only the processes that are still running, with their
+    current names, unless include_exited).
+    """
+    stats = []
+    try:
+        names = sorted(os.listdir(STATS_DIR))
+    except FileNotFoundError:
+        return stats
+    for fname in names:
+        if not fname.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(STATS_DIR, fname), "r") as f:
+                proc = json.load(f)
+        except (OSError, ValueError):
+            continue
+        name = _process_name(proc['pid'], proc['argv'])
+        if name is None:
+            if not include_exited:
+                continue
+            name = f"{' '.join(proc['argv'])} (exited)"
+        proc['name'] = name
+        stats.append(proc)
+    return stats
+
+def _cmd_stats(args):
+    procs = read_stats(args.all)
+    if args.json:
+        print(json.dumps(procs, indent = 2))
+        return
+    if not procs:
+        print(f"No DDS statistics in {STATS_DIR} yet; they get written every few seconds by each process that uses DDS.")
+        return
+
+    rows = []
+    for proc in procs:
+        for direction in ["rx", "tx"]:
+            for topic, st in proc['topics'][direction].items():
+                if args.topic is not None and topic not in args.topic:
+                    continue
+                rows.append((topic, direction, proc, st))
+    sort_keys = {
+        'load': lambda r: r[3]['load'] or 0,
+        'rate': lambda r: r[3]['rate'] or 0,
+        'bytes': lambda r: r[3]['byte_rate'] or 0,
+        'topic': lambda r: r[0],
+    }
+    rows.sort(key = sort_keys[args.sort], reverse = args.sort != 'topic')
+
+    print(f"{'topic':<28} {'dir':<3} {'pid':>6}  {'msgs':>8} {'msg/s':>7} {'KB/s':>7} {'avg B':>6} {'p90 B':>6} {'gap p50':>8} {'load':>6}  process")
+    for topic, direction, proc, st in rows:
+        avg = st['bytes'] / st['count'] if st['count'] else 0
+        p90_size = _bucket_percentile(st['sizes'], SIZE_BUCKETS, 90)
+        p50_gap = _bucket_percentile(st['intervals'], INTERVAL_BUCKETS_MS, 50)
+        print(f"{topic:<28} {direction:<3} {proc['pid']:>6}  {st['count']:>8} {st['rate'] or 0:>7.1f} {(st['byte_rate'] or 0) / 1024:>7.1f} {avg:>6.0f} {'>64K' if p90_size is None else p90_size:>6} "
+              f"{'-' if p50_gap is None else f'<{p50_gap}ms':>8} {(st['load'] or 0) * 100:>5.1f}%  {proc['name']}")
+    print("")
+    print("msg/s, KB/s, and load are over the last few seconds; load is the share of a CPU spent handing messages to")
+    print("subscribers (rx) or to DDS (tx).  Sizes and gaps are the upper bounds of histogram buckets.")
+
+def add_subparser(subparsers):
+    dds_parser = subparsers.add_parser('dds', help="record, replay, and measure DDS traffic")
+    dds_subparsers = dds_parser.add_subparsers(title = 'subcommands', required = True)
+
+    dds_record_parser = dds_subparsers.add_parser('record', help="record DDS traffic to a file")
+    dds_record_parser.add_argument('file', action="store", help="file to record to")
+    dds_record_parser.add_argument('-t', '--topic', action="append", required = True, help="topic to record (can be given more than once)")
+    dds_record_parser.add_argument('--duration', type = float, help="stop after this many seconds, rather than at Ctrl-C")
+    dds_record_parser.add_argument('--no-compress', action="store_true", help="do not compress large messages")
+    dds_record_parser.set_defaults(func=_cmd_record)
+
+    dds_info_parser = dds_subparsers.add_parser('info', help="describe a DDS recording")
+    dds_info_parser.add_argument('file', action="store", help="recording to describe")
+    dds_info_parser.set_defaults(func=_cmd_info)
+
+    dds_replay_parser = dds_subparsers.add_parser('replay', help="publish the traffic in a DDS recording again")
+    dds_replay_parser.add_argument('file', action="store", help="recording to replay")
+    dds_replay_parser.add_argument('--speed', type = float, default = 1.0, help="replay at this multiple of the original speed (default 1)")
+    dds_replay_parser.add_argument('--fast', action="store_true", help="replay as fast as possible")
+    dds_replay_parser.add_argument('-t', '--topic', action="append", help="only replay this topic (can be given more than once)")
+    dds_replay_parser.add_argument('--start', type = float, default = 0.0, help="start this many seconds into the recording")
+    dds_replay_parser.add_argument('--end', type = float, help="stop this many seconds into the recording")
+    dds_replay_parser.add_argument('--response', metavar = 'TOPIC', help="also time how long after each message a consumer answers on TOPIC")
+    dds_replay_parser.add_argument('--json', action="store_true", help="print the results as JSON")
+    dds_replay_parser.set_defaults(func=_cmd_replay)
+
+    dds_stats_parser = dds_subparsers.add_parser('stats', help="show how much is flowing on each DDS topic, and who is sending it")
+    dds_stats_parser.add_argument('-t', '--topic', action="append", help="only show this topic (can be given more than once)")
+    dds_stats_parser.add_argument('--sort', choices = ['load', 'rate', 'bytes', 'topic'], default = 'load', help="what to sort by (default load)")
+    dds_stats_parser.add_argument('--all', action="store_true", help="include processes that have exited")
+    dds_stats_parser.add_argument('--json', action="store_true", help="print the raw statistics as JSON")
+    dds_stats_parser.set_defaults(func=_cmd_stats)
@@ -1,5 +1,6 @@
 from .base import call
 from . import settings
+from . import statusboard
 
 from jeepney import DBusAddress
 
@@ -15,11 +16,22 @@ def download(base_firmware = True):
     call(OTA_DBUS_ADDRESS, 'Download', { "base_firmware": base_firmware })
 
 def update():
-    call(OTA_DBUS_ADDRESS, 'Update')
+    return call(OTA_DBUS_ADDRESS, 'Update')
 
 def get_status():
     return call(OTA_DBUS_ADDRESS, 'GetStatus')
 
+def get_download_history():
+    return call(OTA_DBUS_ADDRESS, 'GetDownloadHistory')['downloads']
+
+def get_progress():
+    """
+    Returns the fast-changing subset of get_status() (status, download
+    progress, and what is downloaded) from the status board, without a
+    DBus round trip, or the full get_status() if the board is not there.
+    """
+    return statusboard.get('ota') or get_status()
+
 ###
 
 from datetime import datetime
@@ -63,14 +75,90 @@ def _cmd_status(args = None):
         else:
             print(f"  Base firmware image has NOT been downloaded.  Use `x1plus ota download --base` to download it, or download from {status['ota_info']['base_update_url']} .")
 
-    # ... download status ...
+    if status.get('verify'):
+        print("")
+        print(f"Verifying {status['verify']['file']}: {status['verify']['bytes']}/{status['verify']['bytes_total']} bytes...")
+
+    prestage = status.get('prestage')
+    if prestage:
+        print("")
+        if prestage['status'] == 'VERIFYING':
+            print(f"Checking the downloaded update: {prestage['bytes']}/{prestage['bytes_total']} bytes...")
+        elif prestage['status'] == 'VERIFIED':
+            print(f"Downloaded update has been checked{', and unpacked ahead of time' if prestage['staged'] else ''}.")
+        elif prestage['status'] == 'FAILED':
+            print(f"Downloaded update is no good: {prestage['error']}")
+
+    if status['status'] in ('DOWNLOADING_X1P', 'DOWNLOADING_BASE'):
+        print("")
+        print(f"Downloaded {status['download']['bytes']}/{status['download']['bytes_total']} bytes{_describe_limit(status['download'])}{_describe_telemetry(status['download'])}.")
+
+def _describe_limit(download):
+    limit = download.get('limit')
+    if not limit:
+        return ""
+    if limit['paused']:
+        return " (paused while printing)" if limit['printing'] else " (paused)"
+    if limit['rate'] is not None:
+        return f" (limited to {limit['rate'] // 1024} KB/s{' while printing' if limit['printing'] else ''})"
+    return ""
+
+def _format_rate(rate):
+    if rate is None:
+        return "?"
+    if rate >= 1048576:
+        return f"{rate / 1048576:.2f} MB/s"
+    return f"{rate / 1024:.0f} KB/s"
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return f"{seconds // 3600}:{seconds // 60 % 60:02}:{seconds % 60:02}"
+    return f"{seconds // 60}:{seconds % 60:02}"
+
+def _describe_telemetry(download):
+    telemetry = download.get('telemetry')
+    if not telemetry:
+        return ""
+    parts = []
+    if telemetry['rate'] is not None:
+        parts.append(_format_rate(telemetry['rate']))
+    if telemetry['eta'] is not None:
+        parts.append(f"{_format_duration(telemetry['eta'])} left")
+    if telemetry['stalled']:
+        parts.append(f"nothing received for {telemetry['since_last_byte']:.0f}s")
+    if telemetry['retries']:
+        parts.append(f"{telemetry['retries']} {'retry' if telemetry['retries'] == 1 else 'retries'}")
+    return "".join(f", {p}" for p in parts)
+
+_SPARKS = " ▁▂▃▄▅▆▇█"
+
+def _sparkline(samples):
+    top = max(samples, default=0)
+    if top == 0:
+        return ""
+    return "".join(_SPARKS[round(s / top * (len(_SPARKS) - 1))] for s in samples)
+
+def _cmd_history(args):
+    downloads = get_download_history()
+    if not downloads:
+        print("No downloads yet.")
+        return
+
+    for d in downloads:
+        print(f"{datetime.fromtimestamp(d['started']).ctime()}: {d['name']}: {d['result']}{': ' + d['error'] if d['error'] else ''}")
+        resumed = f" (resumed from {d['resumed_from']})" if d['resumed_from'] else ""
+        print(f"  {d['bytes']} bytes{resumed} in {_format_duration(d['duration'])} at {_format_rate(d['rate'])}, over {d['connections']} connection(s)")
+        print(f"  {d['retries']} retries, {d['stalls']} stalls, {d['pauses']} pauses")
+        if d['samples']:
+            print(f"  [{_sparkline(d['samples'])}] peak {_format_rate(max(d['samples']))}, one sample per {d['sample_interval']}s")
 
 def _cmd_check(args):
     print("Triggering OTA check.")
     check_now()
     
     print("Waiting for check to complete...")
-    while get_status()['status'] == 'CHECKING_OTA':
+    while get_progress()['status'] == 'CHECKING_OTA':
         time.sleep(0.5)
     print("")
     _cmd_status()
@@ -94,11 +182,21 @@ def _cmd_download(args):
     download(base_firmware = args.base)
     
     print("Waiting for download to complete...")
+
+    # The OTA engine picks the request up asynchronously, so give it a
+    # moment to get going before deciding that it is already done.
+    deadline = time.time() + 5
+    while time.time() < deadline:
+        status = get_progress()
+        if status['status'] != 'IDLE' or (status['ota_is_downloaded'] and (status['ota_base_is_downloaded'] or not args.base)):
+            break
+        time.sleep(0.1)
+
     while True:
-        status = get_status()
+        status = get_progress()
         if status['status'] == 'IDLE':
             break
-        print(f"Status: {status['status']}: {status['download']['bytes']}/{status['download']['bytes_total']} bytes...")
+        print(f"Status: {status['status']}: {status['download']['bytes']}/{status['download']['bytes_total']} bytes{_describe_limit(status['download'])}{_describe_telemetry(status['download'])}...")
         time.sleep(0.5)
 
     # XXX: check status['download']['last_error']?    
@@ -119,10 +217,22 @@ def _cmd_update(args):
         print("Update is not fully downloaded -- cannot install.")
         return
 
+    if (status.get('prestage') or {}).get('status') == 'VERIFYING':
+        print("Waiting for the downloaded update to be checked...")
+        while (get_progress().get('prestage') or {}).get('status') == 'VERIFYING':
+            time.sleep(0.5)
+        status = get_status()
+
+    if (status.get('prestage') or {}).get('status') == 'FAILED':
+        print(f"Downloaded update is no good -- cannot install: {status['prestage']['error']}")
+        return
+
     print(f"Rebooting to install X1Plus version {status['ota_info']['cfwVersion']} in 5 seconds -- press ctrl-C to abort!")
     time.sleep(5)
     
-    update()
+    rv = update()
+    if rv.get('status') == 'failure':
+        print(f"Cannot install update: {rv['reason']}")
 
 def _cmd_set_url(args):
     if args.url == "":
@@ -149,6 +259,9 @@ def add_subparser(subparsers):
     ota_download_parser.add_argument('--base', action="store_true", help="download base firmware as well as X1Plus update, if needed")
     ota_download_parser.set_defaults(func=_cmd_download)
 
+    ota_history_parser = ota_subparsers.add_parser('history', help="show how recent downloads went")
+    ota_history_parser.set_defaults(func=_cmd_history)
+
     ota_update_parser = ota_subparsers.add_parser('update', help="immediately apply a pending update, if one is available")
     ota_update_parser.set_defaults(func=_cmd_update)
     
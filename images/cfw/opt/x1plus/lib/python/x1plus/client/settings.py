@@ -1,18 +1,37 @@
+from . import base
 from .base import call
 
-from jeepney import DBusAddress
+from jeepney import DBusAddress, MatchRule
 
 SETTINGS_DBUS_ADDRESS = DBusAddress('/x1plus/settings', bus_name='x1plus.x1plusd', interface='x1plus.settings')
 
 _settings = None
+_epoch = None
+_version = None
 
 def get_settings(force = False):
-    global _settings
+    """
+    Returns all X1Plus settings.  The first call fetches everything from
+    x1plusd; after that, force = True fetches only what has changed since
+    (or everything, if x1plusd has restarted in the meantime).
+    """
+    global _settings, _epoch, _version
     if _settings == None or force:
-        _settings = call(SETTINGS_DBUS_ADDRESS, 'GetSettings')
+        since = None if _settings == None else { 'epoch': _epoch, 'version': _version }
+        resp = call(SETTINGS_DBUS_ADDRESS, 'GetSettingsSince', since)
+        if resp['full']:
+            _settings = resp['settings']
+        else:
+            for k, v in resp['settings'].items():
+                if v is None:
+                    _settings.pop(k, None)
+                else:
+                    _settings[k] = v
+        _epoch = resp['epoch']
+        _version = resp['version']
     return _settings
 
-def get():
+def get(*args):
     return get_settings().get(*args)
 
 def put_multiple(keys):
@@ -21,6 +40,33 @@ def put_multiple(keys):
 def put(key, value):
     put_multiple({ key: value })
 
+def patch(key, ops):
+    """
+    Applies a list of RFC 6902 JSON Patch operations to a single setting. 
+    Returns the list of paths within the setting that changed.
+    """
+    rv = call(SETTINGS_DBUS_ADDRESS, 'PatchSettings', { 'key': key, 'patch': ops })
+    if rv['status'] != 'ok':
+        raise ValueError(rv['reason'])
+    return rv['paths']
+
+def watch(patterns):
+    """
+    Generator that yields a dict of changed settings every time any setting
+    matching one of patterns changes.  Patterns are dotted keys, where a
+    trailing '*' matches everything underneath ('ota.*'), and other
+    segments can be globs ('boot.*_log').
+    """
+    rule = MatchRule(type='signal', interface=SETTINGS_DBUS_ADDRESS.interface, member='WatchedSettingsChanged')
+    with base.get_dbus_connection().filter(rule, bufsize=256) as queue:
+        call(SETTINGS_DBUS_ADDRESS, 'WatchSettings', { 'patterns': patterns })
+        while True:
+            msg = base.get_dbus_connection().recv_until_filtered(queue)
+            changes = json.loads(msg.body[0])
+            for k in changes.get('_patch', {}):
+                changes[k] = get_settings(force = True).get(k)
+            yield { k: v for k, v in changes.items() if not k.startswith('_') }
+
 ###
 
 import json, sys, pathlib
@@ -53,6 +99,34 @@ def _cmd_get(args):
             print(json.dumps(settings[key]))
     sys.exit(rv) 
 
+def _cmd_watch(args):
+    try:
+        for changes in watch(args.patterns):
+            for k, v in sorted(changes.items()):
+                print(f"{k}: {json.dumps(v)}", flush=True)
+    except KeyboardInterrupt:
+        pass
+
+def _cmd_patch(args):
+    try:
+        ops = json.loads(args.patch[0])
+    except Exception as e:
+        print(f"'{args.patch[0]}' does not look like valid JSON to me: {e}", file=sys.stderr)
+        sys.exit(1)
+    if isinstance(ops, dict):
+        ops = [ops]
+
+    try:
+        paths = patch(args.key[0], ops)
+    except ValueError as e:
+        print(f"patch failed: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if len(paths) == 0:
+        print(f"{args.key[0]}: unchanged")
+    else:
+        print(f"{args.key[0]}: {json.dumps(get_settings().get(args.key[0]))}")
+
 def _cmd_set(args):
     value = args.value[0]
     if args.json:
@@ -117,6 +191,10 @@ def add_subparser(subparsers):
     
     # XXX: should there be a 'known' option that shows all known settings?
     
+    watch_parser = settings_subparsers.add_parser('watch', help='print X1Plus settings as they change')
+    watch_parser.add_argument('patterns', action="store", nargs="*", default=['*'], help="keys or patterns to watch (e.g., 'ota.*'); if not specified, watches all settings")
+    watch_parser.set_defaults(func=_cmd_watch)
+    
     set_parser = settings_subparsers.add_parser('set', help='write an X1Plus setting')
     set_parser.add_argument('key', action="store", nargs=1, help="name of the setting key to write")
     set_parser.add_argument('value', action="store", nargs=1, help="value to write (defaults to 'generous' parsing, can be overridden with individual parse options)")
@@ -126,3 +204,8 @@ def add_subparser(subparsers):
     set_parser.add_argument('--bool', action="store_true", help="strictly interpret value as a boolean")
     set_parser.add_argument('--null', action="store_true", help="strictly interpret value as a null")
     set_parser.set_defaults(func=_cmd_set)
+
+    patch_parser = settings_subparsers.add_parser('patch', help='apply a JSON Patch (RFC 6902) to an X1Plus setting')
+    patch_parser.add_argument('key', action="store", nargs=1, help="name of the setting key to patch")
+    patch_parser.add_argument('patch', action="store", nargs=1, help="JSON list of patch operations (e.g., '[{\"op\": \"replace\", \"path\": \"/power/long\", \"value\": \"reboot\"}]')")
+    patch_parser.set_defaults(func=_cmd_patch)
@@ -0,0 +1,50 @@
+from .base import call
+
+from jeepney import DBusAddress
+
+STATS_DBUS_ADDRESS = DBusAddress('/x1plus/stats', bus_name='x1plus.x1plusd', interface='x1plus.stats')
+
+def get_stats():
+    return call(STATS_DBUS_ADDRESS, 'GetStats')
+
+###
+
+from datetime import datetime
+import json
+
+def _format_ms(ms):
+    if ms is None:
+        return "-"
+    return f"{ms:.0f}" if ms >= 10 else f"{ms:.1f}"
+
+def _cmd_stats(args):
+    stats = get_stats()
+    if args.json:
+        print(json.dumps(stats, indent=2))
+        return
+
+    loop = stats['loop']
+    lag = loop['lag_ms']
+    print(f"Event loop lag over the last {loop['samples']} samples (one per {loop['interval_ms']:.0f} ms):")
+    print(f"  p50 {_format_ms(lag['p50'])} ms, p90 {_format_ms(lag['p90'])} ms, p99 {_format_ms(lag['p99'])} ms, max {_format_ms(lag['max_recent'])} ms ({_format_ms(lag['max'])} ms since startup)")
+    print(f"  held up for over {loop['slow_callback_threshold_ms']:.0f} ms {loop['slow_callback_count']} time{'' if loop['slow_callback_count'] == 1 else 's'}")
+    for cb in loop['slow_callbacks'][-(args.stalls):] if args.stalls > 0 else []:
+        print(f"  {datetime.fromtimestamp(cb['time']).ctime()}: at least {_format_ms(cb['duration_ms'])} ms, in:")
+        for line in cb['stack'].rstrip().split("\n"):
+            print(f"    {line}")
+
+    print("")
+    methods = stats['methods']
+    if not methods:
+        print("No DBus method calls yet.")
+        return
+    width = max(len(name) for name in methods)
+    print(f"{'DBus method':<{width}}  {'calls':>6}  {'errors':>6}  {'p50':>6}  {'p90':>6}  {'p99':>6}  {'max':>6}  (ms)")
+    for name, m in sorted(methods.items(), key=lambda kv: -kv[1]['count']):
+        print(f"{name:<{width}}  {m['count']:>6}  {m['errors'] + m['timeouts']:>6}  {_format_ms(m['p50_ms']):>6}  {_format_ms(m['p90_ms']):>6}  {_format_ms(m['p99_ms']):>6}  {_format_ms(m['max_ms']):>6}")
+
+def add_subparser(subparsers):
+    stats_parser = subparsers.add_parser('stats', help="show event loop and DBus latency statistics for x1plusd")
+    stats_parser.add_argument('--stalls', type=int, default=3, metavar='N', help="show stacks for the last N times the event loop was blocked (default 3)")
+    stats_parser.add_argument('--json', action="store_true", help="print the raw statistics as JSON")
+    stats_parser.set_defaults(func=_cmd_stats)
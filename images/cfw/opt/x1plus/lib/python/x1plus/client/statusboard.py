@@ -0,0 +1,24 @@
+"""
+Reads frequently changing x1plusd state (like OTA download progress) out
+of the shared-memory status board, without talking to DBus; see
+x1plus/statusboard.py for how it works.  These return None (or the
+default) if x1plusd is not running or has not published the value, so
+callers should be ready to fall back to asking over DBus.
+"""
+
+from x1plus.statusboard import StatusBoardReader
+
+_reader = StatusBoardReader()
+
+def get(name, default = None):
+    return _reader.get(name, default)
+
+def read(name):
+    """
+    Returns (value, timestamp) for a value on the board, where timestamp
+    is when x1plusd last updated it.
+    """
+    return _reader.read(name)
+
+def items():
+    return _reader.items()
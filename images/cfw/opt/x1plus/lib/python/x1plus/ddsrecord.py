@@ -0,0 +1,413 @@
+"""
+Recording DDS traffic to a file, and playing it back, so that changes to
+the things that consume DDS (syslog_shim, gpiokeys, the UI) can be
+benchmarked against the same traffic every time -- say, everything that
+the printer says during a full bed mesh and vibration calibration.
+
+A recording is a header, then a stream of records, then (if the
+recording was stopped cleanly) an index:
+
+  header:  MAGIC, then the wall-clock time that the recording started
+           (struct "<d").
+  records: each is a RECORD header (kind, topic id, seconds since the
+           start of the recording, data length) and then that much data.
+           A KIND_TOPIC record names a topic id for the records after it;
+           KIND_MESSAGE and KIND_MESSAGE_ZLIB records hold one message's
+           JSON, as is or zlib-compressed.
+  index:   JSON: the topics, per-topic message counts and bytes, the
+           duration, and the file offset of the first record at or after
+           every INDEX_INTERVAL seconds, so that playback can start
+           partway through without reading everything before it.  Then
+           FOOTER: the index's offset, and INDEX_MAGIC.
+
+A recording without an index (because the recorder got killed) can still
+be played back; Reader just has to read through it to work out what the
+index would have said.
+"""
+
+import os
+import json
+import time
+import zlib
+import queue
+import struct
+import threading
+
+MAGIC = b"X1PDDSR\x01"
+HEADER = struct.Struct("<d")
+RECORD = struct.Struct("<BHdI")
+FOOTER = struct.Struct("<Q8s")
+INDEX_MAGIC = b"X1PDDIDX"
+
+KIND_TOPIC = 0
+KIND_MESSAGE = 1
+KIND_MESSAGE_ZLIB = 2
+
+INDEX_INTERVAL = 1.0
+
+# Messages smaller than this are not worth compressing.
+COMPRESS_MIN = 128
+COMPRESS_LEVEL = 1
+
+# How long a replay waits at the end for its last messages to be delivered.
+DRAIN_TIME = 0.5
+
+# How many messages the recorder will hold on to while the disk catches
+# up, before it starts dropping them (and counting the drops).
+RECORDER_BACKLOG = 100000
+
+
+class RecordingError(Exception):
+    "The file is not a DDS recording, or is damaged."
+
+
+class _Tap:
+    "What Recorder attaches to x1plus.dds for each topic that it records."
+
+    def __init__(self, topic, recorder):
+        self.topic = topic
+        self.recorder = recorder
+
+    def offer(self, msg):
+        self.recorder._offer(self.topic, msg)
+
+    def stats(self):
+        return {"topic": self.topic, "policy": "record", "received": self.recorder.counts.get(self.topic, 0)}
+
+
+class Writer:
+    "Writes a recording to path; see the module docstring for the format."
+
+    def __init__(self, path, compress=True):
+        self.f = open(path, "wb")
+        self.compress = compress
+        self.started = time.time()
+        self.topic_ids = {}
+        self.counts = {}
+        self.bytes = {}
+        self.index = []
+        self.last_t = 0.0
+        self.f.write(MAGIC + HEADER.pack(self.started))
+
+    def write(self, t, topic, msg):
+        "Write msg (a str), which arrived on topic t seconds in."
+
+        topic_id = self.topic_ids.get(topic)
+        if topic_id is None:
+            topic_id = self.topic_ids[topic] = len(self.topic_ids)
+            name = topic.encode()
+            self.f.write(RECORD.pack(KIND_TOPIC, topic_id, t, len(name)) + name)
+
+        if not self.index or t >= self.index[-1][0] + INDEX_INTERVAL:
+            self.index.append((t, self.f.tell()))
+
+        data = msg.encode()
+        kind = KIND_MESSAGE
+        if self.compress and len(data) >= COMPRESS_MIN:
+            z = zlib.compress(data, COMPRESS_LEVEL)
+            if len(z) < len(data):
+                kind, data = KIND_MESSAGE_ZLIB, z
+        self.f.write(RECORD.pack(kind, topic_id, t, len(data)) + data)
+        self.counts[topic] = self.counts.get(topic, 0) + 1
+        self.bytes[topic] = self.bytes.get(topic, 0) + len(msg)
+        self.last_t = max(self.last_t, t)
+
+    def close(self):
+        index_offset = self.f.tell()
+        self.f.write(json.dumps({
+            "started": self.started,
+            "duration": self.last_t,
+            "topics": sorted(self.topic_ids, key=self.topic_ids.get),
+            "counts": self.counts,
+            "bytes": self.bytes,
+            "index": self.index,
+        }).encode())
+        self.f.write(FOOTER.pack(index_offset, INDEX_MAGIC))
+        self.f.close()
+
+
+class Recorder:
+    """
+    Records everything on topics to path, from when start() is called to
+    when stop() is.  Messages get timestamped as they come in, on the DDS
+    receive thread, and written out on a thread of our own.
+    """
+
+    def __init__(self, path, topics, compress=True):
+        self.writer = Writer(path, compress)
+        self.topics = topics
+        self.taps = []
+        self.counts = {}
+        self.dropped = 0
+        self.t0 = None
+        self.backlog = queue.Queue(RECORDER_BACKLOG)
+        self.thread = threading.Thread(target=self._write, name="dds-record", daemon=True)
+
+    def start(self):
+        import x1plus.dds
+
+        self.t0 = time.monotonic()
+        self.thread.start()
+        for topic in self.topics:
+            tap = _Tap(topic, self)
+            x1plus.dds.attach(tap)
+            self.taps.append(tap)
+
+    def _offer(self, topic, msg):
+        try:
+            self.backlog.put_nowait((time.monotonic() - self.t0, topic, msg))
+            self.counts[topic] = self.counts.get(topic, 0) + 1
+        except queue.Full:
+            self.dropped += 1
+
+    def _write(self):
+        while True:
+            item = self.backlog.get()
+            if item is None:
+                return
+            self.writer.write(*item)
+
+    def stop(self):
+        import x1plus.dds
+
+        for tap in self.taps:
+            x1plus.dds.unsubscribe(tap)
+        self.backlog.put(None)
+        self.thread.join()
+        self.writer.close()
+
+
+class Reader:
+    "Reads a recording that Writer wrote."
+
+    def __init__(self, path):
+        self.f = open(path, "rb")
+        head = self.f.read(len(MAGIC) + HEADER.size)
+        if len(head) < len(MAGIC) + HEADER.size or not head.startswith(MAGIC):
+            raise RecordingError(f"{path} is not a DDS recording")
+        (self.started,) = HEADER.unpack(head[len(MAGIC):])
+        self.data_start = len(head)
+        self.complete = True
+        self.info = self._read_index()
+        if self.info is None:
+            self.complete = False
+            self.info = self._scan()
+
+    def _read_index(self):
+        size = self.f.seek(0, os.SEEK_END)
+        if size < self.data_start + FOOTER.size:
+            return None
+        self.f.seek(size - FOOTER.size)
+        index_offset, magic = FOOTER.unpack(self.f.read(FOOTER.size))
+        if magic != INDEX_MAGIC or not self.data_start <= index_offset < size:
+            return None
+        self.f.seek(index_offset)
+        try:
+            info = json.loads(self.f.read(size - FOOTER.size - index_offset))
+        except ValueError:
+            return None
+        self.data_end = index_offset
+        return info
+
+    def _scan(self):
+        "Work out what the index would have said, the slow way."
+
+        self.data_end = self.f.seek(0, os.SEEK_END)
+        topics = {}
+        counts = {}
+        nbytes = {}
+        index = []
+        duration = 0.0
+        for offset, kind, topic_id, t, data in self._records(self.data_start):
+            if kind == KIND_TOPIC:
+                topics[topic_id] = data.decode()
+                continue
+            if not index or t >= index[-1][0] + INDEX_INTERVAL:
+                index.append((t, offset))
+            topic = topics.get(topic_id)
+            msg = self._decode(kind, data)
+            counts[topic] = counts.get(topic, 0) + 1
+            nbytes[topic] = nbytes.get(topic, 0) + len(msg)
+            duration = max(duration, t)
+        return {
+            "started": self.started,
+            "duration": duration,
+            "topics": [topics[i] for i in sorted(topics)],
+            "counts": counts,
+            "bytes": nbytes,
+            "index": index,
+        }
+
+    def _records(self, offset):
+        self.f.seek(offset)
+        while offset + RECORD.size <= self.data_end:
+            head = self.f.read(RECORD.size)
+            kind, topic_id, t, length = RECORD.unpack(head)
+            data = self.f.read(length)
+            if len(data) < length:
+                # A recording that got cut off partway through a record.
+                return
+            yield offset, kind, topic_id, t, data
+            offset += RECORD.size + length
+
+    @staticmethod
+    def _decode(kind, data):
+        if kind == KIND_MESSAGE_ZLIB:
+            data = zlib.decompress(data)
+        return data.decode()
+
+    def messages(self, start=0.0, end=None, topics=None):
+        """
+        Yields (seconds since the start of the recording, topic, message)
+        for each message from start to end seconds in, optionally only on
+        the given topics.
+        """
+
+        # Topic ids are defined in the stream before they are used, so we
+        # need them all before we skip ahead; they are in the index, in id
+        # order.
+        topic_names = dict(enumerate(self.info["topics"]))
+        offset = self.data_start
+        for t, index_offset in self.info["index"]:
+            if t > start:
+                break
+            offset = index_offset
+        for _offset, kind, topic_id, t, data in self._records(offset):
+            if kind == KIND_TOPIC:
+                topic_names[topic_id] = data.decode()
+                continue
+            if t < start:
+                continue
+            if end is not None and t > end:
+                return
+            topic = topic_names.get(topic_id)
+            if topics is not None and topic not in topics:
+                continue
+            yield t, topic, self._decode(kind, data)
+
+    def close(self):
+        self.f.close()
+
+
+def _percentiles(values):
+    if not values:
+        return None
+    ordered = sorted(values)
+    pick = lambda p: ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+    return {"p50": pick(50), "p90": pick(90), "p99": pick(99), "max": ordered[-1], "count": len(ordered)}
+
+
+class Replayer:
+    """
+    Publishes the messages from a Reader on x1plus.dds, at speed times the
+    speed that they were recorded at (or as fast as possible, if speed is
+    None), and measures:
+
+      * lateness: how far behind schedule each publish went out (which
+        goes up if publishing blocks, or if we cannot keep up);
+      * delivery: how long each message took to come back to a
+        subscriber of our own on the same topic, which is the delivery
+        latency that any other consumer sees, too;
+      * response (if response_topic is given): for each message on
+        response_topic, how long since the last message that we
+        published, for consumers that answer what they get.
+    """
+
+    def __init__(self, reader, speed=1.0, start=0.0, end=None, topics=None, response_topic=None):
+        self.reader = reader
+        self.speed = speed
+        self.start = start
+        self.end = end
+        self.topics = topics
+        self.response_topic = response_topic
+        self.lateness = []
+        self.delivery = []
+        self.response = []
+        self.published = 0
+        self.unmatched = 0
+        self._sent = {}
+        self._last_publish = None
+        self._lock = threading.Lock()
+        self.elapsed = 0.0
+
+    def _on_delivery(self, topic, msg):
+        now = time.monotonic()
+        with self._lock:
+            sent = self._sent.get((topic, msg))
+            if sent:
+                self.delivery.append(now - sent.pop(0))
+                if not sent:
+                    del self._sent[(topic, msg)]
+            else:
+                self.unmatched += 1
+
+    def _on_response(self, msg):
+        now = time.monotonic()
+        with self._lock:
+            if self._last_publish is not None:
+                self.response.append(now - self._last_publish)
+
+    def run(self, progress=None):
+        import x1plus.dds
+
+        topics = self.topics if self.topics is not None else self.reader.info["topics"]
+        publishers = {topic: x1plus.dds.publisher(topic) for topic in topics}
+        taps = [_Probe(topic, self._on_delivery) for topic in topics]
+        if self.response_topic is not None:
+            taps.append(_Probe(self.response_topic, lambda _topic, msg: self._on_response(msg)))
+        for tap in taps:
+            x1plus.dds.attach(tap)
+
+        t_start = time.monotonic()
+        first = None
+        try:
+            for t, topic, msg in self.reader.messages(self.start, self.end, set(topics)):
+                if first is None:
+                    first = t
+                if self.speed is not None:
+                    target = t_start + (t - first) / self.speed
+                    delay = target - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                    self.lateness.append(max(0.0, time.monotonic() - target))
+                now = time.monotonic()
+                with self._lock:
+                    self._sent.setdefault((topic, msg), []).append(now)
+                    self._last_publish = now
+                publishers[topic](msg)
+                self.published += 1
+                if progress is not None:
+                    progress(self.published, t)
+            self.elapsed = time.monotonic() - t_start
+            # Give the last few messages a chance to come back.
+            time.sleep(DRAIN_TIME)
+        finally:
+            for tap in taps:
+                x1plus.dds.unsubscribe(tap)
+        return self.results()
+
+    def results(self):
+        with self._lock:
+            lost = sum(len(v) for v in self._sent.values())
+        return {
+            "published": self.published,
+            "elapsed": self.elapsed,
+            "rate": self.published / self.elapsed if self.elapsed > 0 else None,
+            "lateness": _percentiles(self.lateness),
+            "delivery": _percentiles(self.delivery),
+            "not_delivered": lost,
+            "unexpected": self.unmatched,
+            "response": _percentiles(self.response),
+        }
+
+
+class _Probe:
+    def __init__(self, topic, fn):
+        self.topic = topic
+        self.fn = fn
+
+    def offer(self, msg):
+        self.fn(self.topic, msg)
+
+    def stats(self):
+        return {"topic": self.topic, "policy": "probe"}
@@ -1,12 +1,23 @@
 # Always invoke this with python3 -m x1plus.services.x1plusd.
 
-import asyncio
-import logging, logging.handlers
-import x1plus.utils
-from .dbus import *
-from .settings import SettingsService
-from .ota import OTAService
-from .sshd import SSHService
+# This goes first, so that the startup trace can tell how long the imports
+# below take.
+from .startup import trace
+
+with trace.phase("imports"):
+    import asyncio
+    import logging, logging.handlers
+    import x1plus.utils
+    from x1plus.statusboard import StatusBoardWriter
+    from .dbus import *
+    from .settings import SettingsService
+    from .ota import OTAService
+    from .sshd import SSHService
+    from .daemon import DaemonService
+    from .printstate import PrintStateMonitor
+    from .supervisor import Supervisor
+    from .instrument import LoopMonitor
+    from .stats import StatsService
 
 logger = logging.getLogger(__name__)
 
@@ -14,12 +25,50 @@ logger = logging.getLogger(__name__)
 async def main():
     logger.info("x1plusd is starting up")
 
-    router = await get_dbus_router()
-    settings = SettingsService(router=router)
-    ota = OTAService(router=router, settings=settings)
-    ssh = SSHService(settings=settings)
+    with trace.phase("dbus connect"):
+        router = await open_dbus_router()
+
+    # Losing the status board only means that readers have to go through
+    # DBus, so it is not worth failing to start over.
+    with trace.phase("status board"):
+        try:
+            statusboard = StatusBoardWriter()
+        except Exception as e:
+            logger.error(f"failed to create status board: {e}")
+            statusboard = None
+
+    # Everything that answers on DBus has to exist before we claim the bus
+    # name, so that nobody's early calls go missing; anything else can
+    # wait until after.
+    with trace.phase("settings"):
+        settings = SettingsService(router=router)
+    printstate = PrintStateMonitor()
+    with trace.phase("ota"):
+        ota = OTAService(router=router, settings=settings, statusboard=statusboard, printstate=printstate)
+    supervisor = Supervisor()
+    daemon = DaemonService(router=router, supervisor=supervisor)
+    monitor = LoopMonitor()
+    stats = StatsService(router=router, monitor=monitor)
 
-    asyncio.create_task(settings.task())
-    asyncio.create_task(ota.task())
+    with trace.phase("claim bus name"):
+        await claim_bus_name(router)
+
+    # If any of these fall over, the supervisor restarts just that one;
+    # everything else, including the bus name, stays where it is.
+    supervisor.start("settings", settings.task)
+    supervisor.start("settings.watchers", settings._reap_watchers)
+    supervisor.start("ota", ota.task)
+    supervisor.start("ota.engine", ota._ota_task)
+    supervisor.start("printstate", printstate.task)
+    supervisor.start("daemon", daemon.task)
+    supervisor.start("stats", stats.task)
+    supervisor.start("loopmonitor", monitor.task)
+    trace.ready()
+
+    # SSHService runs start-stop-daemon (and maybe dropbearkey and passwd)
+    # in the background, and nobody waits on it over DBus, so it does not
+    # hold up startup.
+    ssh = SSHService(settings=settings)
+    supervisor.start("ssh", ssh.task)
 
     logger.info("x1plusd is running")
@@ -20,18 +20,25 @@ logger.addHandler(ch)
 
 
 def exceptions(loop, ctx):
+    # The long-running tasks are looked after by the supervisor (see
+    # supervisor.py), so anything that ends up here is some one-off
+    # callback or task that went wrong; log it, and keep going, rather
+    # than taking everything else down with it.
     logger.error(f"exception in coroutine: {ctx['message']} {ctx.get('exception', '')}")
     loop.default_exception_handler(ctx)
-    try:
-        asyncio.get_running_loop().stop()
-    except:
-        pass
+
+
+def main_done(task):
+    # If we cannot even get started, there is nothing to keep going.
+    if task.cancelled() or task.exception() is not None:
+        logger.error(f"x1plusd failed to start: {'cancelled' if task.cancelled() else repr(task.exception())}")
+        loop.stop()
 
 
 # TODO: check if we are already running
 loop = asyncio.new_event_loop()
 loop.set_exception_handler(exceptions)
-loop.create_task(main())
+loop.create_task(main()).add_done_callback(main_done)
 try:
     loop.run_forever()
 finally:
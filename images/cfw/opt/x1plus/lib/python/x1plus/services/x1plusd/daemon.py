@@ -0,0 +1,28 @@
+from .dbus import *
+from .startup import trace
+
+logger = logging.getLogger(__name__)
+
+DAEMON_INTERFACE = "x1plus.daemon"
+DAEMON_PATH = "/x1plus/daemon"
+
+
+class DaemonService(X1PlusDBusService):
+    """
+    Introspection for x1plusd itself, as opposed to any one of the things
+    that it manages.
+    """
+
+    def __init__(self, supervisor=None, **kwargs):
+        self.supervisor = supervisor
+        super().__init__(
+            dbus_interface=DAEMON_INTERFACE, dbus_path=DAEMON_PATH, **kwargs
+        )
+
+    async def dbus_GetStartupTrace(self, req):
+        return trace.as_dict()
+
+    async def dbus_GetTasks(self, req):
+        if self.supervisor is None:
+            return {}
+        return self.supervisor.as_dict()
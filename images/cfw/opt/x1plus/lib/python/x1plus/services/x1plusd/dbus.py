@@ -1,4 +1,6 @@
 import json
+import time
+import asyncio
 
 import logging
 import x1plus.utils
@@ -13,26 +15,88 @@ from jeepney import (
 from jeepney.bus_messages import message_bus, MatchRule
 from jeepney.io.asyncio import open_dbus_connection, DBusRouter, Proxy
 
+from .instrument import method_latency
+
 BUS_NAME = "x1plus.x1plusd"
 
+# How many method calls a single service object will have running at once
+# before it stops pulling new calls off the bus.
+DEFAULT_MAX_INFLIGHT = 16
+
+# How long a method call may run (including time spent waiting its turn, if
+# it is serialized) before we give up and hand the caller an error.
+# bbl_screen makes synchronous DBus calls, so it is better for it to get an
+# error than to hang the UI.
+DEFAULT_METHOD_TIMEOUT = 30.0
+
+SERIALIZE_METHOD = "method"
+SERIALIZE_OBJECT = "object"
+
 logger = logging.getLogger(__name__)
 
 
-async def get_dbus_router():
+async def open_dbus_router():
     if x1plus.utils.is_emulating():
         conn = await open_dbus_connection("SESSION")
     else:
         conn = await open_dbus_connection("SYSTEM")
 
-    router = DBusRouter(conn)
+    return DBusRouter(conn)
+
+
+async def claim_bus_name(router):
+    """
+    Once this returns, clients can find us on the bus, so any service
+    objects should already be constructed by the time you call it (which
+    means that their method calls have somewhere to queue up).
+    """
 
     rv = await Proxy(message_bus, router).RequestName(BUS_NAME)
     if rv != (1,):
         raise RuntimeError(f"failed to attach bus name {BUS_NAME}")
 
+
+async def get_dbus_router():
+    router = await open_dbus_router()
+    await claim_bus_name(router)
     return router
 
 
+class JSONResponse(str):
+    """
+    A dbus_* method can return one of these -- a string that already
+    contains the JSON for its response -- to skip serializing the response
+    all over again on every call.  Useful for large, rarely-changing
+    responses that get asked for a lot.
+    """
+
+
+def dbus_method(serialize=None, timeout=None, pass_sender=False):
+    """
+    Decorator to adjust how X1PlusDBusService dispatches a dbus_* method.
+
+    By default, every incoming method call runs in its own task, so a slow
+    method does not hold up anybody else.  If a method cares about ordering,
+    pass serialize=SERIALIZE_METHOD to run calls to it one at a time, or
+    serialize=SERIALIZE_OBJECT to run it one at a time with respect to all
+    other SERIALIZE_OBJECT methods on the same object.  timeout overrides
+    the service's default deadline (in seconds) for this method.  If
+    pass_sender is set, the method is called with the caller's unique bus
+    name as a sender= keyword argument.
+    """
+
+    if serialize not in (None, SERIALIZE_METHOD, SERIALIZE_OBJECT):
+        raise ValueError(f"unknown serialization mode {serialize}")
+
+    def wrap(fn):
+        fn._x1p_serialize = serialize
+        fn._x1p_timeout = timeout
+        fn._x1p_pass_sender = pass_sender
+        return fn
+
+    return wrap
+
+
 class X1PlusDBusService:
     """
     An implementation of the very specific DBus service format that goes
@@ -44,64 +108,153 @@ class X1PlusDBusService:
     argument (you guessed it, a string containing a JSON value).  We
     abstract all of the DBus RPC logic into an asyncio task that a would-be
     DBus object can subclass to implement a BDbus-compatible object.
+
+    Each method call is handled in its own task, with at most max_inflight
+    calls running at once; see dbus_method() for how to ask for ordering or
+    a different deadline on a per-method basis.
     """
 
-    def __init__(self, router, dbus_interface, dbus_path):
+    def __init__(
+        self,
+        router,
+        dbus_interface,
+        dbus_path,
+        max_inflight=DEFAULT_MAX_INFLIGHT,
+        method_timeout=DEFAULT_METHOD_TIMEOUT,
+    ):
         self.router = router
         self.dbus_interface = dbus_interface
         self.dbus_path = dbus_path
+        self.method_timeout = method_timeout
+        self._inflight = asyncio.Semaphore(max_inflight)
+        self._inflight_tasks = set()
+        self._object_lock = asyncio.Lock()
+        self._method_locks = {}
 
-    async def task(self):
-        match = MatchRule(
+        # Start catching method calls right away, rather than when task()
+        # gets around to running, so that calls that show up as soon as
+        # the bus name is claimed wait in the queue instead of getting
+        # dropped on the floor.
+        self._match = MatchRule(
             interface=self.dbus_interface, path=self.dbus_path, type="method_call"
         )
-        await Proxy(message_bus, self.router).AddMatch(match)
-        with self.router.filter(match, bufsize=0) as queue:
-            while True:
-                msg = await queue.get()
-                method = msg.header.fields[HeaderFields.member]
-
-                if msg.header.fields[HeaderFields.signature] != "s":
-                    await self.router.send(
-                        new_error(msg, "x1plus.x1plusd.Error.BadSignature")
-                    )
-                    continue
-
-                arg = msg.body[0]
-
-                # Implement methods in your class of the form:
-                #
-                #   async def dbus_SomeMethod(self, req):
-                #       return { 'resp': req }
-                #
-                # where the return value and the parameter are both things
-                # that can be serialized to JSON values.  If such a method
-                # exists, then a DBUS_INTERFACE.SomeMethod invoke this method.
-                impl = getattr(self, f"dbus_{method}", None)
-                if not callable(impl):
-                    logger.warning(f"{method} -> NoMethod")
-                    await self.router.send(
-                        new_error(msg, "x1plus.x1plusd.Error.NoMethod")
-                    )
-                    continue
-
-                try:
-                    rv = await impl(json.loads(arg))
-                except Exception as e:
-                    logger.error(f"{method}({arg}) -> exception {e}")
-                    await self.router.send(
-                        new_error(msg, "x1plus.x1plusd.Error.InternalError")
-                    )
-                    continue
-
-                logger.debug(f"{method}({arg}) -> {rv}")
-                await self.router.send(new_method_return(msg, "s", (json.dumps(rv),)))
-
-    async def emit_signal(self, name, val):
+        self._filter = self.router.filter(self._match, bufsize=0)
+        self._match_added = False
+
+    async def task(self):
+        # The filter stays put for as long as the object is around, rather
+        # than going away when task() does, so that if task() gets
+        # restarted (see supervisor.py), calls that come in in the meantime
+        # are waiting for it when it comes back.
+        if not self._match_added:
+            await Proxy(message_bus, self.router).AddMatch(self._match)
+            self._match_added = True
+        queue = self._filter.queue
+        while True:
+            msg = await queue.get()
+
+            # Wait for a slot before we pick up the call, so that a
+            # flood of requests backs up in the queue rather than
+            # turning into an unbounded pile of tasks.
+            await self._inflight.acquire()
+            t = asyncio.create_task(self._dispatch(msg))
+            self._inflight_tasks.add(t)
+            t.add_done_callback(self._dispatch_done)
+
+    def _dispatch_done(self, t):
+        self._inflight_tasks.discard(t)
+        self._inflight.release()
+
+    def _lock_for(self, method, impl):
+        serialize = getattr(impl, "_x1p_serialize", None)
+        if serialize == SERIALIZE_OBJECT:
+            return self._object_lock
+        if serialize == SERIALIZE_METHOD:
+            if method not in self._method_locks:
+                self._method_locks[method] = asyncio.Lock()
+            return self._method_locks[method]
+        return None
+
+    async def _run_method(self, lock, impl, arg, kwargs):
+        if lock is None:
+            return await impl(arg, **kwargs)
+        async with lock:
+            return await impl(arg, **kwargs)
+
+    async def _dispatch(self, msg):
+        t0 = time.monotonic()
+        method = msg.header.fields[HeaderFields.member]
+
+        if msg.header.fields.get(HeaderFields.signature) != "s":
+            await self.router.send(
+                new_error(msg, "x1plus.x1plusd.Error.BadSignature")
+            )
+            return
+
+        arg = msg.body[0]
+
+        # Implement methods in your class of the form:
+        #
+        #   async def dbus_SomeMethod(self, req):
+        #       return { 'resp': req }
+        #
+        # where the return value and the parameter are both things
+        # that can be serialized to JSON values.  If such a method
+        # exists, then a DBUS_INTERFACE.SomeMethod invoke this method.
+        impl = getattr(self, f"dbus_{method}", None)
+        if not callable(impl):
+            logger.warning(f"{method} -> NoMethod")
+            await self.router.send(
+                new_error(msg, "x1plus.x1plusd.Error.NoMethod")
+            )
+            return
+
+        timeout = getattr(impl, "_x1p_timeout", None)
+        if timeout is None:
+            timeout = self.method_timeout
+
+        kwargs = {}
+        if getattr(impl, "_x1p_pass_sender", False):
+            kwargs["sender"] = msg.header.fields.get(HeaderFields.sender)
+
+        try:
+            rv = await asyncio.wait_for(
+                self._run_method(self._lock_for(method, impl), impl, json.loads(arg), kwargs),
+                timeout=timeout,
+            )
+        except asyncio.TimeoutError:
+            logger.error(f"{method}({arg}) -> timed out after {timeout}s")
+            await self.router.send(
+                new_error(msg, "x1plus.x1plusd.Error.Timeout")
+            )
+            method_latency.record(self.dbus_interface, method, time.monotonic() - t0, "timeout")
+            return
+        except Exception as e:
+            logger.error(f"{method}({arg}) -> exception {e}")
+            await self.router.send(
+                new_error(msg, "x1plus.x1plusd.Error.InternalError")
+            )
+            method_latency.record(self.dbus_interface, method, time.monotonic() - t0, "error")
+            return
+
+        logger.debug(f"{method}({arg}) -> {rv}")
+        if not isinstance(rv, JSONResponse):
+            rv = json.dumps(rv)
+        await self.router.send(new_method_return(msg, "s", (rv,)))
+        method_latency.record(self.dbus_interface, method, time.monotonic() - t0)
+
+    async def emit_signal(self, name, val, destination=None):
+        """
+        Broadcast a signal to everyone who is listening for it, or, if
+        destination is a bus name, send it only to that one client.
+        """
+
         signal = new_signal(
             DBusAddress("/", interface=self.dbus_interface),
             name,
             signature="s",
             body=(json.dumps(val),),
         )
+        if destination is not None:
+            signal.header.fields[HeaderFields.destination] = destination
         await self.router.send(signal)
@@ -0,0 +1,68 @@
+"""
+Reconstructing an .x1p from the one that is already installed and an
+xdelta3 patch (see scripts/mkotadelta.py for the other end of this).
+
+The installer ships xdelta3 in every .x1p's payload (it uses it to build
+bbl_screen), but only unpacks it while it is running, so we look for it
+on the system first, and failing that, dig it out of the payload of the
+.x1p that we are patching against -- which we are going to read anyway.
+"""
+
+import os
+import shutil
+import tarfile
+import zipfile
+
+from . import process
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+XDELTA3_PATHS = ["/opt/x1plus/bin/xdelta3", "/userdata/x1plus/xdelta3"]
+
+# Somewhere that we can execute things from; the SD card is no good for
+# that.
+XDELTA3_EXTRACT_PATH = "/tmp/x1plusd-xdelta3"
+
+# Rebuilding a few hundred megabytes on the SD card takes a while.
+APPLY_TIMEOUT = 600
+
+
+def find_xdelta3(x1p_path):
+    """
+    Returns the path to an xdelta3 binary, extracting it from the payload
+    of x1p_path if there is none installed.  Raises FileNotFoundError if
+    there is no xdelta3 to be had.  This can take a while (the payload is
+    one big gzip stream, and xdelta3 is near the end of it), so run it in
+    a worker thread.
+    """
+
+    for path in [shutil.which("xdelta3"), XDELTA3_EXTRACT_PATH] + XDELTA3_PATHS:
+        if path is not None and os.access(path, os.X_OK):
+            return path
+
+    logger.info(f"no xdelta3 installed; extracting it from {x1p_path}")
+    with zipfile.ZipFile(x1p_path, "r") as zf, zf.open("payload.tar.gz") as payload:
+        with tarfile.open(fileobj=payload, mode="r|gz") as tf:
+            for ti in tf:
+                if ti.name.lstrip("./") != "xdelta3" or not ti.isfile():
+                    continue
+                with tf.extractfile(ti) as src, open(f"{XDELTA3_EXTRACT_PATH}.new", "wb") as dst:
+                    shutil.copyfileobj(src, dst)
+                os.chmod(f"{XDELTA3_EXTRACT_PATH}.new", 0o755)
+                os.replace(f"{XDELTA3_EXTRACT_PATH}.new", XDELTA3_EXTRACT_PATH)
+                return XDELTA3_EXTRACT_PATH
+    raise FileNotFoundError(f"no xdelta3 installed, and none in {x1p_path}")
+
+
+async def apply_patch(xdelta3, source, patch, output):
+    """
+    Run xdelta3 to build output from source and patch.  Raises
+    RuntimeError if xdelta3 fails (or subprocess.TimeoutExpired if it
+    takes forever).  The output is not checked; that is up to the caller.
+    """
+
+    result = await process.run([xdelta3, "-d", "-f", "-s", source, patch, output], timeout=APPLY_TIMEOUT)
+    if result.returncode != 0:
+        raise RuntimeError(f"xdelta3 failed ({result.returncode}): {result.stderr.strip()}")
@@ -0,0 +1,461 @@
+import os
+import json
+import bisect
+
+import logging
+from .md5state import CheckpointableMD5
+
+logger = logging.getLogger(__name__)
+
+# How often (in bytes downloaded) we make the partial download durable, and
+# record how far we got.  Anything after the last checkpoint gets thrown
+# away and downloaded again when we resume.
+CHECKPOINT_BYTES = 4 * 1024 * 1024
+
+REHASH_CHUNK_SIZE = 1024 * 1024
+
+
+class PartialDownload:
+    """
+    The on-disk state of a download that might get interrupted: the data
+    so far lives in dest.part, and dest.part.json is a checkpoint that
+    says how many bytes of it are known to be good, which URL and md5 they
+    belong to, the validator (ETag or Last-Modified) that the server gave
+    us for it, and the state of the md5 up to that point.  When the whole
+    file is there and its md5 matches, dest.part is renamed to dest.
+
+    None of this is async; the file operations that might block for a
+    while (open, checkpoint, finish) are meant to be run in a worker
+    thread.
+    """
+
+    def __init__(self, dest, url, md5):
+        self.dest = dest
+        self.url = url
+        self.md5 = md5
+        self.part_path = f"{dest}.part"
+        self.checkpoint_path = f"{dest}.part.json"
+        self.bytes = 0
+        self.validator = None
+        self._hash = None
+        self._fh = None
+        self._checkpointed = 0
+        self.discarded = False
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "r") as f:
+                ckpt = json.load(f)
+            if ckpt["url"] != self.url or ckpt["md5"] != self.md5:
+                logger.debug(f"{self.checkpoint_path} is for a different download; starting over")
+                return None
+            if "bytes" not in ckpt:
+                # Left behind by a SegmentedDownload; we can keep whatever
+                # it got from the beginning of the file, but we have to
+                # hash it ourselves.
+                prefix = ckpt["done"][0] if ckpt["done"] and ckpt["done"][0][0] == 0 else [0, 0]
+                ckpt = { **ckpt, "bytes": prefix[1], "md5_state": None }
+            if os.path.getsize(self.part_path) < ckpt["bytes"]:
+                logger.warning(f"{self.part_path} is shorter than its checkpoint says; starting over")
+                return None
+            return ckpt
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"ignoring unreadable download checkpoint {self.checkpoint_path}: {e}")
+            return None
+
+    def open(self):
+        """
+        Get ready to write, picking up from the last checkpoint if there is
+        one that matches this download.  Returns the offset to resume from.
+        """
+
+        os.makedirs(os.path.dirname(self.dest), exist_ok=True)
+        ckpt = self._load_checkpoint()
+        if ckpt is None:
+            self._fh = open(self.part_path, "wb")
+            self._hash = CheckpointableMD5()
+            self.bytes = 0
+            self.validator = None
+            self._checkpointed = 0
+            return 0
+
+        self._fh = open(self.part_path, "r+b")
+        self._fh.truncate(ckpt["bytes"])
+        self._fh.seek(ckpt["bytes"])
+        self.bytes = ckpt["bytes"]
+        self.validator = ckpt.get("validator")
+        self._checkpointed = self.bytes
+
+        state = ckpt.get("md5_state")
+        try:
+            self._hash = CheckpointableMD5(bytes.fromhex(state)) if state is not None else None
+        except ValueError as e:
+            logger.warning(f"cannot restore md5 state from {self.checkpoint_path} ({e}); rehashing")
+            self._hash = None
+        if self._hash is None:
+            self._hash = CheckpointableMD5()
+            with open(self.part_path, "rb") as f:
+                remaining = self.bytes
+                while remaining > 0:
+                    chunk = f.read(min(REHASH_CHUNK_SIZE, remaining))
+                    if not chunk:
+                        raise IOError(f"{self.part_path} got shorter while we were reading it")
+                    self._hash.update(chunk)
+                    remaining -= len(chunk)
+
+        logger.info(f"resuming download of {self.url} at {self.bytes} bytes")
+        return self.bytes
+
+    def restart(self):
+        "Throw away what we have, because the server is sending the whole thing again."
+
+        self._fh.seek(0)
+        self._fh.truncate(0)
+        self._hash = CheckpointableMD5()
+        self.bytes = 0
+        self._checkpointed = 0
+
+    def write(self, chunk):
+        "Append a chunk; returns True if it is time to checkpoint()."
+
+        self._fh.write(chunk)
+        self._hash.update(chunk)
+        self.bytes += len(chunk)
+        return self.bytes - self._checkpointed >= CHECKPOINT_BYTES
+
+    def checkpoint(self):
+        "Make everything written so far durable, and record that it is."
+
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        state = self._hash.state()
+        with open(f"{self.checkpoint_path}.new", "w") as f:
+            json.dump({
+                "url": self.url,
+                "md5": self.md5,
+                "bytes": self.bytes,
+                "validator": self.validator,
+                "md5_state": state.hex() if state is not None else None,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.checkpoint_path}.new", self.checkpoint_path)
+        self._checkpointed = self.bytes
+
+    def finish(self):
+        """
+        Check the md5 of what we have, and if it is right, move it into
+        place.  If it is wrong, the partial download is no good to anyone,
+        so it gets thrown away, and ValueError is raised.
+        """
+
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self.close()
+
+        disk_md5 = self._hash.hexdigest()
+        logger.debug(f"{self.dest} has md5 {disk_md5}, want md5 {self.md5}")
+        if disk_md5 != self.md5:
+            self.discard()
+            raise ValueError("downloaded file had incorrect md5")
+
+        os.replace(self.part_path, self.dest)
+        try:
+            os.unlink(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        "Stop writing, but leave the partial download around to resume later."
+
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+
+    def discard(self):
+        "Throw away the partial download; there is nothing left to checkpoint."
+
+        self.close()
+        self.discarded = True
+        for path in [self.part_path, self.checkpoint_path]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+def remove_stale_partials(directory, urls, suffixes=None):
+    """
+    Remove the partial downloads in directory that are not of any of urls,
+    so that a download that got abandoned (because a newer version came
+    out before it finished, say) does not sit on the SD card forever.  If
+    suffixes is given, only partial downloads of files whose names end in
+    one of them are considered, for directories that have other people's
+    files in them too.  Partial downloads without a readable checkpoint
+    cannot be resumed anyway, so they go too.
+    """
+
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return
+
+    dests = set()
+    for name in names:
+        for suffix in [".part", ".part.json"]:
+            if name.endswith(suffix):
+                dests.add(name[:-len(suffix)])
+    for dest in sorted(dests):
+        if suffixes is not None and not dest.endswith(suffixes):
+            continue
+        part_path = os.path.join(directory, f"{dest}.part")
+        checkpoint_path = f"{part_path}.json"
+        try:
+            with open(checkpoint_path, "r") as f:
+                url = json.load(f)["url"]
+        except Exception:
+            url = None
+        if url is not None and url in urls:
+            continue
+        logger.info(f"removing stale partial download {part_path}")
+        for path in [part_path, checkpoint_path]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+
+class Segment:
+    "A range of a SegmentedDownload that one connection is working on."
+
+    def __init__(self, start, end):
+        self.start = start
+        self.pos = start
+        self.end = end
+
+    def remaining(self):
+        return self.end - self.pos
+
+
+class SegmentedDownload:
+    """
+    The on-disk state of a download that is being fetched as several byte
+    ranges at once.  dest.part is allocated at its full size up front, and
+    pieces of it get written wherever they land; the checkpoint in
+    dest.part.json records the file's size and validator, and the list of
+    [start, end) ranges that are known to be good.  Since the pieces do
+    not arrive in order, there is no running md5; the whole file gets
+    hashed once it is all there, and then finish() moves it into place.
+
+    Connections ask for work with claim(), which hands out the next piece
+    that nobody has, or if there is none left, splits the biggest piece
+    that someone else is still working on; that way, the connections all
+    finish at about the same time, rather than one slow one dragging out
+    the end of the download.  They give it back with release() when they
+    are done or have failed, and whatever they did not get goes back in
+    the pile for someone else.
+
+    Like PartialDownload, the parts that might block for a while (open,
+    checkpoint, finish) are meant to be run in a worker thread; the rest
+    should only be called from the event loop.
+    """
+
+    def __init__(self, dest, url, md5, size, validator):
+        self.dest = dest
+        self.url = url
+        self.md5 = md5
+        self.size = size
+        self.validator = validator
+        self.part_path = f"{dest}.part"
+        self.checkpoint_path = f"{dest}.part.json"
+        self.done = []
+        self.bytes = 0
+        self._unclaimed = []
+        self._active = []
+        self._fd = None
+        self._checkpointed = 0
+        self.discarded = False
+
+    def _load_checkpoint(self):
+        try:
+            with open(self.checkpoint_path, "r") as f:
+                ckpt = json.load(f)
+            if ckpt["url"] != self.url or ckpt["md5"] != self.md5 or ckpt.get("validator") != self.validator:
+                logger.debug(f"{self.checkpoint_path} is for a different download; starting over")
+                return None
+            if "done" not in ckpt:
+                # Left behind by a PartialDownload.
+                ckpt = { **ckpt, "size": self.size, "done": [[0, ckpt["bytes"]]] if ckpt["bytes"] else [] }
+            if ckpt["size"] != self.size:
+                logger.debug(f"{self.checkpoint_path} does not match the file on the server; starting over")
+                return None
+            if ckpt["done"] and os.path.getsize(self.part_path) < ckpt["done"][-1][1]:
+                logger.warning(f"{self.part_path} is shorter than its checkpoint says; starting over")
+                return None
+            return ckpt
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"ignoring unreadable download checkpoint {self.checkpoint_path}: {e}")
+            return None
+
+    def open(self):
+        """
+        Get ready to write, picking up from the last checkpoint if there is
+        one that matches this download.  Returns the list of [start, end)
+        ranges that still need to be fetched.
+        """
+
+        os.makedirs(os.path.dirname(self.dest), exist_ok=True)
+        ckpt = self._load_checkpoint()
+        if ckpt is None:
+            self._fd = os.open(self.part_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            self.done = []
+        else:
+            self._fd = os.open(self.part_path, os.O_RDWR)
+            self.done = [list(r) for r in ckpt["done"]]
+
+        # Allocate the whole thing now, so that we find out that the SD
+        # card is full before we have downloaded most of the file, rather
+        # than after.
+        os.ftruncate(self._fd, self.size)
+        try:
+            os.posix_fallocate(self._fd, 0, self.size)
+        except OSError as e:
+            logger.debug(f"could not preallocate {self.part_path}: {e}")
+
+        self.bytes = sum(end - start for start, end in self.done)
+        self._checkpointed = self.bytes
+        if self.bytes > 0:
+            logger.info(f"resuming download of {self.url} with {self.bytes} of {self.size} bytes")
+        self._unclaimed = self.missing()
+        return self._unclaimed
+
+    def missing(self):
+        "Returns the [start, end) ranges that we do not have yet."
+
+        rv = []
+        pos = 0
+        for start, end in self.done:
+            if start > pos:
+                rv.append([pos, start])
+            pos = end
+        if pos < self.size:
+            rv.append([pos, self.size])
+        return rv
+
+    def claim(self, size, min_size):
+        """
+        Hand out a Segment of about size bytes to fetch.  Pieces that are
+        being worked on are only split if both halves would be at least
+        min_size.  Returns None when there is nothing left to do.
+        """
+
+        if self._unclaimed:
+            start, end = self._unclaimed[0]
+            if end - start <= size + min_size:
+                self._unclaimed.pop(0)
+            else:
+                end = start + size
+                self._unclaimed[0][0] = end
+            seg = Segment(start, end)
+        else:
+            victim = max(self._active, key=Segment.remaining, default=None)
+            if victim is None or victim.remaining() < 2 * min_size:
+                return None
+            mid = victim.pos + victim.remaining() // 2
+            seg = Segment(mid, victim.end)
+            victim.end = mid
+
+        self._active.append(seg)
+        return seg
+
+    def release(self, seg):
+        "Give back a Segment; whatever is left of it can be claimed again."
+
+        self._active.remove(seg)
+        if seg.pos < seg.end:
+            bisect.insort(self._unclaimed, [seg.pos, seg.end])
+
+    def write_at(self, offset, chunk):
+        "Write a chunk at offset; returns True if it is time to checkpoint()."
+
+        os.pwrite(self._fd, chunk, offset)
+        self.bytes += len(chunk)
+        bisect.insort(self.done, [offset, offset + len(chunk)])
+
+        # Merge the new range with its neighbours.
+        merged = []
+        for start, end in self.done:
+            if merged and start <= merged[-1][1]:
+                merged[-1][1] = max(merged[-1][1], end)
+            else:
+                merged.append([start, end])
+        self.done = merged
+        return self.bytes - self._checkpointed >= CHECKPOINT_BYTES
+
+    def complete(self):
+        return self.done == [[0, self.size]]
+
+    def checkpoint(self, done=None):
+        """
+        Make everything written so far durable, and record that it is.  If
+        this is running in a worker thread while other writes are still
+        going on, done should be a copy of self.done from before it
+        started.
+        """
+
+        done = done if done is not None else self.done
+        os.fsync(self._fd)
+        with open(f"{self.checkpoint_path}.new", "w") as f:
+            json.dump({
+                "url": self.url,
+                "md5": self.md5,
+                "size": self.size,
+                "validator": self.validator,
+                "done": done,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(f"{self.checkpoint_path}.new", self.checkpoint_path)
+        self._checkpointed = sum(end - start for start, end in done)
+
+    def finish(self, disk_md5):
+        """
+        Given the md5 of dest.part, move it into place if it is right.  If
+        it is wrong, the partial download is no good to anyone, so it gets
+        thrown away, and ValueError is raised.
+        """
+
+        logger.debug(f"{self.dest} has md5 {disk_md5}, want md5 {self.md5}")
+        if disk_md5 != self.md5:
+            self.discard()
+            raise ValueError("downloaded file had incorrect md5")
+
+        os.fsync(self._fd)
+        self.close()
+        os.replace(self.part_path, self.dest)
+        try:
+            os.unlink(self.checkpoint_path)
+        except FileNotFoundError:
+            pass
+
+    def close(self):
+        "Stop writing, but leave the partial download around to resume later."
+
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def discard(self):
+        "Throw away the partial download; there is nothing left to checkpoint."
+
+        self.close()
+        self.discarded = True
+        for path in [self.part_path, self.checkpoint_path]:
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
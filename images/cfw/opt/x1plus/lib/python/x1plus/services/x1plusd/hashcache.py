@@ -0,0 +1,151 @@
+import os
+import json
+import hashlib
+import threading
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# We only need to remember the handful of firmware files that we are
+# currently interested in.
+MAX_ENTRIES = 32
+
+
+def _mount_fstype(path):
+    "Returns the type of the filesystem that path lives on, or None."
+
+    path = os.path.realpath(path)
+    best, fstype = "", None
+    try:
+        with open("/proc/mounts", "r") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mnt = fields[1].replace("\\040", " ")
+                if (path == mnt or path.startswith(mnt.rstrip("/") + "/")) and len(mnt) > len(best):
+                    best, fstype = mnt, fields[2]
+    except OSError:
+        pass
+    return fstype
+
+
+class HashCache:
+    """
+    A persistent cache of file hashes, so that multi-hundred-megabyte
+    firmware files that have already been checked do not get read all over
+    again on every check (or every boot).
+
+    An entry is trusted only if the file's path, size, mtime, and inode
+    all still match what they were when it was hashed.  The exception is
+    the inode on FAT filesystems (like the SD card): vfat makes up inode
+    numbers each time it is mounted, so there they would never match
+    after a reboot, and we go by path, size, and mtime alone.
+
+    hash_file() does the actual reading, and is meant to be run in a
+    worker thread; everything here is thread-safe.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self._fstypes = {}
+        try:
+            with open(filename, "r") as f:
+                self._entries = json.load(f)
+            if not isinstance(self._entries, dict):
+                raise ValueError("hash cache is not a dict")
+        except FileNotFoundError:
+            self._entries = {}
+        except Exception as e:
+            logger.warning(f"ignoring unreadable hash cache {filename}: {e}")
+            self._entries = {}
+
+    def _key_for(self, path, st):
+        directory = os.path.dirname(os.path.realpath(path))
+        if directory not in self._fstypes:
+            self._fstypes[directory] = _mount_fstype(directory)
+        ino = None if self._fstypes[directory] in ("vfat", "msdos", "exfat") else st.st_ino
+        return {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "ino": ino}
+
+    def _save(self):
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(f"{self.filename}.new", "w") as f:
+                json.dump(self._entries, f)
+            os.replace(f"{self.filename}.new", self.filename)
+        except Exception as e:
+            logger.warning(f"failed to save hash cache {self.filename}: {e}")
+
+    def lookup(self, path, algorithm="md5"):
+        "Returns the cached hash of path, or None if we do not have a valid one."
+
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            entry = self._entries.get(os.path.realpath(path))
+            if entry is None or entry["key"] != self._key_for(path, st):
+                return None
+            return entry["hashes"].get(algorithm)
+
+    def store(self, path, digest, algorithm="md5", st=None):
+        """
+        Remember that path hashes to digest.  If st is given, it is the
+        stat of the file from before it was read, and the hash is only
+        stored if the file has not changed since.
+        """
+
+        now = os.stat(path)
+        with self._lock:
+            key = self._key_for(path, now)
+            if st is not None and self._key_for(path, st) != key:
+                logger.debug(f"{path} changed while it was being hashed; not caching")
+                return
+            realpath = os.path.realpath(path)
+            entry = self._entries.pop(realpath, None)
+            if entry is None or entry["key"] != key:
+                entry = {"key": key, "hashes": {}}
+            entry["hashes"][algorithm] = digest
+            self._entries[realpath] = entry
+            while len(self._entries) > MAX_ENTRIES:
+                del self._entries[next(iter(self._entries))]
+            self._save()
+
+    def invalidate(self, path):
+        with self._lock:
+            if self._entries.pop(os.path.realpath(path), None) is not None:
+                self._save()
+
+    def hash_file(self, path, algorithm="md5", progress=None, cache=True):
+        """
+        Returns the hash of path, reading it only if there is no valid
+        cached hash.  If progress is given, it is called with (bytes read,
+        total bytes) as the file is read.  If cache is False, the file is
+        always read, and the result is not remembered (for files that are
+        about to be renamed anyway).  Raises FileNotFoundError if there is
+        no such file.
+        """
+
+        cached = self.lookup(path, algorithm) if cache else None
+        if cached is not None:
+            logger.debug(f"{path} has cached {algorithm} {cached}")
+            return cached
+
+        accum = hashlib.new(algorithm)
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            done = 0
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+                accum.update(chunk)
+                done += len(chunk)
+                if progress is not None:
+                    progress(done, st.st_size)
+        digest = accum.hexdigest()
+        if cache:
+            self.store(path, digest, algorithm, st=st)
+        return digest
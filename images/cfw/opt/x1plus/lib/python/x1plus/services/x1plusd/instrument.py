@@ -0,0 +1,208 @@
+"""
+Instrumentation for x1plusd's event loop.
+
+Everything in x1plusd shares one event loop, so any synchronous work -- an
+fsync in the settings journal, an md5 pass, a big json.dumps -- holds up
+every DBus call and every other task for as long as it runs.  This keeps
+track of how bad that gets:
+
+  * LoopMonitor wakes up every LAG_INTERVAL and measures how late it was
+    in doing so (the loop lag), and keeps the last LAG_SAMPLES of those
+    for percentiles.  A watchdog thread keeps an eye on it, too: if the
+    loop goes SLOW_CALLBACK_THRESHOLD without getting around to the
+    monitor, whatever the loop is in the middle of is taking too long,
+    and the watchdog grabs the loop thread's stack while it is still
+    there to be grabbed, and logs it.
+
+  * method_latency collects a histogram, per DBus method, of how long
+    calls take from the moment that X1PlusDBusService picks them up to
+    the moment that the reply is on its way (so including time spent
+    waiting on locks, and serializing the result).
+
+All of this is available over DBus from x1plus.stats (see stats.py).
+"""
+
+import sys
+import time
+import threading
+import traceback
+import asyncio
+import bisect
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+LAG_INTERVAL = 0.25
+LAG_SAMPLES = 1200
+
+SLOW_CALLBACK_THRESHOLD = 0.25
+SLOW_CALLBACK_HISTORY = 20
+
+# Upper bounds of the latency histogram buckets, in milliseconds; anything
+# slower than the last one goes in an overflow bucket.
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+
+def _percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+class Histogram:
+    "Counts of durations, in LATENCY_BUCKETS_MS-sized buckets."
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def add(self, ms):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        self.count += 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, p):
+        """
+        The upper bound of the bucket that the pth percentile falls in (or
+        the slowest call so far, if that is less).
+        """
+
+        if self.count == 0:
+            return None
+        want = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= want and n > 0:
+                return min(LATENCY_BUCKETS_MS[i], self.max_ms) if i < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+    def as_dict(self):
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total_ms / self.count, 2) if self.count else None,
+            "max_ms": round(self.max_ms, 2),
+            "p50_ms": self.percentile(50),
+            "p90_ms": self.percentile(90),
+            "p99_ms": self.percentile(99),
+            "buckets_ms": LATENCY_BUCKETS_MS,
+            "counts": self.counts,
+        }
+
+
+class MethodLatency:
+    "A Histogram, and a count of errors and timeouts, per DBus method."
+
+    def __init__(self):
+        self.methods = {}
+
+    def record(self, interface, method, seconds, result="ok"):
+        key = f"{interface}.{method}"
+        stats = self.methods.get(key)
+        if stats is None:
+            stats = self.methods[key] = {"histogram": Histogram(), "errors": 0, "timeouts": 0}
+        stats["histogram"].add(seconds * 1000)
+        if result == "error":
+            stats["errors"] += 1
+        elif result == "timeout":
+            stats["timeouts"] += 1
+
+    def as_dict(self):
+        return {
+            key: {**stats["histogram"].as_dict(), "errors": stats["errors"], "timeouts": stats["timeouts"]}
+            for key, stats in sorted(self.methods.items())
+        }
+
+
+method_latency = MethodLatency()
+
+
+class LoopMonitor:
+    def __init__(self, interval=LAG_INTERVAL, threshold=SLOW_CALLBACK_THRESHOLD):
+        self.interval = interval
+        self.threshold = threshold
+        self.lags = []
+        self._lag_pos = 0
+        self.max_lag = 0.0
+        self.slow_callbacks = []
+        self.slow_callback_count = 0
+        self._beat = None
+        self._loop_thread = None
+        self._stalled = None
+        self._lock = threading.Lock()
+        self._watchdog_thread = None
+
+    async def task(self):
+        self._loop_thread = threading.get_ident()
+        self._beat = time.monotonic()
+        if self._watchdog_thread is None:
+            self._watchdog_thread = threading.Thread(target=self._watchdog, name="loopmonitor", daemon=True)
+            self._watchdog_thread.start()
+
+        while True:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self._add_lag(max(0.0, now - expected))
+            with self._lock:
+                self._beat = now
+                stalled, self._stalled = self._stalled, None
+            if stalled is not None:
+                # Now that the loop is back, we know how late it got (which
+                # is a lower bound on how long it was stuck, since it might
+                # have got stuck partway through our sleep).
+                stalled["duration_ms"] = round((now - stalled["_since"]) * 1000, 1)
+                logger.warning(
+                    f"event loop was held up for at least {stalled['duration_ms']:.0f} ms; it was busy in:\n{stalled['stack']}"
+                )
+
+    def _add_lag(self, lag):
+        if len(self.lags) < LAG_SAMPLES:
+            self.lags.append(lag)
+        else:
+            self.lags[self._lag_pos] = lag
+            self._lag_pos = (self._lag_pos + 1) % LAG_SAMPLES
+        self.max_lag = max(self.max_lag, lag)
+
+    def _watchdog(self):
+        while True:
+            time.sleep(self.threshold / 2)
+            with self._lock:
+                since = self._beat + self.interval
+                if self._stalled is not None or time.monotonic() - since < self.threshold:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread)
+                if frame is None:
+                    continue
+                self._stalled = {
+                    "time": time.time(),
+                    "duration_ms": None,
+                    "stack": "".join(traceback.format_stack(frame)),
+                    "_since": since,
+                }
+                self.slow_callback_count += 1
+                self.slow_callbacks = (self.slow_callbacks + [self._stalled])[-SLOW_CALLBACK_HISTORY:]
+
+    def as_dict(self):
+        ordered = sorted(self.lags)
+        ms = lambda v: None if v is None else round(v * 1000, 2)
+        return {
+            "interval_ms": ms(self.interval),
+            "samples": len(ordered),
+            "lag_ms": {
+                "p50": ms(_percentile(ordered, 50)),
+                "p90": ms(_percentile(ordered, 90)),
+                "p99": ms(_percentile(ordered, 99)),
+                "max_recent": ms(ordered[-1] if ordered else None),
+                "max": ms(self.max_lag),
+            },
+            "slow_callback_threshold_ms": ms(self.threshold),
+            "slow_callback_count": self.slow_callback_count,
+            "slow_callbacks": [
+                {k: v for k, v in cb.items() if not k.startswith("_")} for cb in self.slow_callbacks
+            ],
+        }
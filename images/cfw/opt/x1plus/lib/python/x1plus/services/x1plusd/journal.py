@@ -0,0 +1,169 @@
+import os
+import json
+import zlib
+
+import logging
+from .jsonpatch import apply_patch
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_MAGIC = "X1PJ1"
+
+
+def _checksum(data):
+    return f"{zlib.crc32(data):08x}"
+
+
+class SettingsJournal:
+    """
+    Append-only journal of settings changes, layered on top of a snapshot.
+
+    The journal is a text file.  The first line is a header that names the
+    checksum of the snapshot that the journal applies to:
+
+      X1PJ1 <crc32 of snapshot>
+
+    and every line after that is one committed batch of changes:
+
+      <crc32 of json> {"key": value, "deleted.key": null, ...}
+
+    or, for a PatchSettings, the JSON Patch that was applied to one key:
+
+      <crc32 of json> {"_patch": {"key": [ ... ]}}
+
+    A record is only trusted if its checksum matches and it ends in a
+    newline, so a write that got torn by a power cut just looks like the
+    end of the journal.  If the snapshot has been rewritten by someone else
+    since the journal was started (say, a boot script fiddling with
+    settings.json using jq), the header will not match, and the journal is
+    set aside rather than being replayed on top of something it was not
+    written against.
+
+    None of this is async; SettingsService runs the writes in a worker
+    thread.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.records = 0
+        self.size = 0
+        self._fh = None
+        self._valid = False
+
+    def replay(self, snapshot_data, settings, mismatch_reason="was it edited by hand?"):
+        """
+        Apply whatever the journal has on top of settings (which should have
+        been loaded from snapshot_data), in place.  Returns the number of
+        records that were applied.  mismatch_reason is what gets logged as
+        the likely cause if the journal is for some other snapshot.
+        """
+
+        self.records = 0
+        self.size = 0
+        self._valid = False
+
+        try:
+            with open(self.filename, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return 0
+
+        header = f"{JOURNAL_MAGIC} {_checksum(snapshot_data)}\n".encode()
+        if not data.startswith(header):
+            stale = f"{self.filename}.stale"
+            logger.warning(f"settings journal does not match the settings snapshot ({mismatch_reason}); moving it to {stale}")
+            try:
+                os.replace(self.filename, stale)
+            except Exception as e:
+                logger.error(f"failed to move stale journal out of the way ({e})")
+            return 0
+
+        ofs = len(header)
+        while ofs < len(data):
+            end = data.find(b"\n", ofs)
+            if end == -1:
+                logger.warning(f"settings journal has a torn record at offset {ofs}; discarding it")
+                break
+            crc, _, payload = data[ofs:end].partition(b" ")
+            try:
+                if crc.decode() != _checksum(payload):
+                    raise ValueError("bad checksum")
+                changes = json.loads(payload)
+                if not isinstance(changes, dict):
+                    raise ValueError("record is not a dict")
+            except Exception as e:
+                logger.warning(f"settings journal has a bad record at offset {ofs} ({e}); discarding it and everything after")
+                break
+
+            try:
+                for k, ops in changes.pop("_patch", {}).items():
+                    settings[k], _ = apply_patch(settings.get(k), ops)
+                    if settings[k] is None:
+                        del settings[k]
+            except Exception as e:
+                logger.warning(f"settings journal has a patch at offset {ofs} that does not apply ({e}); discarding it and everything after")
+                break
+
+            for k, v in changes.items():
+                if v is None:
+                    settings.pop(k, None)
+                else:
+                    settings[k] = v
+
+            self.records += 1
+            ofs = end + 1
+
+        self.size = ofs
+        self._valid = True
+        return self.records
+
+    def open(self, snapshot_data):
+        """
+        Get ready to append.  If replay() found a journal that we can
+        continue, we chop off anything torn at the end and keep going;
+        otherwise we start a fresh one against snapshot_data.
+        """
+
+        if not self._valid:
+            self.reset(snapshot_data)
+            return
+
+        with open(self.filename, "r+b") as f:
+            f.truncate(self.size)
+            f.flush()
+            os.fsync(f.fileno())
+        self._fh = open(self.filename, "ab")
+
+    def reset(self, snapshot_data):
+        "Start a new, empty journal that applies to snapshot_data."
+
+        self.close()
+
+        header = f"{JOURNAL_MAGIC} {_checksum(snapshot_data)}\n".encode()
+        with open(self.filename + ".new", "wb") as f:
+            f.write(header)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.filename + ".new", self.filename)
+
+        self.records = 0
+        self.size = len(header)
+        self._valid = True
+        self._fh = open(self.filename, "ab")
+
+    def append(self, records):
+        "Durably append a batch of records, in order, with one fsync."
+
+        for changes in records:
+            payload = json.dumps(changes, separators=(",", ":")).encode()
+            line = _checksum(payload).encode() + b" " + payload + b"\n"
+            self._fh.write(line)
+            self.records += 1
+            self.size += len(line)
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+
+    def close(self):
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
@@ -0,0 +1,138 @@
+"""
+A small implementation of RFC 6902 JSON Patch (and the RFC 6901 JSON
+Pointers that it uses), for applying partial updates to settings values.
+"""
+
+import copy
+
+
+class JSONPatchError(ValueError):
+    pass
+
+
+def parse_pointer(pointer):
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise JSONPatchError(f"JSON pointer {pointer!r} does not start with /")
+    return [p.replace("~1", "/").replace("~0", "~") for p in pointer[1:].split("/")]
+
+
+def _index(container, token, pointer, allow_end=False):
+    if token == "-" and allow_end:
+        return len(container)
+    if not (token.isascii() and token.isdigit()) or (token != "0" and token.startswith("0")):
+        raise JSONPatchError(f"{pointer!r}: {token!r} is not an array index")
+    idx = int(token)
+    if idx > len(container) or (idx == len(container) and not allow_end):
+        raise JSONPatchError(f"{pointer!r}: index {idx} out of range")
+    return idx
+
+
+def _resolve(doc, tokens, pointer):
+    "Returns the container that the last token of pointer refers into."
+
+    for token in tokens[:-1]:
+        if isinstance(doc, dict):
+            if token not in doc:
+                raise JSONPatchError(f"{pointer!r}: {token!r} does not exist")
+            doc = doc[token]
+        elif isinstance(doc, list):
+            doc = doc[_index(doc, token, pointer)]
+        else:
+            raise JSONPatchError(f"{pointer!r}: cannot index into {type(doc).__name__}")
+    return doc
+
+
+def _get(doc, pointer):
+    tokens = parse_pointer(pointer)
+    if not tokens:
+        return doc
+    container = _resolve(doc, tokens, pointer)
+    if isinstance(container, dict):
+        if tokens[-1] not in container:
+            raise JSONPatchError(f"{pointer!r} does not exist")
+        return container[tokens[-1]]
+    if isinstance(container, list):
+        return container[_index(container, tokens[-1], pointer)]
+    raise JSONPatchError(f"{pointer!r}: cannot index into {type(container).__name__}")
+
+
+def _add(doc, pointer, value):
+    tokens = parse_pointer(pointer)
+    if not tokens:
+        return value
+    container = _resolve(doc, tokens, pointer)
+    if isinstance(container, dict):
+        container[tokens[-1]] = value
+    elif isinstance(container, list):
+        container.insert(_index(container, tokens[-1], pointer, allow_end=True), value)
+    else:
+        raise JSONPatchError(f"{pointer!r}: cannot add to {type(container).__name__}")
+    return doc
+
+
+def _remove(doc, pointer):
+    tokens = parse_pointer(pointer)
+    if not tokens:
+        return None
+    container = _resolve(doc, tokens, pointer)
+    if isinstance(container, dict):
+        if tokens[-1] not in container:
+            raise JSONPatchError(f"{pointer!r} does not exist")
+        del container[tokens[-1]]
+    elif isinstance(container, list):
+        del container[_index(container, tokens[-1], pointer)]
+    else:
+        raise JSONPatchError(f"{pointer!r}: cannot remove from {type(container).__name__}")
+    return doc
+
+
+def apply_patch(doc, ops):
+    """
+    Applies the list of RFC 6902 operations in ops to doc, and returns the
+    patched document along with the list of paths that were modified.  doc
+    itself is left alone; if any operation fails, JSONPatchError is raised
+    and nothing has changed.  A document that does not exist is None, and
+    removing the whole document ("path": "") turns it back into None.
+    """
+
+    if not isinstance(ops, list):
+        raise JSONPatchError("patch must be a list of operations")
+
+    doc = copy.deepcopy(doc)
+    paths = []
+    for op in ops:
+        if not isinstance(op, dict) or not isinstance(op.get("path"), str):
+            raise JSONPatchError(f"malformed operation {op!r}")
+        kind = op.get("op")
+        path = op["path"]
+        if kind in ("add", "replace", "test") and "value" not in op:
+            raise JSONPatchError(f"{kind} operation on {path!r} has no value")
+        if kind in ("move", "copy") and not isinstance(op.get("from"), str):
+            raise JSONPatchError(f"{kind} operation on {path!r} has no from")
+
+        if kind == "add":
+            doc = _add(doc, path, copy.deepcopy(op["value"]))
+        elif kind == "remove":
+            doc = _remove(doc, path)
+        elif kind == "replace":
+            _get(doc, path)
+            doc = _add(_remove(doc, path), path, copy.deepcopy(op["value"]))
+        elif kind == "move":
+            if path.startswith(op["from"] + "/"):
+                raise JSONPatchError(f"cannot move {op['from']!r} into its own child {path!r}")
+            value = _get(doc, op["from"])
+            doc = _add(_remove(doc, op["from"]), path, value)
+            paths.append(op["from"])
+        elif kind == "copy":
+            doc = _add(doc, path, copy.deepcopy(_get(doc, op["from"])))
+        elif kind == "test":
+            if _get(doc, path) != op["value"]:
+                raise JSONPatchError(f"test failed at {path!r}")
+            continue
+        else:
+            raise JSONPatchError(f"unknown operation {kind!r}")
+        paths.append(path)
+
+    return doc, paths
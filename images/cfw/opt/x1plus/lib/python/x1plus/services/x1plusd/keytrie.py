@@ -0,0 +1,89 @@
+import fnmatch
+
+GLOB_CHARS = "*?["
+
+
+class _Node:
+    __slots__ = ("children", "globs", "values", "tail_values")
+
+    def __init__(self):
+        self.children = {}
+        self.globs = {}
+        self.values = []
+        self.tail_values = []
+
+
+class KeyTrie:
+    """
+    An index from dotted settings-key patterns to values (usually callbacks
+    or subscribers), organized by key segment so that looking up a key only
+    touches the parts of the index that could possibly match it.
+
+    A pattern is a dotted key, where each segment can be:
+
+      - a literal ("ota", "json_url"), matched exactly;
+      - a glob ("*_log", "image?"), matched with fnmatch against exactly one
+        segment;
+      - "*" as the last segment, which matches one or more of any remaining
+        segments.  So "ota.*" matches "ota.enabled" and "ota.foo.bar", and
+        "*" on its own matches everything.
+    """
+
+    def __init__(self):
+        self._root = _Node()
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def _walk(self, pattern, create):
+        segs = pattern.split(".")
+        tail = segs[-1] == "*"
+        if tail:
+            segs = segs[:-1]
+
+        node = self._root
+        for seg in segs:
+            table = node.globs if any(c in seg for c in GLOB_CHARS) else node.children
+            if seg not in table:
+                if not create:
+                    return None, tail
+                table[seg] = _Node()
+            node = table[seg]
+        return node, tail
+
+    def add(self, pattern, value):
+        node, tail = self._walk(pattern, create=True)
+        (node.tail_values if tail else node.values).append(value)
+        self._count += 1
+
+    def remove(self, pattern, value):
+        "Removes one registration of value under pattern, if there is one."
+
+        node, tail = self._walk(pattern, create=False)
+        if node is None:
+            return
+        values = node.tail_values if tail else node.values
+        if value in values:
+            values.remove(value)
+            self._count -= 1
+
+    def match(self, key):
+        "Returns every value whose pattern matches key, in no particular order."
+
+        segs = key.split(".")
+        rv = []
+        stack = [(self._root, 0)]
+        while stack:
+            node, i = stack.pop()
+            if i == len(segs):
+                rv.extend(node.values)
+                continue
+            rv.extend(node.tail_values)
+            child = node.children.get(segs[i])
+            if child is not None:
+                stack.append((child, i + 1))
+            for glob, child in node.globs.items():
+                if fnmatch.fnmatchcase(segs[i], glob):
+                    stack.append((child, i + 1))
+        return rv
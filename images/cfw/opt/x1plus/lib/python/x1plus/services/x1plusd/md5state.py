@@ -0,0 +1,89 @@
+"""
+An MD5 whose internal state can be saved and restored, so that a
+resumed download can pick up hashing where it left off, rather than
+reading everything it already has back off the SD card.
+
+hashlib does not let you get at the state of a hash, so we go to
+OpenSSL's (deprecated, but still exported) MD5_* functions through ctypes;
+an MD5_CTX is a plain struct, so a copy of its bytes is a checkpoint.  If
+libcrypto cannot be found, CheckpointableMD5 falls back to hashlib, and
+state() returns None, in which case the caller has to rehash instead.
+"""
+
+import ctypes
+import ctypes.util
+import hashlib
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# unsigned int A, B, C, D, Nl, Nh; unsigned int data[16]; unsigned int num;
+MD5_CTX_SIZE = 4 * (6 + 16 + 1)
+
+_libcrypto = None
+_libcrypto_tried = False
+
+
+def _load_libcrypto():
+    global _libcrypto, _libcrypto_tried
+    if _libcrypto_tried:
+        return _libcrypto
+    _libcrypto_tried = True
+
+    for name in [ctypes.util.find_library("crypto"), "libcrypto.so.3", "libcrypto.so.1.1", "libcrypto.so"]:
+        if name is None:
+            continue
+        try:
+            lib = ctypes.CDLL(name)
+            lib.MD5_Init.argtypes = [ctypes.c_void_p]
+            lib.MD5_Update.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_size_t]
+            lib.MD5_Final.argtypes = [ctypes.c_char_p, ctypes.c_void_p]
+        except (OSError, AttributeError):
+            continue
+        _libcrypto = lib
+        break
+    else:
+        logger.warning("libcrypto MD5 is not available; resumed downloads will have to rehash what they have")
+    return _libcrypto
+
+
+class CheckpointableMD5:
+    def __init__(self, state=None):
+        self._lib = _load_libcrypto()
+        if self._lib is None:
+            if state is not None:
+                raise ValueError("cannot restore MD5 state without libcrypto")
+            self._hash = hashlib.md5()
+            return
+
+        self._ctx = ctypes.create_string_buffer(MD5_CTX_SIZE)
+        if state is None:
+            self._lib.MD5_Init(self._ctx)
+        else:
+            if len(state) != MD5_CTX_SIZE:
+                raise ValueError(f"MD5 state should be {MD5_CTX_SIZE} bytes, not {len(state)}")
+            ctypes.memmove(self._ctx, state, MD5_CTX_SIZE)
+
+    def update(self, data):
+        if self._lib is None:
+            self._hash.update(data)
+        else:
+            self._lib.MD5_Update(self._ctx, bytes(data), len(data))
+
+    def hexdigest(self):
+        if self._lib is None:
+            return self._hash.hexdigest()
+
+        # MD5_Final wrecks the context, so finalize a copy.
+        ctx = ctypes.create_string_buffer(self._ctx.raw, MD5_CTX_SIZE)
+        md = ctypes.create_string_buffer(16)
+        self._lib.MD5_Final(md, ctx)
+        return md.raw.hex()
+
+    def state(self):
+        "Returns the state of the hash as bytes, or None if that is not possible."
+
+        if self._lib is None:
+            return None
+        return self._ctx.raw
@@ -1,13 +1,24 @@
 import os
 import json
 import ssl
-import aiohttp
+import time
 import datetime
 import asyncio
-import hashlib
+import importlib
+import threading
+import functools
+import contextlib
 
 import x1plus.utils
 from .dbus import *
+from .startup import trace
+from .hashcache import HashCache
+from .download import PartialDownload, SegmentedDownload, remove_stale_partials
+from . import delta
+from . import prestage
+from . import process
+from .ratelimit import TokenBucket, Paused
+from .telemetry import DownloadTelemetry, DownloadHistory, Stalled, TICK_INTERVAL, STALL_TIMEOUT
 
 logger = logging.getLogger(__name__)
 
@@ -18,8 +29,101 @@ UPDATE_CHECK_SUCCESSFUL_INTERVAL = datetime.timedelta(hours = 24)
 UPDATE_CHECK_FAILED_INTERVAL = datetime.timedelta(hours = 4)
 DEFAULT_OTA_URL = "https://ota.x1plus.net/stable/ota.json"
 
-# Setup SSL for aiohttp
-ssl_ctx = ssl.create_default_context(capath="/etc/ssl/certs")
+DOWNLOAD_CHUNK_SIZE = 131072
+
+# The OTA engine keeps one aiohttp session around for everything it
+# fetches, so that an update check and the downloads that follow it (and
+# the connections of a segmented download) share connections and DNS
+# lookups.
+DNS_CACHE_TTL = 300
+KEEPALIVE_TIMEOUT = 30
+
+# If a download stops making progress, we wait this long before each of our
+# attempts to resume it, and then give up (until someone asks again).
+DOWNLOAD_RETRY_DELAYS = [1, 2, 5, 10, 30]
+
+# With ota.download_connections set to more than 1, downloads are fetched
+# as that many byte ranges at once, for servers that limit how fast each
+# connection can go.  Each connection starts with a segment of
+# SEGMENT_INITIAL_SIZE, and then sizes its segments so that they take
+# about SEGMENT_TARGET_SECONDS at the rate that it has been getting.
+MAX_DOWNLOAD_CONNECTIONS = 8
+SEGMENT_INITIAL_SIZE = 1024 * 1024
+SEGMENT_MIN_SIZE = 256 * 1024
+SEGMENT_MAX_SIZE = 16 * 1024 * 1024
+SEGMENT_TARGET_SECONDS = 4
+
+# aiohttp (and the SSL context that goes with it) take a good while to load
+# on the printer, and nothing needs them until the first update check, so
+# they get loaded by _load_aiohttp() when the OTA engine first needs them
+# rather than at import time.
+aiohttp = None
+ssl_ctx = None
+_aiohttp_lock = asyncio.Lock()
+
+
+def _import_aiohttp():
+    global aiohttp, ssl_ctx
+    ssl_ctx = ssl.create_default_context(capath="/etc/ssl/certs")
+    aiohttp = importlib.import_module("aiohttp")
+
+
+async def _load_aiohttp():
+    "Import aiohttp in a worker thread, so that the event loop keeps going."
+
+    async with _aiohttp_lock:
+        if aiohttp is None:
+            with trace.phase("ota: import aiohttp"):
+                await asyncio.to_thread(_import_aiohttp)
+
+
+def _download_timeout():
+    # No total timeout, since a slow connection is fine as long as it keeps
+    # moving; a connection that stalls gets dropped, and resumed.
+    return aiohttp.ClientTimeout(connect=5, sock_read=10)
+
+
+@contextlib.asynccontextmanager
+async def _download_request(session, url, headers):
+    """
+    session.get() for downloads, which we often walk away from partway
+    through (when we pause, or another connection takes over the rest of
+    a segment).  If the rest of the body has already arrived by then,
+    aiohttp (as of 3.9) has already put the connection back in the pool,
+    with reading still paused if enough of it was sitting in the buffer,
+    and the next request on it hangs until it times out.  Throwing the
+    buffered data away resumes reading; a response that is still coming
+    in just gets its connection closed.
+    """
+
+    async with session.get(url, headers=headers, timeout=_download_timeout()) as response:
+        try:
+            yield response
+        finally:
+            if response.content.is_eof():
+                while not response.content.at_eof():
+                    response.content.read_nowait()
+            else:
+                response.close()
+
+
+async def _read_chunks(response):
+    """
+    response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE), except that a
+    connection that goes quiet for STALL_TIMEOUT raises Stalled, so that
+    we can get going again on a new one without waiting for aiohttp's
+    sock_read timeout.
+    """
+
+    while True:
+        try:
+            async with asyncio.timeout(STALL_TIMEOUT):
+                chunk = await response.content.read(DOWNLOAD_CHUNK_SIZE)
+        except TimeoutError:
+            raise Stalled(f"no data for {STALL_TIMEOUT:g}s") from None
+        if not chunk:
+            return
+        yield chunk
 
 
 class OTAService(X1PlusDBusService):
@@ -28,9 +132,15 @@ class OTAService(X1PlusDBusService):
     STATUS_CHECKING_OTA = "CHECKING_OTA"
     STATUS_DOWNLOADING_X1P = "DOWNLOADING_X1P"
     STATUS_DOWNLOADING_BASE = "DOWNLOADING_BASE"
+
+    PRESTAGE_VERIFYING = "VERIFYING"
+    PRESTAGE_VERIFIED = "VERIFIED"
+    PRESTAGE_FAILED = "FAILED"
     
-    def __init__(self, settings, **kwargs):
+    def __init__(self, settings, statusboard=None, printstate=None, **kwargs):
         self.x1psettings = settings
+        self.statusboard = statusboard
+        self.printstate = printstate
         self.ota_url = self.x1psettings.get('ota.json_url', DEFAULT_OTA_URL)
         self.ota_available = False
         self.last_check_timestamp = None
@@ -43,12 +153,35 @@ class OTAService(X1PlusDBusService):
         self.ota_downloaded = False
         self.base_update_downloaded = False
         self.ota_task_wake = asyncio.Event()
+        self.watching_settings = False
         self.last_status_object = None
         self.task_status = OTAService.STATUS_DISABLED
         self.sdcard_path = "/tmp/x1plus" if x1plus.utils.is_emulating() else "/sdcard"
         self.download_bytes = 0
         self.download_bytes_total = 0
         self.download_last_error = None
+        self.verify_file = None
+        self.verify_bytes = 0
+        self.verify_bytes_total = 0
+        self.download_telemetry = None
+        self.download_history = DownloadHistory(os.path.join(self.sdcard_path, "x1plus", "ota_downloads.json"))
+        self.download_checkpoint = None
+        self.hashcache = HashCache(os.path.join(self.sdcard_path, "x1plus", "ota_hashes.json"))
+        self.http_session = None
+        self.check_cache_path = os.path.join(self.sdcard_path, "x1plus", "ota_check.json")
+        self.check_cache = None
+        self.manifest_path = os.path.join(self.sdcard_path, "x1plus", "ota_manifest.json")
+        self.staging_path = "/tmp/x1plus.staged" if x1plus.utils.is_emulating() else prestage.STAGING_PATH
+        self.prestage_for = None
+        self.prestage_task = None
+        self.reboot_task = None
+        self.prestage_status = None
+        self.prestage_error = None
+        self.prestage_staged = False
+        self.prestage_bytes = 0
+        self.prestage_bytes_total = 0
+        self.rate_limiter = TokenBucket()
+        self._update_rate_limit()
 
         try:
             # XXX: check is_emulating
@@ -72,8 +205,9 @@ class OTAService(X1PlusDBusService):
         return bool(self.x1psettings.get("ota.enabled", True))
 
     async def task(self):
-        # On startup run an update check to populate info
-        asyncio.create_task(self._ota_task())
+        # The OTA engine itself -- which, on startup, runs an update check
+        # to populate info -- is _ota_task, which gets supervised on its
+        # own, so that if it falls over, we keep answering DBus calls.
         await super().task()
     
     def _make_status_object(self):
@@ -86,12 +220,47 @@ class OTAService(X1PlusDBusService):
             "ota_info": self.last_check_response,
             "ota_is_downloaded": self.ota_downloaded,
             "ota_base_is_downloaded": self.base_update_downloaded,
-            "download": {
-                "bytes": self.download_bytes,
-                "bytes_total": self.download_bytes_total,
-                "last_error": self.download_last_error,
+            "download": self._make_download_object(),
+            "verify": self._make_verify_object(),
+            "prestage": self._make_prestage_object(),
+        }
+
+    def _make_download_object(self):
+        return {
+            "bytes": self.download_bytes,
+            "bytes_total": self.download_bytes_total,
+            "last_error": self.download_last_error,
+            "telemetry": self._make_telemetry_object(),
+            "limit": {
+                "printing": self._printing(),
+                **self.rate_limiter.as_dict(),
             },
         }
+
+    def _make_telemetry_object(self):
+        if self.download_telemetry is None:
+            return None
+        return self.download_telemetry.as_dict(self.download_bytes, self.download_bytes_total, self.rate_limiter.paused)
+
+    def _make_verify_object(self):
+        if self.verify_file is None:
+            return None
+        return {
+            "file": self.verify_file,
+            "bytes": self.verify_bytes,
+            "bytes_total": self.verify_bytes_total,
+        }
+
+    def _make_prestage_object(self):
+        if self.prestage_status is None:
+            return None
+        return {
+            "status": self.prestage_status,
+            "bytes": self.prestage_bytes,
+            "bytes_total": self.prestage_bytes_total,
+            "staged": self.prestage_staged,
+            "error": self.prestage_error,
+        }
     
     async def dbus_CheckNow(self, req):
         self.next_check_timestamp = datetime.datetime.now()
@@ -109,24 +278,79 @@ class OTAService(X1PlusDBusService):
         self.download_base_update = bool(req.get('base_firmware', False))
         return {"status": "ok"}
     
+    @dbus_method(serialize=SERIALIZE_METHOD)
     async def dbus_Update(self, req):
         # you're on your own to make sure you're not printing when you call
         # this method!
         if not self.ota_downloaded:
             return {"status": "failure", "reason": "ota not downloaded, doofus"}
+        # Checking the update over can take minutes, which is a lot longer
+        # than anyone should be left waiting on a DBus call; the caller
+        # can watch prestage.status and try again once it is done.
+        if self.prestage_task is not None and not self.prestage_task.done():
+            return {"status": "failure", "reason": "update is still being verified"}
+        if self.prestage_status == OTAService.PRESTAGE_FAILED:
+            return {"status": "failure", "reason": self.prestage_error}
+        if self.reboot_task is not None and not self.reboot_task.done():
+            return {"status": "rebooting"}
         await self.x1psettings.put('ota.filename', os.path.split(self.last_check_response['ota_url'])[-1])
         if not x1plus.utils.is_emulating():
-            os.system("sync; sync; reboot")
+            # With a few hundred megabytes of update freshly written to the
+            # SD card, sync can take longer than the caller is willing to
+            # wait for a reply, so it happens after we have replied.
+            self.reboot_task = asyncio.create_task(self._reboot())
             return {"status": "rebooting"}
         else:
             return {"status": "ok"}
 
+    async def _reboot(self):
+        """
+        Reboot to install the update that Update asked for.  If we cannot,
+        take back the request in ota.filename, so that the printer does not
+        install the update the next time that it happens to reboot for some
+        other reason.
+        """
+
+        try:
+            await process.run(["sync"], timeout=None)
+            await process.run(["reboot"], check=True)
+        except Exception as e:
+            logger.error(f"failed to reboot to install update ({e.__class__.__name__}: {e}); cancelling the install")
+            await self.x1psettings.put('ota.filename', None)
+
     async def dbus_GetStatus(self, req):
         return self._make_status_object()
 
+    async def dbus_GetDownloadHistory(self, req):
+        return {"downloads": self.download_history.records}
+
+    def _publish_statusboard(self):
+        """
+        Put the frequently changing parts of the status object on the
+        status board.  This is cheap (no syscalls, no DBus traffic), so it
+        happens for every chunk of a download.
+        """
+
+        if self.statusboard is None:
+            return
+        try:
+            self.statusboard.publish("ota", {
+                "status": self.task_status,
+                "enabled": self.ota_enabled(),
+                "ota_available": self.ota_available,
+                "ota_is_downloaded": self.ota_downloaded,
+                "ota_base_is_downloaded": self.base_update_downloaded,
+                "download": self._make_download_object(),
+                "verify": self._make_verify_object(),
+                "prestage": self._make_prestage_object(),
+            })
+        except Exception as e:
+            logger.error(f"failed to publish ota status to status board: {e}")
+
     async def _maybe_publish_status_object(self):
         "Publish a new _make_status_object as a DBus signal iff something has changed."
         
+        self._publish_statusboard()
         status_object = self._make_status_object()
         if status_object != self.last_status_object:
             # equality on a dict is object-equality, not reference-equality
@@ -134,6 +358,60 @@ class OTAService(X1PlusDBusService):
             await self.emit_signal("StatusChanged", status_object)
             logger.debug(f"ota status changed to {status_object}")
 
+    async def _get_session(self):
+        "Returns the OTA engine's aiohttp session, creating it if need be."
+
+        await _load_aiohttp()
+        if self.http_session is None or self.http_session.closed:
+            connector = aiohttp.TCPConnector(
+                ssl=ssl_ctx,
+                ttl_dns_cache=DNS_CACHE_TTL,
+                keepalive_timeout=KEEPALIVE_TIMEOUT,
+                limit_per_host=MAX_DOWNLOAD_CONNECTIONS,
+            )
+            self.http_session = aiohttp.ClientSession(connector=connector)
+        return self.http_session
+
+    def _load_check_cache(self):
+        """
+        Returns what we remember about the last time we fetched ota.json
+        from the current URL -- its ETag, Last-Modified, and contents --
+        or None if we have nothing useful.
+        """
+
+        if self.check_cache is None:
+            try:
+                with open(self.check_cache_path, "r") as f:
+                    self.check_cache = json.load(f)
+                if not isinstance(self.check_cache.get("response"), dict):
+                    raise ValueError("cached OTA response is not a dict")
+            except FileNotFoundError:
+                self.check_cache = {}
+            except Exception as e:
+                logger.warning(f"ignoring unreadable OTA check cache {self.check_cache_path}: {e}")
+                self.check_cache = {}
+
+        if self.check_cache.get("url") != self.ota_url:
+            return None
+        if self.check_cache.get("etag") is None and self.check_cache.get("last_modified") is None:
+            return None
+        return self.check_cache
+
+    def _save_check_cache(self, headers, response):
+        self.check_cache = {
+            "url": self.ota_url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "response": response,
+        }
+        try:
+            os.makedirs(os.path.dirname(self.check_cache_path), exist_ok=True)
+            with open(f"{self.check_cache_path}.new", "w") as f:
+                json.dump(self.check_cache, f)
+            os.replace(f"{self.check_cache_path}.new", self.check_cache_path)
+        except Exception as e:
+            logger.warning(f"failed to save OTA check cache {self.check_cache_path}: {e}")
+
     async def _check_for_ota(self):
         self.task_status = OTAService.STATUS_CHECKING_OTA
         await self._maybe_publish_status_object()
@@ -141,13 +419,31 @@ class OTAService(X1PlusDBusService):
         try:
             # Update check timestamp first
             self.last_check_timestamp = datetime.datetime.now().timestamp()
-            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_ctx)) as session:
-                async with session.get(self.ota_url, timeout=5) as response:
+            session = await self._get_session()
+
+            # If we have a copy of ota.json from before (even from before a
+            # reboot), we only need the server to tell us that it has not
+            # changed.
+            cached = self._load_check_cache()
+            headers = {}
+            if cached is not None:
+                if cached.get("etag") is not None:
+                    headers["If-None-Match"] = cached["etag"]
+                if cached.get("last_modified") is not None:
+                    headers["If-Modified-Since"] = cached["last_modified"]
+
+            async with session.get(self.ota_url, headers=headers, timeout=aiohttp.ClientTimeout(total=5)) as response:
+                if response.status == 304 and cached is not None:
+                    logger.debug("ota.json has not changed since we last fetched it")
+                    not_modified = True
+                else:
                     response.raise_for_status()
-                    self.last_check_response = await response.json()
-                    if not isinstance(self.last_check_response, dict):
+                    not_modified = False
+                    check_response = await response.json()
+                    if not isinstance(check_response, dict):
                         self.last_check_response = None
                         raise ValueError("OTA response was not a dict")
+                    self._save_check_cache(response.headers, check_response)
         except Exception as e:
             logger.error(f"Exception calling OTA URL! {e.__class__.__name__}: \"{e}\"")
             # we Timed out, or hit other error with requests
@@ -161,23 +457,76 @@ class OTAService(X1PlusDBusService):
         # Reset error flag at this point, since we ran through correctly
         self.last_check_error = False
         self.next_check_timestamp = datetime.datetime.now() + UPDATE_CHECK_SUCCESSFUL_INTERVAL
+
+        if not_modified:
+            if self.last_check_response is not None:
+                # Nothing to do; everything we know is still true.
+                logger.debug("_update_check found that ota.json is unchanged")
+                return
+            check_response = cached["response"]
+        self.last_check_response = check_response
         
         # Also, since the last_check_response has changed, blank out that
         # the OTA has been downloaded until we check.
         self.ota_downloaded = False
         self.base_update_downloaded = False
+        await asyncio.to_thread(self._remove_stale_downloads)
 
         # Now that we have the build info, do our check to see if there's an update
         if self.build_info.get("buildTimestamp", 0) < self.last_check_response.get(
             "buildTimestamp", 0
         ):
             self.ota_available = True
-            self._check_fwfiles()
+            await self._check_fwfiles()
 
         # the status diagnostics will give the contents later
         logger.debug("_update_check successfully downloaded ota.json")
     
-    def _check_fwfiles(self):
+    def _remove_stale_downloads(self):
+        """
+        Throw away partial downloads of anything that ota.json no longer
+        points us at.  Downloads only happen on the OTA task, which is busy
+        checking right now, so none of them can be in progress.
+        """
+
+        urls = {self.last_check_response.get("ota_url"), self.last_check_response.get("base_update_url")}
+        for d in self.last_check_response.get("ota_deltas") or []:
+            if isinstance(d, dict):
+                urls.add(d.get("url"))
+        try:
+            remove_stale_partials(self.sdcard_path, urls, suffixes=(".x1p", ".xdelta"))
+            remove_stale_partials(os.path.join(self.sdcard_path, "x1plus", "firmware"), urls)
+        except Exception as e:
+            logger.warning(f"failed to remove stale partial downloads: {e}")
+
+    async def _hash_file(self, path, cache=True):
+        """
+        md5 a file in a worker thread (or not at all, if the hash cache
+        already knows it), so that DBus calls keep getting answered while
+        we chew through hundreds of megabytes of SD card, and keep the
+        status object up to date on how far along we are.
+        """
+
+        self.verify_file = os.path.basename(path)
+        self.verify_bytes = 0
+        self.verify_bytes_total = -1
+
+        def progress(done, total):
+            self.verify_bytes = done
+            self.verify_bytes_total = total
+
+        hashing = asyncio.ensure_future(asyncio.to_thread(self.hashcache.hash_file, path, "md5", progress, cache))
+        try:
+            while True:
+                done, _ = await asyncio.wait({hashing}, timeout=0.2)
+                if done:
+                    return hashing.result()
+                await self._maybe_publish_status_object()
+        finally:
+            self.verify_file = None
+            await self._maybe_publish_status_object()
+
+    async def _check_fwfiles(self):
         if not self.last_check_response:
             return
 
@@ -189,11 +538,7 @@ class OTAService(X1PlusDBusService):
                 ota_md5 = self.last_check_response['ota_md5']
                 ota_filename = os.path.split(ota_url)[-1]
                 ota_on_disk_path = os.path.join(self.sdcard_path, ota_filename)
-                accum = hashlib.md5()
-                with open(ota_on_disk_path, "rb") as f:
-                    for chunk in iter(lambda: f.read(65536), b""):
-                        accum.update(chunk)
-                disk_md5 = accum.hexdigest()
+                disk_md5 = await self._hash_file(ota_on_disk_path)
                 logger.debug(f"{ota_on_disk_path} has md5 {disk_md5}, want md5 {ota_md5}")
                 self.ota_downloaded = ota_md5 == disk_md5
             except FileNotFoundError as e:
@@ -208,11 +553,7 @@ class OTAService(X1PlusDBusService):
                 base_update_md5 = self.last_check_response['base_update_md5']
                 base_update_filename = os.path.split(base_update_url)[-1]
                 base_update_on_disk_path = os.path.join(self.sdcard_path, "x1plus", "firmware", base_update_filename)
-                accum = hashlib.md5()
-                with open(base_update_on_disk_path, "rb") as f:
-                    for chunk in iter(lambda: f.read(65536), b""):
-                        accum.update(chunk)
-                disk_md5 = accum.hexdigest()
+                disk_md5 = await self._hash_file(base_update_on_disk_path)
                 logger.debug(f"{base_update_on_disk_path} has md5 {disk_md5}, want md5 {base_update_md5}")
                 self.base_update_downloaded = base_update_md5 == disk_md5
             except FileNotFoundError as e:
@@ -221,45 +562,559 @@ class OTAService(X1PlusDBusService):
             except Exception as e:
                 logger.error(f"exception while checking base update file: {e.__class__.__name__}: \"{e}\"")
 
+    async def _download_some(self, url, part):
+        """
+        Make one request for the rest of url, appending whatever we get to
+        part, and resuming with a Range request if part already has
+        something in it.
+        """
+
+        headers = {}
+        if part.bytes > 0:
+            headers["Range"] = f"bytes={part.bytes}-"
+            if part.validator is not None:
+                # Make sure that we do not splice the end of a new file
+                # onto the beginning of an old one.
+                headers["If-Range"] = part.validator
+
+        session = await self._get_session()
+        async with _download_request(session, url, headers) as response:
+            if response.status == 416 and part.bytes > 0:
+                # We already have all of it (or the file on the server
+                # has gotten shorter, in which case the md5 will not
+                # match, and we start over next time).
+                return
+            response.raise_for_status()
+
+            if part.bytes > 0 and response.status != 206:
+                logger.info(f"server sent all of {url} instead of resuming; starting over")
+                await asyncio.to_thread(part.restart)
+
+            etag = response.headers.get("ETag")
+            if etag is not None and not etag.startswith("W/"):
+                part.validator = etag
+            else:
+                part.validator = response.headers.get("Last-Modified")
+
+            content_length = response.headers.get("Content-Length")
+            self.download_bytes_total = part.bytes + int(content_length) if content_length is not None else -1
+            self.download_bytes = part.bytes
+
+            async for chunk in _read_chunks(response):
+                if part.write(chunk):
+                    await asyncio.to_thread(part.checkpoint)
+                self._report_download_progress(part.bytes, len(chunk))
+                await self.rate_limiter.consume(len(chunk))
+            await self._maybe_publish_status_object()
+
+            if self.download_bytes_total >= 0 and part.bytes < self.download_bytes_total:
+                raise aiohttp.ClientPayloadError(f"connection closed after {part.bytes} of {self.download_bytes_total} bytes")
+
+    def _printing(self):
+        return self.printstate is not None and self.printstate.printing
+
+    def _update_rate_limit(self):
+        """
+        Set the download rate limit from ota.max_rate_printing or
+        ota.max_rate_idle (in kilobytes per second), depending on whether
+        we are printing.  Unset means no limit, and 0 means do not download
+        at all; by default, downloads go as fast as they can, except during
+        a print, when they wait until it is over.
+        """
+
+        if self._printing():
+            key, default = "ota.max_rate_printing", 0
+        else:
+            key, default = "ota.max_rate_idle", None
+        limit = self.x1psettings.get(key, default)
+        try:
+            rate = None if limit is None else int(float(limit) * 1024)
+            if rate is not None and rate < 0:
+                raise ValueError("rate cannot be negative")
+        except (TypeError, ValueError) as e:
+            logger.warning(f"ignoring bad {key} setting {limit!r}: {e}")
+            rate = None
+        was_paused = self.rate_limiter.paused
+        self.rate_limiter.set_rate(rate)
+        if self.rate_limiter.paused and not was_paused and self.download_telemetry is not None:
+            self.download_telemetry.pauses += 1
+        self._publish_statusboard()
+
+    async def _wait_unpaused(self):
+        if self.rate_limiter.paused:
+            await self._maybe_publish_status_object()
+            await self.rate_limiter.wait_unpaused()
+            logger.info("download rate limit lifted; resuming")
+            await self._maybe_publish_status_object()
+
+    def _report_download_progress(self, nbytes, received):
+        """
+        Called for every chunk that we get.  The status board hears about
+        it right away; DBus hears about it from _download_ticker.
+        """
+
+        self.download_bytes = nbytes
+        self.download_telemetry.received(received)
+        self._publish_statusboard()
+
+    async def _download_ticker(self):
+        """
+        While a download is running, update its telemetry and publish the
+        status once every TICK_INTERVAL -- whether or not anything is
+        arriving, since a download that is stuck is exactly when someone
+        wants to know about it.
+        """
+
+        while True:
+            await asyncio.sleep(TICK_INTERVAL)
+            self.download_telemetry.tick()
+            await self._maybe_publish_status_object()
+
+    def _count_retry(self, error):
+        self.download_telemetry.retries += 1
+        if isinstance(error, Stalled):
+            self.download_telemetry.stalls += 1
+
+    def _download_connections(self):
+        try:
+            connections = int(self.x1psettings.get("ota.download_connections", 1))
+        except (TypeError, ValueError):
+            logger.warning("ota.download_connections is not a number; using one connection")
+            return 1
+        return max(1, min(connections, MAX_DOWNLOAD_CONNECTIONS))
+
     # can throw!  handle it yourself!
     async def _download_file(self, url, dest, md5):
+        """
+        Download url to dest, and check that it has the right md5.  The
+        download goes into dest.part first (see download.py), and if the
+        connection drops, we pick up where we left off -- either right
+        away, or on the next attempt, if we run out of retries or x1plusd
+        gets restarted.
+        """
+
+        logger.debug(f"downloading {url} to {dest}")
+        await _load_aiohttp()
+        connections = self._download_connections()
+        self.download_telemetry = DownloadTelemetry(os.path.basename(dest), connections)
+        ticker = asyncio.create_task(self._download_ticker())
+        result, error = "ok", None
+        try:
+            if connections > 1 and await self._download_segmented(url, dest, md5, connections):
+                return
+            self.download_telemetry.connections = 1
+            await self._download_stream(url, dest, md5)
+        except asyncio.CancelledError:
+            result = "cancelled"
+            raise
+        except Exception as e:
+            result, error = "failed", f"{e.__class__.__name__}: {e}"
+            raise
+        finally:
+            ticker.cancel()
+            record = self.download_telemetry.record(self.download_bytes_total, result, error)
+            self.download_telemetry = None
+            logger.info(f"download of {record['name']} {result}: {record['bytes']} bytes in {record['duration']}s, {record['retries']} retries ({record['stalls']} stalls)")
+            await asyncio.to_thread(self.download_history.add, record)
+
+    async def _download_stream(self, url, dest, md5):
+        "Download url to dest over a single connection."
+
+        part = PartialDownload(dest, url, md5)
+        self.download_bytes = await asyncio.to_thread(part.open)
+        self.download_telemetry.resumed_from = self.download_bytes
+        self.download_bytes_total = -1
+
+        try:
+            failures = 0
+            while True:
+                await self._wait_unpaused()
+                started_at = part.bytes
+                try:
+                    await self._download_some(url, part)
+                    break
+                except Paused:
+                    logger.info(f"pausing download of {url} at {part.bytes} bytes")
+                    await asyncio.to_thread(part.checkpoint)
+                    continue
+                except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    if part.bytes > started_at:
+                        failures = 0
+                    failures += 1
+                    if failures > len(DOWNLOAD_RETRY_DELAYS):
+                        raise
+                    delay = DOWNLOAD_RETRY_DELAYS[failures - 1]
+                    self._count_retry(e)
+                    logger.warning(f"download of {url} interrupted at {part.bytes} bytes ({e.__class__.__name__}: {e}); resuming in {delay}s")
+                    await asyncio.to_thread(part.checkpoint)
+                    await asyncio.sleep(delay)
+
+            await asyncio.to_thread(part.finish)
+        except:
+            # Keep whatever we got for next time, unless finish() decided
+            # that it was garbage.
+            if not part.discarded:
+                try:
+                    await asyncio.to_thread(part.checkpoint)
+                except Exception as e:
+                    logger.warning(f"could not checkpoint download of {url} ({e.__class__.__name__}: {e})")
+            part.close()
+            raise
+
+        await asyncio.to_thread(self.hashcache.store, dest, md5)
+
+    async def _fetch_segment(self, session, url, download, seg):
+        "Fetch seg of download, until it is done or someone else takes the rest."
+
+        headers = {
+            "Range": f"bytes={seg.pos}-{seg.end - 1}",
+            "If-Range": download.validator,
+        }
+        async with _download_request(session, url, headers) as response:
+            response.raise_for_status()
+            if response.status != 206:
+                raise ValueError(f"{url} changed on the server while we were downloading it")
+
+            async for chunk in _read_chunks(response):
+                # seg.end might have moved while we were waiting, if
+                # another connection took over the back half of it.
+                chunk = chunk[:seg.end - seg.pos]
+                if download.write_at(seg.pos, chunk):
+                    await self._checkpoint_segmented(download)
+                seg.pos += len(chunk)
+                self._report_download_progress(download.bytes, len(chunk))
+                if seg.pos >= seg.end:
+                    break
+                await self.rate_limiter.consume(len(chunk))
+
+            if seg.pos < seg.end:
+                raise aiohttp.ClientPayloadError(f"connection closed {seg.end - seg.pos} bytes short of the end of a segment")
+
+    async def _fetch_segments(self, session, url, download):
+        "One connection's worth of a segmented download."
+
+        size = SEGMENT_INITIAL_SIZE
+        failures = 0
+        while True:
+            await self._wait_unpaused()
+            seg = download.claim(size, SEGMENT_MIN_SIZE)
+            if seg is None:
+                return
+
+            started_at = seg.pos
+            t0 = time.monotonic()
+            error = None
+            paused = False
+            try:
+                await self._fetch_segment(session, url, download, seg)
+            except Paused:
+                paused = True
+            except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            finally:
+                download.release(seg)
+            if paused:
+                # Whoever gets going first after the pause can have the
+                # rest of the segment.
+                continue
+
+            fetched = seg.pos - started_at
+            if fetched > 0:
+                failures = 0
+                elapsed = time.monotonic() - t0
+                size = int(fetched / max(elapsed, 0.001) * SEGMENT_TARGET_SECONDS)
+                size = max(SEGMENT_MIN_SIZE, min(size, SEGMENT_MAX_SIZE))
+
+            if error is not None:
+                failures += 1
+                if failures > len(DOWNLOAD_RETRY_DELAYS):
+                    raise error
+                delay = DOWNLOAD_RETRY_DELAYS[failures - 1]
+                self._count_retry(error)
+                logger.warning(f"segment of {url} interrupted at {seg.pos} bytes ({error.__class__.__name__}: {error}); retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+    async def _checkpoint_segmented(self, download):
+        # With several connections going, more than one of them will decide
+        # that it is time for a checkpoint; one at a time is plenty.
+        if self.download_checkpoint is not None and not self.download_checkpoint.done():
+            return
+        snapshot = [list(r) for r in download.done]
+        self.download_checkpoint = asyncio.ensure_future(asyncio.to_thread(download.checkpoint, snapshot))
+        # If we get cancelled, the checkpoint keeps going in its thread;
+        # _download_segmented waits for it before closing the file.
+        await asyncio.shield(self.download_checkpoint)
+
+    async def _download_segmented(self, url, dest, md5, connections):
+        """
+        Download url to dest over several connections at once (see
+        SegmentedDownload in download.py).  Returns False without touching
+        anything if the server will not give us the file in pieces, in
+        which case the caller should fall back to _download_stream.
+        """
+
+        session = await self._get_session()
+
+        # Find out how big the file is, and whether we can have it in
+        # pieces at all.  Without a validator, we would have no way to
+        # tell if the file changed between pieces, so that counts as a
+        # no.
+        try:
+            async with _download_request(session, url, {"Range": "bytes=0-0"}) as response:
+                response.raise_for_status()
+                content_range = response.headers.get("Content-Range", "")
+                etag = response.headers.get("ETag")
+                validator = etag if etag is not None and not etag.startswith("W/") else response.headers.get("Last-Modified")
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            logger.warning(f"could not start segmented download of {url} ({e.__class__.__name__}: {e}); using one connection")
+            return False
+        total = content_range.rpartition("/")[2]
+        if response.status != 206 or not total.isdigit() or validator is None:
+            logger.info(f"{url} cannot be downloaded in segments; using one connection")
+            return False
+
+        download = SegmentedDownload(dest, url, md5, int(total), validator)
+        await asyncio.to_thread(download.open)
+        self.download_bytes = download.bytes
+        self.download_telemetry.resumed_from = download.bytes
+        self.download_bytes_total = download.size
+        self.download_checkpoint = None
+        logger.debug(f"downloading {url} over {connections} connections")
+
+        workers = [asyncio.create_task(self._fetch_segments(session, url, download)) for _ in range(connections)]
         try:
-            logger.debug(f"downloading {url} to {dest}")
-            accum = hashlib.md5()
-            self.download_bytes = 0
-            self.download_bytes_total = -1
-            with open(dest, 'wb') as f:
-                # Total timeout of 15 minutes per request means you need to
-                # sustain 100 kB/s from Bambu on a 90MB update.zip before we
-                # time out.
-                timeout = aiohttp.ClientTimeout(connect=5, total=900, sock_read=10)
-                async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(ssl=ssl_ctx), timeout=timeout) as session:
-                    async with session.get(url) as response:
-                        response.raise_for_status()
-                        self.download_bytes_total = int(response.headers['content-length'])
-                        self.download_bytes = 0
-                        last_publish = datetime.datetime.now()
-                        async for chunk in response.content.iter_chunked(131072):
-                            self.download_bytes += len(chunk)
-                            accum.update(chunk)
-                            f.write(chunk)
-                            
-                            # only make noise at 5Hz
-                            if (datetime.datetime.now() - last_publish) > datetime.timedelta(seconds = 0.2):
-                                last_publish = datetime.datetime.now()
-                                await self._maybe_publish_status_object()
-                        await self._maybe_publish_status_object()
-            disk_md5 = accum.hexdigest()
-            logger.debug(f"{dest} has md5 {disk_md5}, want md5 {md5}")
-            if disk_md5 != md5:
-                raise ValueError("downloaded file had incorrect md5")
+            try:
+                await asyncio.gather(*workers)
+            finally:
+                for w in workers:
+                    w.cancel()
+                await asyncio.gather(*workers, return_exceptions=True)
+                if self.download_checkpoint is not None:
+                    await asyncio.wait({self.download_checkpoint})
+            if not download.complete():
+                raise aiohttp.ClientPayloadError(f"segmented download ended with {download.bytes} of {download.size} bytes")
+        except ValueError:
+            # The file changed out from under us; none of what we have
+            # is any good.
+            download.discard()
+            raise
         except:
             try:
-                os.unlink(dest)
-            except:
+                await asyncio.to_thread(download.checkpoint)
+            except Exception as e:
+                logger.warning(f"could not checkpoint download of {url} ({e.__class__.__name__}: {e})")
+            download.close()
+            raise
+
+        await self._maybe_publish_status_object()
+        disk_md5 = await self._hash_file(download.part_path, cache=False)
+        await asyncio.to_thread(download.finish, disk_md5)
+        await asyncio.to_thread(self.hashcache.store, dest, md5)
+        return True
+
+    async def _download_delta(self, dest, md5):
+        """
+        Try to build dest by patching the .x1p that we are running now
+        with one of the ota_deltas that ota.json offers, which look like:
+
+          {"from_version": "...", "from_md5": "...", "url": "...", "md5": "...", "size": ...}
+
+        The smallest patch whose from_md5 matches what we have on the SD
+        card wins.  Returns True if dest is now there and has the right
+        md5, or False if there was nothing to patch from or the patch did
+        not work out, in which case the caller should download the whole
+        thing.
+        """
+
+        installed_version = self.build_info.get("cfwVersion")
+        deltas = []
+        for d in self.last_check_response.get("ota_deltas") or []:
+            if not isinstance(d, dict) or not all(k in d for k in ("from_version", "from_md5", "url", "md5")):
+                logger.warning(f"ignoring malformed entry in ota_deltas: {d}")
+                continue
+            if d["from_version"] == installed_version:
+                deltas.append(d)
+        deltas.sort(key=lambda d: d.get("size") or float("inf"))
+
+        for d in deltas:
+            source = os.path.join(self.sdcard_path, f"{d['from_version']}.x1p")
+            try:
+                source_md5 = await self._hash_file(source)
+            except FileNotFoundError:
+                logger.debug(f"{source} is not on the SD card; cannot patch from it")
+                return False
+            if source_md5 != d["from_md5"]:
+                logger.debug(f"{source} has md5 {source_md5}, but the patch wants {d['from_md5']}")
+                continue
+
+            patch_path = f"{dest}.xdelta"
+            output_path = f"{dest}.patched"
+            try:
+                logger.info(f"building {dest} from {source} and {d['url']}")
+                await self._download_file(d["url"], patch_path, d["md5"])
+                xdelta3 = await asyncio.to_thread(delta.find_xdelta3, source)
+                await delta.apply_patch(xdelta3, source, patch_path, output_path)
+                disk_md5 = await self._hash_file(output_path, cache=False)
+                if disk_md5 != md5:
+                    raise ValueError(f"patched file has md5 {disk_md5}, want {md5}")
+                os.replace(output_path, dest)
+            except Exception as e:
+                logger.warning(f"could not patch {source} up to {dest} ({e.__class__.__name__}: {e}); downloading the whole thing")
+                return False
+            finally:
+                for path in [patch_path, output_path]:
+                    try:
+                        os.unlink(path)
+                    except FileNotFoundError:
+                        pass
+                await asyncio.to_thread(self.hashcache.invalidate, patch_path)
+
+            await asyncio.to_thread(self.hashcache.store, dest, md5)
+            return True
+
+        return False
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"ignoring unreadable OTA manifest {self.manifest_path}: {e}")
+            return None
+
+    def _save_manifest(self, manifest):
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            with open(f"{self.manifest_path}.new", "w") as f:
+                json.dump(manifest, f)
+            os.replace(f"{self.manifest_path}.new", self.manifest_path)
+        except Exception as e:
+            logger.warning(f"failed to save OTA manifest {self.manifest_path}: {e}")
+
+    def _prestage_extract(self):
+        return bool(self.x1psettings.get("ota.prestage_extract", False))
+
+    def _manifest_is_current(self, manifest, path, md5):
+        "Does manifest say that we have already done all we need to for path?"
+
+        if not isinstance(manifest, dict):
+            return False
+        try:
+            stamp = prestage.x1p_stamp(path)
+        except OSError:
+            return False
+        if manifest.get("version") != prestage.MANIFEST_VERSION or manifest.get("stamp") != stamp or manifest.get("md5") != md5:
+            return False
+        if self._prestage_extract() and prestage.staged_stamp(self.staging_path) != stamp:
+            return False
+        return True
+
+    def _maybe_start_prestage(self):
+        """
+        Once an update has been downloaded, start verifying it (and
+        unpacking it, if ota.prestage_extract is set) in the background;
+        if what we are working on is no longer the update, stop.
+        """
+
+        wanted = None
+        if self.ota_downloaded and self.last_check_response:
+            try:
+                ota_url = self.last_check_response['ota_url']
+                wanted = (os.path.join(self.sdcard_path, os.path.split(ota_url)[-1]), self.last_check_response['ota_md5'])
+            except KeyError:
                 pass
+        if wanted == self.prestage_for:
+            return
+
+        if self.prestage_task is not None and not self.prestage_task.done():
+            self.prestage_task.cancel()
+        self.prestage_task = None
+        self.prestage_for = wanted
+        if wanted is None:
+            # Hang on to a failure, so that whoever is watching gets to
+            # find out why the update went away.
+            if self.prestage_status != OTAService.PRESTAGE_FAILED:
+                self.prestage_status = None
+            return
+        self.prestage_task = asyncio.create_task(self._prestage(*wanted))
+
+    def _prestage_settings_changed(self):
+        self.prestage_for = None
+        self.ota_task_wake.set()
+
+    async def _prestage(self, path, md5):
+        """
+        Check over the payload of the .x1p at path, which has already been
+        checked against md5, in the prestaging worker; a payload that is
+        damaged even so (the SD card went bad under it, or the release
+        itself is broken) gets the update marked as not downloaded, so
+        that nobody reboots into it.  Keep a manifest of what we found, so
+        that we only do this once per update.
+        """
+
+        self.prestage_error = None
+        self.prestage_staged = False
+        manifest = await asyncio.to_thread(self._load_manifest)
+        if await asyncio.to_thread(self._manifest_is_current, manifest, path, md5):
+            logger.debug(f"{path} has already been verified")
+            self.prestage_status = OTAService.PRESTAGE_VERIFIED
+            self.prestage_staged = manifest.get("staged") is not None
+            await self._maybe_publish_status_object()
+            return
+
+        extract = self._prestage_extract()
+        if not extract:
+            await asyncio.to_thread(prestage.discard_staged, self.staging_path)
+
+        self.prestage_status = OTAService.PRESTAGE_VERIFYING
+        self.prestage_bytes = 0
+        self.prestage_bytes_total = -1
+
+        def progress(done, total):
+            self.prestage_bytes = done
+            self.prestage_bytes_total = total
+
+        logger.info(f"verifying {path}{' and unpacking it to ' + self.staging_path if extract else ''}")
+        cancel = threading.Event()
+        verifying = asyncio.get_running_loop().run_in_executor(
+            prestage.executor(),
+            functools.partial(prestage.verify_x1p, path, self.staging_path if extract else None, progress, cancel),
+        )
+        try:
+            while True:
+                done, _ = await asyncio.wait({verifying}, timeout=1)
+                if done:
+                    manifest = verifying.result()
+                    break
+                await self._maybe_publish_status_object()
+        except asyncio.CancelledError:
+            cancel.set()
+            verifying.cancel()
             raise
-    
+        except prestage.PayloadError as e:
+            logger.error(f"downloaded update is no good: {e}")
+            self.prestage_status = OTAService.PRESTAGE_FAILED
+            self.prestage_error = str(e)
+            self.ota_downloaded = False
+            await asyncio.to_thread(self.hashcache.invalidate, path)
+            await self._maybe_publish_status_object()
+            return
+        except Exception as e:
+            logger.error(f"exception while verifying {path}: {e.__class__.__name__}: \"{e}\"")
+            self.prestage_status = OTAService.PRESTAGE_FAILED
+            self.prestage_error = f"could not verify {os.path.basename(path)}: {e.__class__.__name__}: {e}"
+            await self._maybe_publish_status_object()
+            return
+
+        manifest["md5"] = md5
+        await asyncio.to_thread(self._save_manifest, manifest)
+        logger.info(f"{path} is good: {manifest['file_count']} files, {manifest['file_bytes']} bytes{', unpacked' if manifest['staged'] else ''}")
+        self.prestage_status = OTAService.PRESTAGE_VERIFIED
+        self.prestage_staged = manifest["staged"] is not None
+        await self._maybe_publish_status_object()
+
     def _ota_url_changed(self):
         new_url = self.x1psettings.get('ota.json_url', DEFAULT_OTA_URL)
         if self.ota_url != new_url:
@@ -270,9 +1125,17 @@ class OTAService(X1PlusDBusService):
     
     async def _ota_task(self):
         # Make sure that we are given a chance to see if there is work to do
-        # when the OTA status changes.
-        self.x1psettings.on("ota.enabled", lambda: self.ota_task_wake.set())
-        self.x1psettings.on("ota.json_url", lambda: self._ota_url_changed())
+        # when the OTA status changes -- but only once, even if we get
+        # restarted.
+        if not self.watching_settings:
+            self.watching_settings = True
+            self.x1psettings.on("ota.enabled", lambda _key, _paths: self.ota_task_wake.set())
+            self.x1psettings.on("ota.json_url", lambda _key, _paths: self._ota_url_changed())
+            self.x1psettings.on("ota.max_rate_idle", lambda _key, _paths: self._update_rate_limit())
+            self.x1psettings.on("ota.max_rate_printing", lambda _key, _paths: self._update_rate_limit())
+            self.x1psettings.on("ota.prestage_extract", lambda _key, _paths: self._prestage_settings_changed())
+            if self.printstate is not None:
+                self.printstate.on_change(lambda _printing: self._update_rate_limit())
         
         while True:
             did_work = False
@@ -283,7 +1146,7 @@ class OTAService(X1PlusDBusService):
                 did_work = True
             
             if self.recheck_files_request or self.download_ota_request:
-                self._check_fwfiles()
+                await self._check_fwfiles()
                 self.recheck_files_request = False
                 did_work = True
             
@@ -296,7 +1159,8 @@ class OTAService(X1PlusDBusService):
                         ota_md5 = self.last_check_response['ota_md5']
                         ota_filename = os.path.split(ota_url)[-1]
                         ota_on_disk_path = os.path.join(self.sdcard_path, ota_filename)
-                        await self._download_file(ota_url, ota_on_disk_path, ota_md5)
+                        if not await self._download_delta(ota_on_disk_path, ota_md5):
+                            await self._download_file(ota_url, ota_on_disk_path, ota_md5)
                         self.ota_downloaded = True
                     except Exception as e:
                         self.download_last_error = f"exception while downloading OTA: {e.__class__.__name__}: \"{e}\""
@@ -324,6 +1188,8 @@ class OTAService(X1PlusDBusService):
                 self.task_status = OTAService.STATUS_DISABLED
             else:
                 self.task_status = OTAService.STATUS_IDLE
+
+            self._maybe_start_prestage()
             
             await self._maybe_publish_status_object()
             
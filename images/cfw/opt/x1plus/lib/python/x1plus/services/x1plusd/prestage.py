@@ -0,0 +1,310 @@
+"""
+Checking over an .x1p once it has been downloaded -- and, optionally,
+unpacking it ahead of time -- so that we find out about a damaged payload
+before we reboot into the installer rather than after, and so that the
+installer does not have to sit there gunzipping it while the printer is
+out of commission.
+
+The installer (bbl_screen-patch/kexec_ui/printerui/qml/InstallingPage.qml)
+normally unpacks payload.tar.gz into /userdata/x1plus.  If it finds a
+staged copy in STAGING_PATH whose stamp file matches the .x1p that it is
+about to install (see x1p_stamp()), it moves that into place instead.
+
+All of this is slow, and none of it is urgent, so it runs in a thread of
+its own at the lowest CPU priority (which, with the kernel's default I/O
+scheduling, also puts its SD card and eMMC traffic behind everyone
+else's).
+"""
+
+import os
+import gzip
+import json
+import shutil
+import hashlib
+import tarfile
+import zipfile
+import threading
+import zlib
+import concurrent.futures
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+STAGING_PATH = "/userdata/x1plus.staged"
+STAMP_NAME = ".x1plus-staged"
+
+CHUNK_SIZE = 1024 * 1024
+PRESTAGE_NICE = 19
+
+MANIFEST_VERSION = 1
+
+
+class PayloadError(Exception):
+    "The .x1p is damaged, or is missing something that the installer needs."
+
+
+class Cancelled(Exception):
+    "Raised from the worker when the caller has lost interest."
+
+
+def required_members(cfw_version):
+    """
+    The payload members that the installer cannot do without; these also
+    get an md5 in the manifest.  (Everything else -- mostly the Python
+    that the installer runs on -- is only counted, since the zip's CRC
+    and gzip's checks already tell us whether it came through intact.)
+    """
+
+    return [
+        "info.json", "install.sh", "install.py", "dds.py",
+        f"{cfw_version}.squashfs", "bbl_screen.xdelta",
+        "xdelta3", "gensquashfs", "rdsquashfs",
+    ]
+
+
+def x1p_stamp(x1p_path):
+    """
+    What the installer compares (with busybox's `stat -c '%s %Y'`) to make
+    sure that a staged payload came from the .x1p that it is installing.
+    """
+
+    st = os.stat(x1p_path)
+    return f"{os.path.basename(x1p_path)} {st.st_size} {int(st.st_mtime)}"
+
+
+def staged_stamp(staging_path):
+    "Returns the stamp of what is staged in staging_path, or None."
+
+    try:
+        with open(os.path.join(staging_path, STAMP_NAME), "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def discard_staged(staging_path):
+    for path in [f"{staging_path}.new", staging_path]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _lower_priority():
+    # On Linux, setpriority() on a thread ID renices just that thread.
+    try:
+        os.setpriority(os.PRIO_PROCESS, threading.get_native_id(), PRESTAGE_NICE)
+    except OSError as e:
+        logger.warning(f"could not lower the priority of the prestaging thread: {e}")
+
+
+_executor = None
+
+
+def executor():
+    "The single low-priority worker thread that verify_x1p() should run on."
+
+    global _executor
+    if _executor is None:
+        _executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="prestage", initializer=_lower_priority
+        )
+    return _executor
+
+
+class _ProgressReader:
+    "Counts how much of the compressed payload has gone by, for progress."
+
+    def __init__(self, f, progress, cancel):
+        self.f = f
+        self.done = 0
+        self.progress = progress
+        self.cancel = cancel
+
+    def read(self, n=-1):
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled()
+        data = self.f.read(n)
+        self.done += len(data)
+        if self.progress is not None:
+            self.progress(self.done)
+        return data
+
+
+class _Staging:
+    """
+    Unpacks payload members into path.new as they go by.  If that fails
+    (most likely for lack of space on /userdata), we throw away what we
+    have and carry on just verifying; the installer can always unpack the
+    payload itself.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp = f"{path}.new"
+        self.out = None
+        self.ok = True
+        discard_staged(path)
+        self._try(os.makedirs, self.tmp)
+
+    def _try(self, fn, *args):
+        if not self.ok:
+            return None
+        try:
+            return fn(*args)
+        except OSError as e:
+            logger.warning(f"giving up on unpacking the payload ahead of time: {e}")
+            self.ok = False
+            if self.out is not None:
+                self.out.close()
+                self.out = None
+            shutil.rmtree(self.tmp, ignore_errors=True)
+            return None
+
+    def begin_file(self, name, ti):
+        dest = os.path.join(self.tmp, name)
+        self._try(os.makedirs, os.path.dirname(dest), 0o755, True)
+        self.out = self._try(open, dest, "wb")
+
+    def write(self, data):
+        if self.out is not None:
+            self._try(self.out.write, data)
+
+    def end_file(self, name, ti):
+        if self.out is None:
+            return
+        self._try(self.out.close)
+        self.out = None
+        dest = os.path.join(self.tmp, name)
+        self._try(os.chmod, dest, ti.mode & 0o7777)
+        self._try(os.utime, dest, (ti.mtime, ti.mtime))
+
+    def other(self, tf, ti):
+        """
+        Directories, symlinks, and the like, which tarfile can do itself.
+        This is our own payload, which we would otherwise hand straight to
+        tar, so it gets trusted just as much as tar would trust it.
+        """
+
+        self._try(lambda: tf.extract(ti, self.tmp, set_attrs=True, filter="fully_trusted"))
+
+    def commit(self, stamp):
+        self._try(self._commit, stamp)
+        return self.ok
+
+    def _commit(self, stamp):
+        with open(os.path.join(self.tmp, STAMP_NAME), "w") as f:
+            f.write(f"{stamp}\n")
+        os.sync()
+        os.rename(self.tmp, self.path)
+
+
+def _member_name(ti):
+    name = os.path.normpath(ti.name)
+    if name.startswith("..") or os.path.isabs(name):
+        raise PayloadError(f"payload member {ti.name} points outside of the payload")
+    return name
+
+
+def verify_x1p(x1p_path, staging_path=None, progress=None, cancel=None):
+    """
+    Read all the way through x1p_path's payload, checking that every
+    member of it comes out intact, and that everything that the installer
+    needs is there.  If staging_path is given, unpack the payload there as
+    well (if we can).
+
+    progress, if given, is called with (compressed bytes read, total).
+    cancel, if given, is a threading.Event; once it is set, we raise
+    Cancelled at the next opportunity.
+
+    Returns the manifest: a dict describing the .x1p and what is in it.
+    Raises PayloadError if the .x1p is no good.  This takes a while, so it
+    is meant to run on executor().
+    """
+
+    stamp = x1p_stamp(x1p_path)
+    staging = None
+    try:
+        with zipfile.ZipFile(x1p_path, "r") as zf:
+            info = json.loads(zf.read("info.json"))
+            cfw_version = info["cfwVersion"]
+            payload_info = zf.getinfo("payload.tar.gz")
+            required = set(required_members(cfw_version))
+
+            if staging_path is not None:
+                staging = _Staging(staging_path)
+
+            members = {}
+            file_count = 0
+            file_bytes = 0
+            kernel_files = 0
+            with zf.open(payload_info) as payload:
+                reader = _ProgressReader(
+                    payload,
+                    progress and (lambda done: progress(done, payload_info.file_size)),
+                    cancel,
+                )
+                # tarfile can do the gunzipping itself, but it does not
+                # check gzip's CRC at the end, which gzip.GzipFile does.
+                with gzip.GzipFile(fileobj=reader, mode="rb") as gz:
+                    with tarfile.open(fileobj=gz, mode="r|") as tf:
+                        for ti in tf:
+                            name = _member_name(ti)
+                            if not ti.isfile():
+                                if staging is not None:
+                                    staging.other(tf, ti)
+                                continue
+
+                            if staging is not None:
+                                staging.begin_file(name, ti)
+                            md5 = hashlib.md5()
+                            size = 0
+                            with tf.extractfile(ti) as f:
+                                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                                    md5.update(chunk)
+                                    size += len(chunk)
+                                    if staging is not None:
+                                        staging.write(chunk)
+                            if staging is not None:
+                                staging.end_file(name, ti)
+
+                            file_count += 1
+                            file_bytes += size
+                            if name.startswith("kernel/"):
+                                kernel_files += 1
+                            if name in required or name.startswith("kernel/"):
+                                members[name] = {"size": size, "md5": md5.hexdigest()}
+
+                    # tar stops reading at its end-of-archive marker, but
+                    # gzip's CRC, and the zip's, only get checked once
+                    # everything has been read.
+                    while gz.read(CHUNK_SIZE):
+                        pass
+                while reader.read(CHUNK_SIZE):
+                    pass
+    except (zipfile.BadZipFile, gzip.BadGzipFile, tarfile.TarError, EOFError, zlib.error, KeyError, ValueError) as e:
+        if staging is not None:
+            discard_staged(staging_path)
+        raise PayloadError(f"{os.path.basename(x1p_path)} is damaged: {e.__class__.__name__}: {e}") from e
+    except BaseException:
+        if staging is not None:
+            discard_staged(staging_path)
+        raise
+
+    missing = sorted(required - set(members))
+    if kernel_files == 0:
+        missing.append("kernel/")
+    if missing:
+        if staging is not None:
+            discard_staged(staging_path)
+        raise PayloadError(f"{os.path.basename(x1p_path)} is missing {', '.join(missing)}")
+
+    staged = staging is not None and staging.commit(stamp)
+    return {
+        "version": MANIFEST_VERSION,
+        "x1p": os.path.basename(x1p_path),
+        "stamp": stamp,
+        "cfwVersion": cfw_version,
+        "members": members,
+        "file_count": file_count,
+        "file_bytes": file_bytes,
+        "staged": staging_path if staged else None,
+    }
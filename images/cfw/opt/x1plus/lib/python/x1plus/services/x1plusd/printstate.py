@@ -0,0 +1,73 @@
+import json
+import asyncio
+import importlib
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+PRINT_TOPIC = "device/report/print"
+
+# gcode_states in which there is a print going on (or about to be); a
+# paused print still has the camera streaming and the cloud watching it.
+PRINTING_STATES = {"PREPARE", "SLICING", "RUNNING", "PAUSE"}
+
+
+class PrintStateMonitor:
+    """
+    Keeps track of whether the printer is printing, by listening to the
+    push_status reports that the printer firmware sends out over DDS.  If
+    DDS is not available (say, because we are emulating), we just never
+    think that we are printing.
+
+    Callbacks registered with on_change() get called, from the event loop,
+    with the new value of printing whenever it changes.
+    """
+
+    def __init__(self):
+        self.printing = False
+        self.gcode_state = None
+        self._callbacks = []
+
+    def on_change(self, cb):
+        self._callbacks.append(cb)
+
+    def _handle(self, msg):
+        try:
+            datum = json.loads(msg)
+        except ValueError as e:
+            logger.debug(f"ignoring unparseable message on {PRINT_TOPIC}: {e}")
+            return
+        if not isinstance(datum, dict) or datum.get("command") != "push_status":
+            return
+
+        # Reports are incremental, and most of them do not mention
+        # gcode_state at all.
+        gcode_state = datum.get("gcode_state")
+        if gcode_state is None and isinstance(datum.get("print"), dict):
+            gcode_state = datum["print"].get("gcode_state")
+        if gcode_state is None or gcode_state == self.gcode_state:
+            return
+
+        self.gcode_state = gcode_state
+        printing = gcode_state in PRINTING_STATES
+        if printing == self.printing:
+            return
+        logger.info(f"print state is now {gcode_state}; {'' if printing else 'not '}printing")
+        self.printing = printing
+        for cb in self._callbacks:
+            try:
+                cb(printing)
+            except Exception as e:
+                logger.error(f"print state callback failed: {e.__class__.__name__}: {e}")
+
+    async def task(self):
+        try:
+            dds = await asyncio.to_thread(importlib.import_module, "x1plus.dds")
+        except (ImportError, OSError) as e:
+            logger.warning(f"DDS is not available ({e.__class__.__name__}: {e}); assuming that we are not printing")
+            return
+
+        with dds.subscribe_async(PRINT_TOPIC) as sub:
+            async for msg in sub:
+                self._handle(msg)
@@ -0,0 +1,78 @@
+"""
+Running other programs from x1plusd without holding up the event loop.
+
+Everything in x1plusd shares one event loop, so a subprocess.run() from a
+settings callback or a DBus method -- say, of dropbearkey, which can take
+several seconds to come up with a key -- stalls every other DBus call for
+as long as it takes.  run() is the asyncio equivalent: it takes an
+argument list (there is no shell, so there is nothing to quote), captures
+output, kills the program if it takes too long, and limits how many
+programs x1plusd has going at once.
+"""
+
+import asyncio
+import subprocess
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 30
+
+# The printer does not have many cores to spare, and nothing that x1plusd
+# runs is in a hurry.
+MAX_CONCURRENT = 4
+
+_semaphore = None
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(MAX_CONCURRENT)
+    return _semaphore
+
+
+async def run(args, input=None, timeout=DEFAULT_TIMEOUT, check=False, capture_output=True):
+    """
+    Run args, a list of the program and its arguments, feeding it input (a
+    str) on stdin if given, and return a subprocess.CompletedProcess,
+    with stdout and stderr as str if capture_output is set.
+
+    Like subprocess.run(), this raises FileNotFoundError (or some other
+    OSError) if the program cannot be run at all, subprocess.TimeoutExpired
+    if it is still going after timeout seconds (in which case it gets
+    killed), and, if check is set, subprocess.CalledProcessError if it
+    exits with a non-zero status.  If we get cancelled, the program gets
+    killed, too.
+    """
+
+    args = [str(arg) for arg in args]
+    output = asyncio.subprocess.PIPE if capture_output else asyncio.subprocess.DEVNULL
+    async with _get_semaphore():
+        logger.debug(f"running {args}")
+        proc = await asyncio.create_subprocess_exec(
+            *args,
+            stdin=asyncio.subprocess.PIPE if input is not None else asyncio.subprocess.DEVNULL,
+            stdout=output,
+            stderr=output,
+        )
+        try:
+            stdout, stderr = await asyncio.wait_for(
+                proc.communicate(input.encode() if input is not None else None), timeout
+            )
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise subprocess.TimeoutExpired(args, timeout) from None
+        except asyncio.CancelledError:
+            proc.kill()
+            raise
+
+    if capture_output:
+        stdout = stdout.decode(errors="replace")
+        stderr = stderr.decode(errors="replace")
+    result = subprocess.CompletedProcess(args, proc.returncode, stdout, stderr)
+    if check:
+        result.check_returncode()
+    return result
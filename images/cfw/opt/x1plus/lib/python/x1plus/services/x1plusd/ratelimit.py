@@ -0,0 +1,95 @@
+import time
+import asyncio
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How much a bucket can save up while nobody is using it, in seconds' worth
+# of its rate.
+BURST_SECONDS = 1.0
+
+
+class Paused(Exception):
+    "Raised by TokenBucket.consume() when the bucket has been paused."
+
+
+class TokenBucket:
+    """
+    A token bucket for limiting how fast we download, shared by everyone
+    who is downloading.  The rate is in bytes per second; None means no
+    limit at all, and 0 means that we are paused.
+
+    Callers read a chunk, and then consume() its size; consume() lets the
+    bucket go into debt for the chunk, and then sleeps until it is paid
+    off, so the average works out even when chunks are bigger than the
+    bucket.  Since nobody is reading the socket while we sleep, TCP flow
+    control slows the sender down, too.
+
+    A pause might last for the length of a print, which is far longer than
+    we want to hold a connection open doing nothing, so rather than
+    blocking, consume() raises Paused; the downloader lets go of the
+    connection, waits in wait_unpaused(), and resumes where it left off.
+    """
+
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.tokens = 0
+        self._last = time.monotonic()
+        self._changed = asyncio.Event()
+
+    @property
+    def paused(self):
+        return self.rate == 0
+
+    def set_rate(self, rate):
+        if rate == self.rate:
+            return
+        logger.info(f"download rate limit is now {'unlimited' if rate is None else 'paused' if rate == 0 else f'{rate} bytes/s'}")
+        self._refill()
+        self.rate = rate
+        self.tokens = min(self.tokens, self._burst())
+        self._changed.set()
+
+    def _burst(self):
+        return self.rate * BURST_SECONDS if self.rate else 0
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.rate:
+            self.tokens = min(self._burst(), self.tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    async def _wait_for_change(self, timeout=None):
+        self._changed.clear()
+        try:
+            await asyncio.wait_for(self._changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def consume(self, n):
+        "Account for n bytes, waiting as long as it takes to afford them."
+
+        self._refill()
+        if self.rate is None:
+            return
+        if self.paused:
+            raise Paused()
+        self.tokens -= n
+        while True:
+            self._refill()
+            if self.rate is None or self.tokens >= 0:
+                return
+            if self.paused:
+                raise Paused()
+            await self._wait_for_change(-self.tokens / self.rate)
+
+    async def wait_unpaused(self):
+        while self.paused:
+            await self._wait_for_change()
+
+    def as_dict(self):
+        return {
+            "rate": self.rate,
+            "paused": self.paused,
+        }
@@ -1,17 +1,52 @@
 import os
 import copy
+import asyncio
+import time
+import uuid
 from pathlib import Path
 import json
 
 import logging
 import x1plus.utils
+import x1plus.settingsview
 from .dbus import *
+from .journal import SettingsJournal
+from .keytrie import KeyTrie
+from .jsonpatch import apply_patch, JSONPatchError
 
 logger = logging.getLogger(__name__)
 
 SETTINGS_INTERFACE = "x1plus.settings"
 SETTINGS_PATH = "/x1plus/settings"
 
+# Puts that show up within this many seconds of each other share one write
+# (and, more importantly, one fsync on the SD card).
+COMMIT_WINDOW = 0.05
+
+# Commits normally just append to the journal.  Once the journal gets this
+# big, or once things have been quiet for COMPACT_DELAY seconds, we fold it
+# back into a fresh snapshot.
+COMPACT_RECORDS = 64
+COMPACT_BYTES = 64 * 1024
+COMPACT_DELAY = 5.0
+
+# Boot scripts (functions.sh, check_kexec, ...) read these out of
+# settings.json (or the views that are written alongside it), before
+# x1plusd is up to replay the journal, and the printer may well reboot
+# right after one of them is set.  Changes to them always go straight into
+# the snapshot.
+SNAPSHOT_KEY_PREFIXES = ("boot.", "ota.filename")
+
+# Keys starting with this are never settings; SettingsChanged signals use
+# them to carry metadata alongside the changed keys.
+RESERVED_KEY_PREFIX = "_"
+SIGNAL_VERSION_KEY = "_version"
+SIGNAL_EPOCH_KEY = "_epoch"
+SIGNAL_PATCH_KEY = "_patch"
+
+# How many patterns a single DBus client can ask to watch.
+MAX_WATCH_PATTERNS = 64
+
 
 class SettingsService(X1PlusDBusService):
     """
@@ -26,6 +61,10 @@ class SettingsService(X1PlusDBusService):
 
       https://github.com/X1Plus/X1Plus/wiki/Developer-Notes:-Configuration-settings
 
+    On disk, settings live in a compact settings.json snapshot, plus a
+    journal of changes that have been committed since (see journal.py); the
+    journal gets folded back into the snapshot in the background.
+
     Never write directly to settings.json while x1plusd is running; x1plusd
     will overwrite your changes!  If you want to modify a setting, use a
     DBus invocation tool (currently, x1plus-test-settings).
@@ -44,30 +83,92 @@ class SettingsService(X1PlusDBusService):
             self.filename = f"{self.settings_dir}/settings.json"
             os.makedirs(self.settings_dir, exist_ok=True)
 
-        # Before we startup, do we have our settings file? Try to read, create if it doesn't exist.
-        try:
-            with open(self.filename, "r") as fh:
-                self.settings = json.load(fh)
-                logger.debug(f"loaded settings with {len(self.settings)} keys")
-        except Exception as e:
-            if isinstance(e, FileNotFoundError):
-                logger.warning("settings file does not exist; creating with defaults...")
-            else:
-                bakfile = f"{self.filename}.bad"
-                logger.error(f"settings file was unreadable ({e}); moving it to {bakfile} and starting from scratch")
-                try:
-                    os.replace(self.filename, bakfile)
-                except Exception as e:
-                    logger.error(f"failed to even move the old file out of the way ({e})!")
-            self.settings = self._migrate_old_settings()
-            self._save()
-        
-        self.settings_callbacks = {}
+        self.journal_filename = f"{os.path.splitext(self.filename)[0]}.journal"
+        self.view_filenames = x1plus.settingsview.view_filenames(self.filename)
+
+        # Before we startup, do we have our settings file? Try to read,
+        # create if it doesn't exist.  Then play back anything that was
+        # committed to the journal since that snapshot was written.
+        self.settings, self._snapshot_data, recovered = self._load_snapshot()
+        self.journal = SettingsJournal(self.journal_filename)
+        if recovered:
+            # The journal was almost certainly written against the
+            # settings.json that we could not read, not the backup.
+            replayed = self.journal.replay(self._snapshot_data, self.settings, "settings were recovered from the backup")
+        else:
+            replayed = self.journal.replay(self._snapshot_data, self.settings)
+        if replayed > 0:
+            logger.debug(f"replayed {replayed} settings journal records")
+        self.journal.open(self._snapshot_data)
+        self._compact_timer = None
+
+        self.settings_callbacks = KeyTrie()
+
+        # DBus clients that have asked to hear only about some keys, by
+        # unique bus name.
+        self._watchers = KeyTrie()
+        self._watch_patterns = {}
+
+        # Every put that changes something bumps the version, and we
+        # remember the version at which each key (including ones that have
+        # since been deleted) last changed, so that clients can ask for just
+        # what changed since the last version they saw.  Versions only mean
+        # anything within one run of x1plusd, which the epoch identifies.
+        self.epoch = uuid.uuid4().hex
+        self.version = 0
+        self._key_versions = {}
+        self._response_cache = {}
+
+        self._commit_pending = []
+        self._commit_task = None
+        self.commit_stats = {
+            "commits": 0,
+            "puts": 0,
+            "last_batch_size": 0,
+            "max_batch_size": 0,
+            "last_latency_ms": 0.0,
+            "max_latency_ms": 0.0,
+            "last_write_ms": 0.0,
+            "compactions": 0,
+        }
 
         super().__init__(
             dbus_interface=SETTINGS_INTERFACE, dbus_path=SETTINGS_PATH, **kwargs
         )
 
+    def _load_snapshot(self):
+        for filename in [self.filename, f"{self.filename}.bak"]:
+            try:
+                with open(filename, "rb") as fh:
+                    data = fh.read()
+                settings = json.loads(data)
+                if not isinstance(settings, dict):
+                    raise ValueError("settings file is not a dict")
+                logger.debug(f"loaded settings from {filename} with {len(settings)} keys")
+                if filename != self.filename:
+                    # Boot scripts only look at settings.json, and give up
+                    # on it entirely if it is not there, so put it back now
+                    # rather than at the next compaction.
+                    logger.warning(f"recovered settings from {filename}; writing them back to {self.filename}")
+                    self._write(self.filename, data)
+                    return settings, data, True
+                return settings, data, False
+            except FileNotFoundError:
+                continue
+            except Exception as e:
+                badfile = f"{filename}.bad"
+                logger.error(f"settings file {filename} was unreadable ({e}); moving it to {badfile}")
+                try:
+                    os.replace(filename, badfile)
+                except Exception as e:
+                    logger.error(f"failed to even move the old file out of the way ({e})!")
+
+        logger.warning("no usable settings file; creating with defaults...")
+        settings = self._migrate_old_settings()
+        data = json.dumps(settings).encode()
+        self._write(self.filename, data)
+        return settings, data, False
+
     def _migrate_old_settings(self):
         """
         Used to migrate init.d flag files to our new json on first run.
@@ -89,37 +190,191 @@ class SettingsService(X1PlusDBusService):
         return defaults
 
     async def task(self):
-        await self.emit_signal("SettingsChanged", self.settings)
-        await super().task()
+        # The views might be missing (first boot after an upgrade), or
+        # stale (someone edited settings.json while we were not running),
+        # so bring them up to date now rather than waiting for a snapshot.
+        # If there is anything in the journal, compacting it writes them
+        # anyway; otherwise the snapshot is what they should say, and they
+        # can be written off the event loop.
+        if self.journal.records > 0:
+            self._schedule_compaction()
+        else:
+            await asyncio.to_thread(self._write_views, self._snapshot_data)
 
-    def _save(self):
-        # TODO: at some point, copy out the old file to .bak, and try
-        # loading the .bak at startup
+        # Tell anyone who was listening to a previous x1plusd that they
+        # need to resync.  They can do it with GetSettingsSince.
+        await self.emit_signal("SettingsChanged", {SIGNAL_EPOCH_KEY: self.epoch, SIGNAL_VERSION_KEY: self.version})
+        await super().task()
 
-        with open(self.filename + ".new", "w") as f:
-            json.dump(self.settings, f, indent=4)
+    def _write(self, filename, data, sync=True):
+        with open(filename + ".new", "wb") as f:
+            f.write(data)
             f.flush()
-            os.fsync(f.fileno())
+            if sync:
+                os.fsync(f.fileno())
+
+        os.replace(filename + ".new", filename)
+
+    def _write_views(self, data):
+        """
+        Write the shell and binary views of the snapshot data (see
+        settingsview.py) that boot scripts use instead of running jq on
+        settings.json.  They get written after the snapshot, so they are
+        never older than it unless somebody else has touched settings.json.
+
+        The views are only a cache of the snapshot, and the boot scripts
+        check them against it with -nt, so they do not need an fsync, and
+        failing to write them is not a failure to save.
+        """
+
+        try:
+            settings = json.loads(data)
+            shell_filename, bin_filename = self.view_filenames
+            self._write(shell_filename, x1plus.settingsview.render_shell(settings), sync=False)
+            self._write(bin_filename, x1plus.settingsview.render_binary(settings), sync=False)
+        except Exception as e:
+            logger.error(f"failed to write settings views: {e}")
+
+    def _compact_sync(self, data):
+        # Keep the previous snapshot around in case the new one somehow
+        # turns out to be unreadable at next boot.  The journal is about to
+        # be reset, so this is only a last resort; it does not need its own
+        # fsync.
+        self._write(f"{self.filename}.bak", self._snapshot_data, sync=False)
+        self._write(self.filename, data)
+
+        # If we die right here, the journal's header no longer matches the
+        # snapshot, so it gets ignored at startup -- which is fine, because
+        # the snapshot already has everything in it.
+        self.journal.reset(data)
+        self._snapshot_data = data
+        self._write_views(data)
+
+    def _schedule_compaction(self):
+        if self._compact_timer is not None:
+            self._compact_timer.cancel()
+        self._compact_timer = asyncio.get_running_loop().call_later(
+            COMPACT_DELAY, lambda: asyncio.create_task(self._background_compact())
+        )
+
+    async def _background_compact(self):
+        try:
+            await self.compact()
+        except Exception as e:
+            # The journal is still intact, so we can try again later.
+            logger.error(f"background settings compaction failed: {e}")
+
+    async def compact(self):
+        """
+        Fold the journal into a new settings.json snapshot, and wait until
+        that is durable.
+        """
+
+        if self._compact_timer is not None:
+            self._compact_timer.cancel()
+            self._compact_timer = None
+        await self._commit({}, snapshot=True)
+
+    async def _commit(self, changes, snapshot=False):
+        """
+        Wait until changes (which have already been applied to
+        self.settings, and are in the form of a journal record) are durable
+        on disk.  Everyone who calls this within COMMIT_WINDOW of each other
+        gets batched into the same write.
+        """
+
+        fut = asyncio.get_running_loop().create_future()
+        self._commit_pending.append((time.monotonic(), fut, changes, snapshot))
+        if self._commit_task is None:
+            self._commit_task = asyncio.create_task(self._commit_writer())
+        await fut
+
+    async def _commit_writer(self):
+        # Only one of these runs at a time, so anybody who shows up while a
+        # write is in progress lands in the next batch.
+        while len(self._commit_pending) > 0:
+            await asyncio.sleep(COMMIT_WINDOW)
+
+            # Everything that has been changed in memory so far has a waiter
+            # in this batch, and vice versa, so serializing right now (on
+            # the event loop, before anyone else can mutate self.settings)
+            # captures exactly this batch.
+            batch = self._commit_pending
+            self._commit_pending = []
+
+            records = [c for _, _, c, _ in batch if len(c) > 0]
+            snapshot = self.journal.records >= COMPACT_RECORDS or self.journal.size >= COMPACT_BYTES
+            snapshot = snapshot or any(snap for _, _, _, snap in batch)
+            snapshot = snapshot or any(
+                k.startswith(SNAPSHOT_KEY_PREFIXES)
+                for c in records
+                for k in c.get(SIGNAL_PATCH_KEY, c)
+            )
+
+            write_start = time.monotonic()
+            try:
+                if snapshot:
+                    await asyncio.to_thread(self._compact_sync, json.dumps(self.settings).encode())
+                    self.commit_stats["compactions"] += 1
+                else:
+                    await asyncio.to_thread(self.journal.append, records)
+                err = None
+            except Exception as e:
+                logger.error(f"failed to save settings: {e}")
+                err = e
+            now = time.monotonic()
+
+            for _, fut, _, _ in batch:
+                if fut.done():
+                    continue
+                if err is None:
+                    fut.set_result(None)
+                else:
+                    fut.set_exception(err)
 
-        os.replace(self.filename + ".new", self.filename)
+            latency_ms = (now - batch[0][0]) * 1000
+            stats = self.commit_stats
+            stats["commits"] += 1
+            stats["puts"] += len(batch)
+            stats["last_batch_size"] = len(batch)
+            stats["max_batch_size"] = max(stats["max_batch_size"], len(batch))
+            stats["last_latency_ms"] = latency_ms
+            stats["max_latency_ms"] = max(stats["max_latency_ms"], latency_ms)
+            stats["last_write_ms"] = (now - write_start) * 1000
+            logger.debug(f"committed {len(batch)} put(s) in {latency_ms:.1f} ms ({stats['last_write_ms']:.1f} ms {'compacting' if snapshot else 'journaling'})")
+
+        self._commit_task = None
+        if self.journal.records > 0:
+            self._schedule_compaction()
 
     def get(self, *args):
         "For internal consumers in x1plusd, returns the value of a setting."
 
         return self.settings.get(*args)
 
-    def on(self, setting, fn):
+    def on(self, pattern, fn):
         """
         For internal consumers in x1plusd, receive a synchronous callback
         when an x1plusd setting changes.  If you need to perform an async
         task, then you will need to spawn it with asyncio.create_task().
+
+        pattern is either an exact key, or a pattern as understood by
+        KeyTrie ("ota.*" for everything under ota., say).  fn is called
+        as fn(key, paths), where paths is None if the whole value was
+        replaced, or the list of JSON Pointers within the value that were
+        touched if it was patched.
         """
         
-        if setting not in self.settings_callbacks:
-            self.settings_callbacks[setting] = []
-        self.settings_callbacks[setting].append(fn)
+        self.settings_callbacks.add(pattern, fn)
 
     async def put_multiple(self, settings_set):
+        # Refuse the whole thing before touching anything, so that a bad key
+        # does not leave the keys before it changed in memory but never
+        # saved or sent out.
+        for k in settings_set:
+            if k.startswith(RESERVED_KEY_PREFIX):
+                raise ValueError(f"setting key {k} is reserved")
+
         settings_updated = {}
         for k, v in settings_set.items():
             if v is None:
@@ -127,34 +382,217 @@ class SettingsService(X1PlusDBusService):
                     del self.settings[k]
                     settings_updated[k] = v
             else:
-                # TODO: this comparison does not make much sense for dicts /
-                # arrays, but at least we fail safe
+                # This is a deep comparison for dicts and arrays, but a
+                # change anywhere in one still means we save and send the
+                # whole thing; use patch() for those.
                 if k not in self.settings or self.settings[k] != v:
                     self.settings[k] = v
                     settings_updated[k] = v
-        self._save()
+
+        if len(settings_updated) > 0:
+            self.version += 1
+            for k in settings_updated:
+                self._key_versions[k] = self.version
+            self._response_cache = {}
+
+            # Once the change is in memory, we have to see it through to
+            # the signal, even if whoever asked for it goes away (say, their
+            # DBus call timed out).
+            await asyncio.shield(self._commit_and_notify(
+                settings_updated, self.version, {k: None for k in settings_updated}
+            ))
+
+        return settings_updated
+
+    async def patch(self, key, ops):
+        """
+        Applies a list of RFC 6902 JSON Patch operations to the value of a
+        single setting (which does not exist, as far as the patch is
+        concerned, if it is null).  Only the patch itself gets journaled and
+        sent out in SettingsChanged.  Returns the list of paths that were
+        changed, or raises JSONPatchError if the patch does not apply.
+        """
+
+        if key.startswith(RESERVED_KEY_PREFIX):
+            raise ValueError(f"setting key {key} is reserved")
+
+        value, paths = apply_patch(self.settings.get(key), ops)
+        if value == self.settings.get(key):
+            return []
+
+        if value is None:
+            del self.settings[key]
+        else:
+            self.settings[key] = value
+        self.version += 1
+        self._key_versions[key] = self.version
+        self._response_cache = {}
+
+        await asyncio.shield(self._commit_and_notify(
+            {SIGNAL_PATCH_KEY: {key: ops}}, self.version, {key: paths}
+        ))
+
+        return paths
+
+    async def _commit_and_notify(self, record, version, changed):
+        """
+        record is what goes in the journal and the signals: either a dict of
+        new values, or a SIGNAL_PATCH_KEY dict of patches.  changed maps
+        each key that changed to the paths that changed within it (or None,
+        if the whole thing did).
+        """
+
+        await self._commit(record)
 
         # Inform everybody locally inside x1plusd who might want to know
         # that a setting has changed.
-        for k in settings_updated.keys():
-            for cb in self.settings_callbacks.get(k, []):
-                cb()
+        for k, paths in changed.items():
+            for cb in self.settings_callbacks.match(k):
+                cb(k, paths)
 
         # Inform everyone else on the system, only *after* we have saved
         # and made it visible.  That way, anybody who wants to know
         # about this setting either will have read it from disk
         # initially, or will have heard about the update from us after
         # they read it.
-        if len(settings_updated) > 0:
-            await self.emit_signal("SettingsChanged", settings_updated)
-        
-        return settings_updated
+        await self.emit_signal("SettingsChanged", {
+            **record,
+            SIGNAL_EPOCH_KEY: self.epoch,
+            SIGNAL_VERSION_KEY: version,
+        })
+
+        # And send everyone who only cares about some keys just those.
+        if len(self._watchers) > 0:
+            watched = {}
+            for k in changed:
+                for name in set(self._watchers.match(k)):
+                    changes = watched.setdefault(name, {})
+                    if SIGNAL_PATCH_KEY in record:
+                        changes.setdefault(SIGNAL_PATCH_KEY, {})[k] = record[SIGNAL_PATCH_KEY][k]
+                    else:
+                        changes[k] = record[k]
+            for name, changes in watched.items():
+                await self.emit_signal("WatchedSettingsChanged", {
+                    **changes,
+                    SIGNAL_EPOCH_KEY: self.epoch,
+                    SIGNAL_VERSION_KEY: version,
+                }, destination=name)
+
+    def _unwatch(self, name):
+        for pattern in self._watch_patterns.pop(name, []):
+            self._watchers.remove(pattern, name)
+
+    async def _reap_watchers(self):
+        "Forget about watchers once they drop off the bus."
+
+        match = MatchRule(
+            type="signal",
+            sender="org.freedesktop.DBus",
+            interface="org.freedesktop.DBus",
+            member="NameOwnerChanged",
+        )
+        with self.router.filter(match, bufsize=0) as queue:
+            await Proxy(message_bus, self.router).AddMatch(match)
+            while True:
+                msg = await queue.get()
+                name, old_owner, new_owner = msg.body
+                if new_owner == "" and name in self._watch_patterns:
+                    logger.debug(f"{name} went away; dropping its settings watches")
+                    self._unwatch(name)
     
     async def put(self, key, value):
         return await self.put_multiple({key: value})
 
+    def _cached_response(self, key, fn):
+        if key not in self._response_cache:
+            self._response_cache[key] = JSONResponse(json.dumps(fn()))
+        return self._response_cache[key]
+
+    def settings_since(self, version):
+        """
+        Returns every setting that has changed after version, with deleted
+        settings as None.
+        """
+
+        return {
+            k: self.settings.get(k)
+            for k, v in self._key_versions.items()
+            if v > version
+        }
+
     async def dbus_GetSettings(self, req):
-        return self.settings
+        return self._cached_response("all", lambda: self.settings)
+
+    async def dbus_GetSettingsSince(self, req):
+        """
+        Takes { "epoch": ..., "version": ... } from a previous response or
+        SettingsChanged signal, and returns only the settings that have
+        changed since then.  If the caller has nothing (req is null), or
+        x1plusd has restarted since, the response has "full": true and
+        contains every setting.
+        """
+
+        version = None
+        if isinstance(req, dict) and req.get("epoch") == self.epoch:
+            version = req.get("version")
+        if not isinstance(version, int) or version > self.version:
+            return self._cached_response("full", lambda: {
+                "epoch": self.epoch,
+                "version": self.version,
+                "full": True,
+                "settings": self.settings,
+            })
+
+        return self._cached_response(version, lambda: {
+            "epoch": self.epoch,
+            "version": self.version,
+            "full": False,
+            "settings": self.settings_since(version),
+        })
+
+    @dbus_method(pass_sender=True)
+    async def dbus_WatchSettings(self, req, sender):
+        """
+        Takes { "patterns": [ ... ] }, and from then on sends the caller a
+        WatchedSettingsChanged signal (addressed only to them) with just the
+        keys that match one of their patterns, whenever any of those change.
+        Each call replaces the caller's previous patterns; an empty list
+        stops the signals.  Version numbers in WatchedSettingsChanged skip
+        over changes that the caller is not watching.
+        """
+
+        patterns = req.get("patterns") if isinstance(req, dict) else None
+        if not isinstance(patterns, list) or not all(isinstance(p, str) and p != "" for p in patterns):
+            return {"status": "error", "reason": "patterns must be a list of strings"}
+        if len(patterns) > MAX_WATCH_PATTERNS:
+            return {"status": "error", "reason": f"at most {MAX_WATCH_PATTERNS} patterns"}
+
+        self._unwatch(sender)
+        if len(patterns) > 0:
+            self._watch_patterns[sender] = patterns
+            for pattern in patterns:
+                self._watchers.add(pattern, sender)
+
+        return {"status": "ok", "epoch": self.epoch, "version": self.version}
+
+    async def dbus_PatchSettings(self, req):
+        """
+        Takes { "key": ..., "patch": [ RFC 6902 operations ] }, and applies
+        the patch to that one setting.
+        """
+
+        if not isinstance(req, dict) or not isinstance(req.get("key"), str):
+            return {"status": "error", "reason": "request must have a key"}
+        if req["key"].startswith(RESERVED_KEY_PREFIX):
+            return {"status": "error", "reason": f"setting key {req['key']} is reserved"}
+
+        try:
+            paths = await self.patch(req["key"], req.get("patch"))
+        except JSONPatchError as e:
+            logger.debug(f"x1p_settings: patch {req} failed: {e}")
+            return {"status": "error", "reason": str(e)}
+
+        return {"status": "ok", "updated": len(paths) > 0, "paths": paths}
 
     async def dbus_PutSettings(self, settings_set):
         if not isinstance(settings_set, dict):
@@ -163,6 +601,12 @@ class SettingsService(X1PlusDBusService):
             )
             return {"status": "error"}
 
+        if any(k.startswith(RESERVED_KEY_PREFIX) for k in settings_set):
+            logger.error(
+                f"x1p_settings: set request {settings_set} contains a reserved key"
+            )
+            return {"status": "error"}
+
         settings_updated = await self.put_multiple(settings_set)
         
         logger.debug(
@@ -1,9 +1,12 @@
 import base64
 import os
+import asyncio
 import subprocess
+import traceback
 
 import x1plus.utils
 from .dbus import *
+from . import process
 
 logger = logging.getLogger(__name__)
 
@@ -11,46 +14,86 @@ CONFIG_DIR = "/config/sshd"
 HOST_KEYFILE = f"{CONFIG_DIR}/dropbear_ecdsa_host_key"
 PIDFILE = "/var/run/x1plus_sshd.pid"
 
+# dropbearkey can take a good long while to come up with a key on the
+# printer.
+KEYGEN_TIMEOUT = 120
+
 class SSHService():
     def __init__(self, settings, **kwargs):
         self.x1psettings = settings
-        self.x1psettings.on("ssh.enabled", lambda: self.sync_startstop())
-        self.x1psettings.on("ssh.root_password", lambda: self.set_password())
-        
-        self.sync_startstop()
-    
-    def sshd_is_running(self):
-        return subprocess.run(f"start-stop-daemon -K -q -t -p \"{PIDFILE}\"", shell=True).returncode == 0
-    
-    def sync_startstop(self):
-        enabled = self.x1psettings.get("ssh.enabled", False)
-        running = self.sshd_is_running()
-        if enabled and not running:
-            self.start_sshd()
-        if not enabled and running:
-            self.stop_sshd()
-    
-    def start_sshd(self):
+        self.lock = asyncio.Lock()
+        self._tasks = set()
+        self.x1psettings.on("ssh.enabled", lambda _key, _paths: self._spawn(self.sync_startstop()))
+        self.x1psettings.on("ssh.root_password", lambda _key, _paths: self._spawn(self.update_password()))
+
+    def _spawn(self, coro):
+        # The event loop only keeps weak references to tasks, so hang on to
+        # them ourselves until they are done.
+        t = asyncio.create_task(coro)
+        self._tasks.add(t)
+        t.add_done_callback(self._task_done)
+
+    def _task_done(self, t):
+        self._tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            e = t.exception()
+            tb = "".join(traceback.format_exception(type(e), e, e.__traceback__))
+            logger.error(f"sshd {t.get_coro().__name__} failed: {e.__class__.__name__}: {e}\n{tb}")
+
+    async def task(self):
+        await self.sync_startstop()
+
+    async def _run(self, args, **kwargs):
+        """
+        process.run(), except that a program that is missing or hangs
+        counts as having failed (which, in emulation, they all are).
+        """
+
+        try:
+            return await process.run(args, **kwargs)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.error(f"failed to run {args[0]}: {e}")
+            return subprocess.CompletedProcess(args, -1, "", "")
+
+    async def sshd_is_running(self):
+        return (await self._run(["start-stop-daemon", "-K", "-q", "-t", "-p", PIDFILE])).returncode == 0
+
+    async def sync_startstop(self):
+        # Settings can change again while we are still busy with the last
+        # change; one at a time, and each time from the latest settings.
+        async with self.lock:
+            enabled = self.x1psettings.get("ssh.enabled", False)
+            running = await self.sshd_is_running()
+            if enabled and not running:
+                await self.start_sshd()
+            if not enabled and running:
+                await self.stop_sshd()
+
+    async def start_sshd(self):
         if not os.path.exists(HOST_KEYFILE):
             logger.info("creating sshd keyfile")
             if not x1plus.utils.is_emulating():
                 os.makedirs(CONFIG_DIR, exist_ok=True)
-                subprocess.run(f"dropbearkey -t ecdsa -f {HOST_KEYFILE}", shell=True)
-        
-        self.set_password()
-        
+                await self._run(["dropbearkey", "-t", "ecdsa", "-f", HOST_KEYFILE], timeout=KEYGEN_TIMEOUT)
+
+        await self.set_password()
+
         logger.info("starting sshd...")
-        rv = subprocess.run(f"start-stop-daemon -S -m -b -p \"{PIDFILE}\" --exec dropbear -- -r \"{HOST_KEYFILE}\" -F -p 22", shell=True).returncode
+        rv = (await self._run(["start-stop-daemon", "-S", "-m", "-b", "-p", PIDFILE, "--exec", "dropbear", "--", "-r", HOST_KEYFILE, "-F", "-p", "22"])).returncode
         if rv != 0:
             logger.error("failed to start sshd!")
-    
-    def stop_sshd(self):
+
+    async def stop_sshd(self):
         logger.info("stopping sshd...")
-        rv = subprocess.run(f"start-stop-daemon -K -q -p \"{PIDFILE}\"", shell=True).returncode
+        rv = (await self._run(["start-stop-daemon", "-K", "-q", "-p", PIDFILE])).returncode
         if rv != 0:
             logger.error("failed to stop sshd!")
-    
-    def set_password(self):
+
+    async def update_password(self):
+        async with self.lock:
+            await self.set_password()
+
+    async def set_password(self):
         pw = self.x1psettings.get('ssh.root_password', None)
         if x1plus.utils.is_emulating():
             logger.info(f"EMULATING: would reset password to {pw}")
@@ -61,7 +104,6 @@ class SSHService():
             if os.path.exists('/config/keys/PUSK'):
                 pw = base64.encodebytes(open('/config/keys/PUSK', 'rb').read())
             else:
-                pw = subprocess.run("/usr/bin/bbl_showpwd 11", shell=True, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
-        r = subprocess.run("passwd root", shell=True, input=f"{pw}\n{pw}\n", capture_output = True, text=True)
+                pw = (await self._run(["/usr/bin/bbl_showpwd", "11"])).stdout
+        r = await self._run(["passwd", "root"], input=f"{pw}\n{pw}\n")
         logger.info(f"reset password: {r}")
-
@@ -0,0 +1,101 @@
+"""
+Startup tracing for x1plusd.
+
+x1plusd is on the boot path (S72x1plusd waits for it before the UI comes
+up), so we keep track of how long each phase of startup takes, log it
+once we are ready to answer on DBus, and complain if that took longer
+than STARTUP_BUDGET_MS.  The trace is also available over DBus from
+x1plus.daemon.GetStartupTrace.
+
+This module is imported before anything else in x1plusd, so that the
+"interpreter" phase covers Python starting up and nothing more.
+"""
+
+import os
+import time
+import logging
+import contextlib
+
+import x1plus.utils
+
+logger = logging.getLogger(__name__)
+
+# From the process being started to being ready on DBus.
+STARTUP_BUDGET_MS = 3000
+
+# S72x1plusd waits for this to show up, which is a lot cheaper than
+# running dbus-send over and over.
+READY_FILE = "/tmp/x1plusd.ready" if x1plus.utils.is_emulating() else "/var/run/x1plusd.ready"
+
+
+def _process_age():
+    "Seconds since this process was started, according to the kernel."
+
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # Skip past the command name, which might have spaces in it;
+            # starttime is field 22 overall.
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except Exception:
+        return 0.0
+
+
+class StartupTrace:
+    def __init__(self, budget_ms=STARTUP_BUDGET_MS):
+        self.budget_ms = budget_ms
+        now = time.monotonic()
+        self._t0 = now - _process_age()
+        self.phases = []
+        self.ready_ms = None
+        self._add("interpreter", self._t0, now)
+
+    def _ms(self, t):
+        return round((t - self._t0) * 1000, 1)
+
+    def _add(self, name, start, end):
+        self.phases.append({
+            "name": name,
+            "start_ms": self._ms(start),
+            "duration_ms": round((end - start) * 1000, 1),
+            "deferred": self.ready_ms is not None,
+        })
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        "Time the body of a with block as a phase of startup."
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._add(name, start, time.monotonic())
+
+    def ready(self):
+        "Call this once x1plusd is answering on DBus."
+
+        self.ready_ms = self._ms(time.monotonic())
+        summary = ", ".join(f"{p['name']} {p['duration_ms']:.0f}" for p in self.phases)
+        if self.ready_ms > self.budget_ms:
+            logger.warning(f"x1plusd took {self.ready_ms:.0f} ms to become ready, over its budget of {self.budget_ms} ms ({summary})")
+        else:
+            logger.info(f"x1plusd ready in {self.ready_ms:.0f} ms ({summary})")
+
+        try:
+            with open(READY_FILE, "w") as f:
+                f.write(f"{self.ready_ms:.0f}\n")
+        except Exception as e:
+            logger.error(f"failed to write {READY_FILE}: {e}")
+
+    def as_dict(self):
+        return {
+            "phases": self.phases,
+            "ready_ms": self.ready_ms,
+            "budget_ms": self.budget_ms,
+            "over_budget": self.ready_ms is not None and self.ready_ms > self.budget_ms,
+        }
+
+
+trace = StartupTrace()
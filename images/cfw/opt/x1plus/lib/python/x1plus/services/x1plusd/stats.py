@@ -0,0 +1,32 @@
+from .dbus import *
+from .instrument import method_latency
+
+logger = logging.getLogger(__name__)
+
+STATS_INTERFACE = "x1plus.stats"
+STATS_PATH = "/x1plus/stats"
+
+
+class StatsService(X1PlusDBusService):
+    """
+    How x1plusd itself is holding up: event loop lag, event loop stalls,
+    and DBus method latency (see instrument.py).
+    """
+
+    def __init__(self, monitor, **kwargs):
+        self.monitor = monitor
+        super().__init__(
+            dbus_interface=STATS_INTERFACE, dbus_path=STATS_PATH, **kwargs
+        )
+
+    async def dbus_GetStats(self, req):
+        return {
+            "loop": self.monitor.as_dict(),
+            "methods": method_latency.as_dict(),
+        }
+
+    async def dbus_GetLoopStats(self, req):
+        return self.monitor.as_dict()
+
+    async def dbus_GetMethodStats(self, req):
+        return method_latency.as_dict()
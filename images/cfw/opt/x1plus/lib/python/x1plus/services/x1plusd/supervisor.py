@@ -0,0 +1,117 @@
+"""
+Keeping x1plusd's long-running tasks alive.
+
+Every subsystem in x1plusd is a coroutine that is meant to run forever on
+the one event loop.  If one of them dies to an exception that nobody saw
+coming, it is much better to log it and start just that subsystem over
+than to take the whole daemon down with it: a Python cold start on the
+printer takes seconds, and in the meantime bbl_screen has nobody to talk
+to on x1plus.x1plusd.
+
+The Supervisor starts each task, and, if it raises, starts it again after
+a delay that doubles with every failure in a row (so that something that
+fails straight away does not spin), up to BACKOFF_MAX.  A task that has
+run for STABLE_TIME without failing gets its delay reset.  A task that
+returns normally is done, and stays done.  How each task is getting on
+is available over DBus from x1plus.daemon.GetTasks.
+"""
+
+import time
+import asyncio
+import traceback
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_MIN = 1.0
+BACKOFF_MAX = 60.0
+STABLE_TIME = 60.0
+
+STATE_RUNNING = "running"
+STATE_BACKOFF = "backoff"
+STATE_FINISHED = "finished"
+STATE_CANCELLED = "cancelled"
+
+
+class SupervisedTask:
+    def __init__(self, name, fn):
+        self.name = name
+        self.fn = fn
+        self.task = None
+        self.state = None
+        self.started = None
+        self.restarts = 0
+        self.failures = 0
+        self.last_error = None
+        self.last_error_time = None
+        self.last_traceback = None
+        self.restart_at = None
+
+    def as_dict(self):
+        return {
+            "state": self.state,
+            "started": self.started,
+            "restarts": self.restarts,
+            "failures": self.failures,
+            "last_error": self.last_error,
+            "last_error_time": self.last_error_time,
+            "last_traceback": self.last_traceback,
+            "restart_at": self.restart_at,
+        }
+
+
+class Supervisor:
+    def __init__(self, backoff_min=BACKOFF_MIN, backoff_max=BACKOFF_MAX, stable_time=STABLE_TIME):
+        self.backoff_min = backoff_min
+        self.backoff_max = backoff_max
+        self.stable_time = stable_time
+        self.tasks = {}
+
+    def start(self, name, fn):
+        """
+        Run fn(), a coroutine function that takes no arguments, as the task
+        called name, and keep it running.
+        """
+
+        if name in self.tasks:
+            raise ValueError(f"there is already a task called {name}")
+        st = SupervisedTask(name, fn)
+        self.tasks[name] = st
+        st.task = asyncio.create_task(self._supervise(st), name=name)
+        return st
+
+    async def _supervise(self, st):
+        delay = self.backoff_min
+        while True:
+            st.state = STATE_RUNNING
+            st.started = time.time()
+            st.restart_at = None
+            t0 = time.monotonic()
+            try:
+                await st.fn()
+            except asyncio.CancelledError:
+                st.state = STATE_CANCELLED
+                raise
+            except Exception as e:
+                st.failures += 1
+                st.last_error = f"{e.__class__.__name__}: {e}"
+                st.last_error_time = time.time()
+                st.last_traceback = traceback.format_exc()
+                logger.error(f"task {st.name} failed: {st.last_error}\n{st.last_traceback}")
+            else:
+                logger.info(f"task {st.name} has finished")
+                st.state = STATE_FINISHED
+                return
+
+            if time.monotonic() - t0 >= self.stable_time:
+                delay = self.backoff_min
+            logger.warning(f"restarting task {st.name} in {delay:.0f} seconds")
+            st.state = STATE_BACKOFF
+            st.restart_at = time.time() + delay
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, self.backoff_max)
+            st.restarts += 1
+
+    def as_dict(self):
+        return {name: st.as_dict() for name, st in self.tasks.items()}
@@ -0,0 +1,162 @@
+"""
+Statistics about OTA downloads, for telling a slow CDN from flaky Wi-Fi
+from a server that just stops talking to us partway through: smoothed
+throughput, an ETA, how long it has been since the last byte arrived, and
+how many times we had to retry.  Once a download is over, a compact record
+of how it went goes into a DownloadHistory, which keeps the last few.
+"""
+
+import os
+import json
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# How often the OTA engine updates the smoothed rate (and tells everyone
+# how the download is going) while a download is running, in seconds.
+TICK_INTERVAL = 1.0
+
+# How much weight each new one-second sample gets in the smoothed rate.
+RATE_SMOOTHING = 0.3
+
+# A connection that goes this long without a single byte gets dropped and
+# resumed, rather than waiting out the 10 second sock_read timeout.
+STALL_TIMEOUT = 4.0
+
+HISTORY_LENGTH = 10
+
+# Each history record has a throughput sample every this many seconds, to
+# start with; once it has HISTORY_MAX_SAMPLES of them, neighbouring pairs
+# get averaged together, and the interval doubles, so that long downloads
+# still fit.
+HISTORY_SAMPLE_SECONDS = 5
+HISTORY_MAX_SAMPLES = 60
+
+
+class Stalled(TimeoutError):
+    "A connection went STALL_TIMEOUT seconds without sending us anything."
+
+
+class DownloadTelemetry:
+    """
+    The statistics for one download.  received() gets called for every
+    chunk, and needs to be cheap; tick() gets called every TICK_INTERVAL,
+    and does the rest of the arithmetic.
+    """
+
+    def __init__(self, name, connections=1):
+        self.name = name
+        self.connections = connections
+        self.started = time.time()
+        self.resumed_from = 0
+        self.bytes = 0
+        self.rate = None
+        self.retries = 0
+        self.stalls = 0
+        self.pauses = 0
+
+        now = time.monotonic()
+        self._t0 = now
+        self.last_byte = now
+        self._tick_at = now
+        self._tick_bytes = 0
+        self._sample_at = now
+        self._sample_bytes = 0
+        self._sample_interval = HISTORY_SAMPLE_SECONDS
+        self._samples = []
+
+    def received(self, nbytes):
+        self.bytes += nbytes
+        self.last_byte = time.monotonic()
+
+    def tick(self):
+        now = time.monotonic()
+        elapsed = now - self._tick_at
+        if elapsed <= 0:
+            return
+        rate = (self.bytes - self._tick_bytes) / elapsed
+        self.rate = rate if self.rate is None else self.rate + RATE_SMOOTHING * (rate - self.rate)
+        self._tick_at = now
+        self._tick_bytes = self.bytes
+
+        if now - self._sample_at >= self._sample_interval:
+            self._samples.append(round((self.bytes - self._sample_bytes) / (now - self._sample_at)))
+            self._sample_at = now
+            self._sample_bytes = self.bytes
+            if len(self._samples) >= HISTORY_MAX_SAMPLES:
+                self._samples = [(a + b) // 2 for a, b in zip(self._samples[0::2], self._samples[1::2])]
+                self._sample_interval *= 2
+
+    def since_last_byte(self):
+        return time.monotonic() - self.last_byte
+
+    def eta(self, done, total):
+        "Seconds until we have all total bytes, or None if we cannot tell."
+
+        if total < 0 or not self.rate:
+            return None
+        return max(0, total - done) / self.rate
+
+    def as_dict(self, done, total, paused=False):
+        since_last_byte = self.since_last_byte()
+        eta = self.eta(done, total)
+        return {
+            "rate": None if self.rate is None else round(self.rate),
+            "eta": None if eta is None else round(eta),
+            "since_last_byte": round(since_last_byte, 1),
+            "stalled": not paused and since_last_byte >= STALL_TIMEOUT,
+            "retries": self.retries,
+            "stalls": self.stalls,
+            "connections": self.connections,
+        }
+
+    def record(self, total, result, error=None):
+        "A compact summary of the download, for the history."
+
+        duration = time.monotonic() - self._t0
+        return {
+            "name": self.name,
+            "started": round(self.started),
+            "duration": round(duration, 1),
+            "result": result,
+            "error": error,
+            "bytes": self.bytes,
+            "resumed_from": self.resumed_from,
+            "bytes_total": total,
+            "rate": round(self.bytes / duration) if duration > 0 else None,
+            "retries": self.retries,
+            "stalls": self.stalls,
+            "pauses": self.pauses,
+            "connections": self.connections,
+            "samples": self._samples,
+            "sample_interval": self._sample_interval,
+        }
+
+
+class DownloadHistory:
+    "The last HISTORY_LENGTH download records, kept in a JSON file."
+
+    def __init__(self, filename):
+        self.filename = filename
+        try:
+            with open(filename, "r") as f:
+                self.records = json.load(f)
+            if not isinstance(self.records, list):
+                raise ValueError("download history is not a list")
+        except FileNotFoundError:
+            self.records = []
+        except Exception as e:
+            logger.warning(f"ignoring unreadable download history {filename}: {e}")
+            self.records = []
+
+    def add(self, record):
+        self.records = (self.records + [record])[-HISTORY_LENGTH:]
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            with open(f"{self.filename}.new", "w") as f:
+                json.dump(self.records, f)
+            os.replace(f"{self.filename}.new", self.filename)
+        except Exception as e:
+            logger.warning(f"failed to save download history {self.filename}: {e}")
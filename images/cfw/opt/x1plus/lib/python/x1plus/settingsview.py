@@ -0,0 +1,243 @@
+"""
+Precomputed, read-only views of the X1Plus settings, for things that need
+to look at settings before x1plusd is up (mostly init scripts during boot,
+when every fork and exec of jq on a slow ARM core adds up).
+
+SettingsService writes two views next to settings.json every time it
+writes the snapshot:
+
+  - settings.sh, which is a shell script that defines a function,
+    x1p_settings_view, that sets X1P_VALUE to the JSON of a setting (or
+    "false" if it is unset, like `jq '.key // false'` would).  functions.sh
+    sources it once per script, and after that, looking up a setting costs
+    no forks at all.  The last line sets X1P_SETTINGS_VIEW=1, so a script
+    that got truncated by a power cut can be told apart from a good one.
+
+  - settings.bin, which is a fixed-layout binary table for anything else
+    that wants to look up a key without parsing JSON:
+
+      header (16 bytes): "X1PV", u16 version, u16 flags, u32 count,
+                         u32 crc32 of everything after the header
+      count entries (16 bytes each), sorted by key:
+                         u32 key offset, u32 value offset, u32 value length,
+                         u16 key length, u8 type, u8 padding
+      a pool of keys and values, which the offsets point into
+
+    Strings are stored as raw UTF-8; numbers and anything more complicated
+    than that are stored as JSON.  Everything is little-endian.
+
+The views are only a cache: if settings.json is newer than a view, someone
+has been editing settings.json by hand (or with jq), and the view should
+be ignored.
+
+Used as a script, this looks up a setting the same way x1p_get_setting
+does:
+
+  python3 -m x1plus.settingsview boot.quick_boot && echo "quick boot"
+"""
+
+import os
+import sys
+import json
+import mmap
+import zlib
+import struct
+import argparse
+
+import x1plus.utils
+
+VIEW_MAGIC = b"X1PV"
+VIEW_VERSION = 1
+
+_HEADER = struct.Struct("<4sHHII")
+_ENTRY = struct.Struct("<IIIHBx")
+
+TYPE_NULL = 0
+TYPE_FALSE = 1
+TYPE_TRUE = 2
+TYPE_NUMBER = 3
+TYPE_STRING = 4
+TYPE_JSON = 5
+
+SHELL_FUNCTION = "x1p_settings_view"
+
+
+def default_settings_filename():
+    "Where SettingsService keeps settings.json on this printer."
+
+    if x1plus.utils.is_emulating():
+        return "/tmp/x1plus-settings.json"
+    return f"/mnt/sdcard/x1plus/printers/{x1plus.utils.serial_number()}/settings.json"
+
+
+def view_filenames(settings_filename):
+    "Returns the (shell, binary) view filenames that go with a settings.json."
+
+    base = os.path.splitext(settings_filename)[0]
+    return f"{base}.sh", f"{base}.bin"
+
+
+def _shell_quote(s):
+    return "'" + s.replace("'", "'\\''") + "'"
+
+
+def render_shell(settings):
+    lines = [
+        "# Generated by x1plusd from settings.json; do not edit (see x1plus/settingsview.py).",
+        f"{SHELL_FUNCTION}() {{",
+        '    case "$1" in',
+    ]
+    for k in sorted(settings):
+        v = settings[k]
+        if v is None:
+            v = False
+        lines.append(f"        {_shell_quote(k)}) X1P_VALUE={_shell_quote(json.dumps(v, separators=(',', ':')))} ;;")
+    lines += [
+        "        *) X1P_VALUE=false ;;",
+        "    esac",
+        "}",
+        "X1P_SETTINGS_VIEW=1",
+        "",
+    ]
+    return "\n".join(lines).encode()
+
+
+def _encode_value(v):
+    if v is None:
+        return TYPE_NULL, b""
+    if v is False:
+        return TYPE_FALSE, b""
+    if v is True:
+        return TYPE_TRUE, b""
+    if isinstance(v, (int, float)):
+        return TYPE_NUMBER, json.dumps(v).encode()
+    if isinstance(v, str):
+        return TYPE_STRING, v.encode()
+    return TYPE_JSON, json.dumps(v, separators=(",", ":")).encode()
+
+
+def _decode_value(typ, data):
+    if typ == TYPE_NULL:
+        return None
+    if typ == TYPE_FALSE:
+        return False
+    if typ == TYPE_TRUE:
+        return True
+    if typ == TYPE_STRING:
+        return data.decode()
+    if typ in (TYPE_NUMBER, TYPE_JSON):
+        return json.loads(data)
+    raise ValueError(f"unknown settings view value type {typ}")
+
+
+def render_binary(settings):
+    items = sorted((k.encode(), _encode_value(v)) for k, v in settings.items())
+
+    pool = bytearray()
+    entries = bytearray()
+    pool_start = _HEADER.size + _ENTRY.size * len(items)
+    for key, (typ, val) in items:
+        key_ofs = pool_start + len(pool)
+        pool += key
+        val_ofs = pool_start + len(pool)
+        pool += val
+        entries += _ENTRY.pack(key_ofs, val_ofs, len(val), len(key), typ)
+
+    body = bytes(entries + pool)
+    return _HEADER.pack(VIEW_MAGIC, VIEW_VERSION, 0, len(items), zlib.crc32(body)) + body
+
+
+class SettingsView:
+    """
+    Reader for settings.bin.  Lookups binary-search the entry table in
+    place, so opening a view does not have to decode all of it.
+    """
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._buf) < _HEADER.size:
+            raise ValueError(f"{filename} is truncated")
+        magic, version, _, self.count, crc = _HEADER.unpack_from(self._buf, 0)
+        if magic != VIEW_MAGIC or version != VIEW_VERSION:
+            raise ValueError(f"{filename} is not a version {VIEW_VERSION} settings view")
+        if zlib.crc32(self._buf[_HEADER.size:]) != crc:
+            raise ValueError(f"{filename} has a bad checksum")
+
+    def _entry(self, i):
+        return _ENTRY.unpack_from(self._buf, _HEADER.size + i * _ENTRY.size)
+
+    def _key(self, entry):
+        key_ofs, _, _, key_len, _ = entry
+        return self._buf[key_ofs:key_ofs + key_len]
+
+    def get(self, key, default=None):
+        key = key.encode()
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry = self._entry(mid)
+            k = self._key(entry)
+            if k == key:
+                _, val_ofs, val_len, _, typ = entry
+                return _decode_value(typ, self._buf[val_ofs:val_ofs + val_len])
+            if k < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return default
+
+    def items(self):
+        for i in range(self.count):
+            entry = self._entry(i)
+            _, val_ofs, val_len, _, typ = entry
+            yield self._key(entry).decode(), _decode_value(typ, self._buf[val_ofs:val_ofs + val_len])
+
+    def close(self):
+        self._buf.close()
+
+
+def lookup(key, settings_filename=None, default=None):
+    """
+    Look up one setting without talking to x1plusd, preferring the binary
+    view if it is up to date, and falling back to parsing settings.json.
+    """
+
+    if settings_filename is None:
+        settings_filename = default_settings_filename()
+    _, bin_filename = view_filenames(settings_filename)
+
+    try:
+        if os.stat(bin_filename).st_mtime >= os.stat(settings_filename).st_mtime:
+            view = SettingsView(bin_filename)
+            try:
+                return view.get(key, default)
+            finally:
+                view.close()
+    except (OSError, ValueError):
+        pass
+
+    try:
+        with open(settings_filename, "r") as f:
+            return json.load(f).get(key, default)
+    except (OSError, ValueError):
+        return default
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Look up an X1Plus setting without asking x1plusd; exits 0 if it is set to something other than false")
+    parser.add_argument("key", help="name of the setting key to look up")
+    parser.add_argument("-f", "--file", help="settings.json to look next to (defaults to the one for this printer)")
+    args = parser.parse_args()
+
+    value = lookup(args.key, args.file, False)
+    if value is False or value is None:
+        sys.exit(1)
+    if value is not True:
+        print(json.dumps(value))
+    sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,222 @@
+"""
+A shared-memory "status board" for state that x1plusd updates often (like
+OTA download progress), so that local readers can look at the current
+value without a DBus round trip, or any syscalls at all once the board is
+mapped.
+
+The board is a fixed-size file in /dev/shm:
+
+  header (64 bytes): "X1PB", u16 version, u16 slot count, u32 slot size,
+                     u32 writer pid, f64 time the board was created
+  slot count slots of slot size bytes each:
+                     u32 sequence, u32 length, u32 crc32 of payload,
+                     u32 reserved, f64 time of last update, 32-byte name,
+                     and then length bytes of JSON payload
+
+Each slot is a seqlock: the writer makes the sequence odd, writes the
+slot, and then makes it even again, and a reader only believes a slot if
+the sequence was the same even number before and after reading it.
+Python gives us no memory barriers, so the payload also carries a CRC;
+a reader that sees a matching sequence but a torn payload just tries
+again.
+
+There is only ever one writer (x1plusd), which owns the whole file, and
+names a slot the first time it publishes to it.  When x1plusd restarts,
+it creates a new board and renames it over the old one; readers notice
+that the file has been replaced the next time they check, which is at
+most every REOPEN_INTERVAL seconds.
+"""
+
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+
+BOARD_MAGIC = b"X1PB"
+BOARD_VERSION = 1
+BOARD_PATH = "/dev/shm/x1plus-status" if os.path.isdir("/dev/shm") else "/tmp/x1plus-status"
+
+DEFAULT_SLOTS = 16
+DEFAULT_SLOT_SIZE = 4096
+
+# How often a reader checks whether x1plusd has replaced the board.
+REOPEN_INTERVAL = 1.0
+
+# How many times a reader retries a slot that is being written to before
+# giving up on it.  If the writer got preempted in the middle of an update,
+# spinning will not help, so every READ_SPINS tries we yield the CPU.
+READ_RETRIES = 1000
+READ_SPINS = 50
+
+_HEADER = struct.Struct("<4sHHIId")
+_HEADER_SIZE = 64
+_SLOT = struct.Struct("<IIIId32s")
+
+
+class StatusBoardWriter:
+    """
+    The x1plusd side of the board.  Not thread-safe; call publish() from
+    the event loop only.
+    """
+
+    def __init__(self, path=BOARD_PATH, slots=DEFAULT_SLOTS, slot_size=DEFAULT_SLOT_SIZE):
+        self.path = path
+        self.slots = slots
+        self.slot_size = slot_size
+        self._index = {}
+
+        size = _HEADER_SIZE + slots * slot_size
+        fd = os.open(f"{path}.new", os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.ftruncate(fd, size)
+            self._buf = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        _HEADER.pack_into(self._buf, 0, BOARD_MAGIC, BOARD_VERSION, slots, slot_size, os.getpid(), time.time())
+        os.replace(f"{path}.new", path)
+
+    def publish(self, name, value):
+        "Replace the value in the slot called name, allocating it if need be."
+
+        data = json.dumps(value, separators=(",", ":")).encode()
+        if len(data) > self.slot_size - _SLOT.size:
+            raise ValueError(f"status board value for {name} is {len(data)} bytes, which does not fit in a slot")
+
+        idx = self._index.get(name)
+        if idx is None:
+            if len(self._index) >= self.slots:
+                raise ValueError(f"status board is full; cannot add {name}")
+            if len(name.encode()) > 32:
+                raise ValueError(f"status board slot name {name} is too long")
+            idx = len(self._index)
+            self._index[name] = idx
+
+        ofs = _HEADER_SIZE + idx * self.slot_size
+        seq = struct.unpack_from("<I", self._buf, ofs)[0]
+        struct.pack_into("<I", self._buf, ofs, (seq + 1) & 0xFFFFFFFF)
+        self._buf[ofs + _SLOT.size:ofs + _SLOT.size + len(data)] = data
+        _SLOT.pack_into(self._buf, ofs, (seq + 1) & 0xFFFFFFFF, len(data), zlib.crc32(data), 0, time.time(), name.encode())
+        struct.pack_into("<I", self._buf, ofs, (seq + 2) & 0xFFFFFFFF)
+
+    def close(self):
+        self._buf.close()
+
+
+class StatusBoardReader:
+    """
+    The reader side of the board.  Opening the board is lazy, and if
+    x1plusd is not running (or has not published anything by that name),
+    lookups just return the default.
+    """
+
+    def __init__(self, path=BOARD_PATH):
+        self.path = path
+        self._buf = None
+        self._ino = None
+        self._checked = 0
+        self._index = {}
+
+    def _open(self):
+        self.close()
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            st = os.fstat(fd)
+            if st.st_size < _HEADER_SIZE:
+                return False
+            buf = mmap.mmap(fd, st.st_size, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+
+        magic, version, slots, slot_size, _, _ = _HEADER.unpack_from(buf, 0)
+        if magic != BOARD_MAGIC or version != BOARD_VERSION or len(buf) < _HEADER_SIZE + slots * slot_size:
+            buf.close()
+            return False
+
+        self._buf = buf
+        self._ino = st.st_ino
+        self.slots = slots
+        self.slot_size = slot_size
+        return True
+
+    def _ensure_open(self):
+        now = time.monotonic()
+        if self._buf is not None and now - self._checked < REOPEN_INTERVAL:
+            return True
+        self._checked = now
+        try:
+            if self._buf is not None and os.stat(self.path).st_ino == self._ino:
+                return True
+        except FileNotFoundError:
+            pass
+        return self._open()
+
+    def _read_slot(self, idx):
+        "Returns (name, payload, updated) for slot idx, or None if it is empty or busy."
+
+        ofs = _HEADER_SIZE + idx * self.slot_size
+        for i in range(READ_RETRIES):
+            if i > 0 and i % READ_SPINS == 0:
+                os.sched_yield()
+            seq, length, crc, _, updated, name = _SLOT.unpack_from(self._buf, ofs)
+            if seq == 0:
+                return None
+            if seq & 1 or length > self.slot_size - _SLOT.size:
+                continue
+            payload = self._buf[ofs + _SLOT.size:ofs + _SLOT.size + length]
+            if struct.unpack_from("<I", self._buf, ofs)[0] == seq and zlib.crc32(payload) == crc:
+                return name.rstrip(b"\0").decode(), payload, updated
+        return None
+
+    def read(self, name):
+        """
+        Returns (value, time of last update) for the slot called name, or
+        None if there is no such slot.
+        """
+
+        if not self._ensure_open():
+            return None
+
+        idx = self._index.get(name)
+        slot = self._read_slot(idx) if idx is not None else None
+        if slot is None or slot[0] != name:
+            slot = None
+            for idx in range(self.slots):
+                s = self._read_slot(idx)
+                if s is None:
+                    continue
+                self._index[s[0]] = idx
+                if s[0] == name:
+                    slot = s
+                    break
+        if slot is None:
+            return None
+
+        _, payload, updated = slot
+        return json.loads(payload), updated
+
+    def get(self, name, default=None):
+        rv = self.read(name)
+        return default if rv is None else rv[0]
+
+    def items(self):
+        "Returns a dict of everything on the board."
+
+        if not self._ensure_open():
+            return {}
+        rv = {}
+        for idx in range(self.slots):
+            s = self._read_slot(idx)
+            if s is not None:
+                self._index[s[0]] = idx
+                rv[s[0]] = json.loads(s[1])
+        return rv
+
+    def close(self):
+        if self._buf is not None:
+            self._buf.close()
+            self._buf = None
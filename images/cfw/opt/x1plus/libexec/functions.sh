@@ -1,10 +1,46 @@
 #!/bin/bash
 
 # Shared x1plus functions for bash scripts
+#
+# These get called a lot during boot, on a slow core, so they try hard not
+# to fork: the serial number is parsed with shell builtins, and settings
+# come from the settings.sh view that x1plusd writes next to settings.json
+# (see /opt/x1plus/lib/python/x1plus/settingsview.py), which only has to
+# be sourced once per script.
+
+X1P_PRINTERS_DIR="${X1P_PRINTERS_DIR:-/mnt/sdcard/x1plus/printers}"
+
+_x1p_find_sn() {
+    # Sets X1P_SN to the device serial number from cmdline, without forking
+    if [ -z "${X1P_SN}" ]; then
+        local cmdline word
+        read -r cmdline < /proc/cmdline
+        for word in ${cmdline}; do
+            case "${word}" in
+                bbl_serial=*) X1P_SN="${word#bbl_serial=}" ;;
+            esac
+        done
+    fi
+}
 
 x1p_sn() {
     # Used to get the device serial number from cmdline
-    echo $(cat /proc/cmdline | xargs -n1 | grep "bbl_serial=" | sed "s|bbl_serial=||")
+    _x1p_find_sn
+    echo "${X1P_SN}"
+}
+
+_x1p_view_lookup() {
+    # Sets X1P_VALUE to the JSON value of setting $1 from the settings view,
+    # sourcing it first if need be.  Returns 1 if there is no usable view
+    # (it is missing, truncated, or older than settings.json, which means
+    # someone edited settings.json by hand), in which case use jq instead.
+    if [ -z "${X1P_SETTINGS_VIEW}" ]; then
+        [ -f "${SETTING_VIEW_FILE}" ] || return 1
+        [ "${SETTING_JSON_FILE}" -nt "${SETTING_VIEW_FILE}" ] && return 1
+        . "${SETTING_VIEW_FILE}"
+        [ -n "${X1P_SETTINGS_VIEW}" ] || return 1
+    fi
+    x1p_settings_view "${1}"
 }
 
 x1p_get_setting() {
@@ -13,13 +49,19 @@ x1p_get_setting() {
     # $2 - optional - flag file check path (legacy, do not use for new settings!)
     # response: exit code 1 on false, exit code 1 on true
 
-    SETTING_JSON_FILE="/mnt/sdcard/x1plus/printers/$(x1p_sn)/settings.json"
-    LEGACY_FLAGFILE_PATH="/mnt/sdcard/x1plus/printers/$(x1p_sn)/"
+    _x1p_find_sn
+    SETTING_JSON_FILE="${X1P_PRINTERS_DIR}/${X1P_SN}/settings.json"
+    SETTING_VIEW_FILE="${X1P_PRINTERS_DIR}/${X1P_SN}/settings.sh"
+    LEGACY_FLAGFILE_PATH="${X1P_PRINTERS_DIR}/${X1P_SN}/"
 
     # First try the settings JSON file if it exists (this is always source of truth if it exists)
     if [ -f "${SETTING_JSON_FILE}" ]; then
-        # Read our JSON file, default to false if unset
-        SETTING_VALUE=$(jq ".\"${1}\" // false" ${SETTING_JSON_FILE})
+        # Read our JSON file (or its view), default to false if unset
+        if _x1p_view_lookup "${1}"; then
+            SETTING_VALUE="${X1P_VALUE}"
+        else
+            SETTING_VALUE=$(jq -c ".\"${1}\" // false" ${SETTING_JSON_FILE})
+        fi
         if [ "${SETTING_VALUE}" == "true" ]; then
             return 0
         elif [ "${SETTING_VALUE}" == "false" ]; then
@@ -40,4 +82,13 @@ x1p_get_setting() {
 
     # We should never get here, if we do, assume false cuz what else can we do? :/
     return 1
-}
\ No newline at end of file
+}
+
+x1p_invalidate_settings_view() {
+    # Call this after changing settings.json behind x1plusd's back, so that
+    # nobody uses the now-stale view.  (settings.json being newer than the
+    # view would catch it too, but not if both land in the same second.)
+    _x1p_find_sn
+    rm -f "${X1P_PRINTERS_DIR}/${X1P_SN}/settings.sh" "${X1P_PRINTERS_DIR}/${X1P_SN}/settings.bin"
+    unset X1P_SETTINGS_VIEW
+}
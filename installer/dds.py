@@ -1,54 +1,591 @@
 import ctypes as c
 import threading
 from queue import Queue
+import collections
+import concurrent.futures
+import asyncio
+import atexit
+import bisect
+import itertools
+import json
+import socket
+import sys
 import time
 import os
 
+# Set X1PLUS_DDS_DEBUG in the environment (or x1plus.dds.debug = True) to
+# print every message that comes in.  It is off by default, because on
+# busy topics (device/report/mc_print, say), printing costs more than
+# everything else in the receive path put together.
+debug = bool(os.environ.get("X1PLUS_DDS_DEBUG"))
+
+# What a Subscription does when its queue is full: throw away the oldest
+# message to make room (so a slow consumer sees the most recent messages,
+# and never holds up anyone else), or wait for the consumer to catch up
+# (which holds up the DDS receive thread, and so every other subscriber,
+# too -- only for consumers that cannot afford to miss anything).
+DROP_OLDEST = "drop_oldest"
+BLOCK = "block"
+
+DEFAULT_MAXSIZE = 256
+
+# Which DDS implementation to use, from X1PLUS_DDS_BACKEND:
+#
+#   native   -- the printer's own libdds_intf.so (the default).
+#   loopback -- a stand-in that only delivers messages within this
+#               process, for testing things off the printer.
+#   udp      -- a stand-in that delivers messages between processes on
+#               the same machine, by UDP multicast to X1PLUS_DDS_UDP_GROUP
+#               on the interface X1PLUS_DDS_UDP_IFACE, so that (say)
+#               gpiokeys can talk to a test harness on a Linux box.
+BACKEND_NATIVE = "native"
+BACKEND_LOOPBACK = "loopback"
+BACKEND_UDP = "udp"
+
+backend = os.environ.get("X1PLUS_DDS_BACKEND", BACKEND_NATIVE)
+
+DEFAULT_UDP_GROUP = "239.255.88.1:7788"
+DEFAULT_UDP_IFACE = "127.0.0.1"
+UDP_MAX_DATAGRAM = 65507
+UDP_RCVBUF = 1024 * 1024
+
+# Every process that uses DDS keeps per-topic statistics on what it sends
+# and receives, and writes them out every STATS_INTERVAL seconds to
+# STATS_DIR/<pid>.json, for `x1plus dds stats` to gather up.  Set
+# X1PLUS_DDS_STATS=0 in the environment to turn that off.
+stats_enabled = os.environ.get("X1PLUS_DDS_STATS", "1") != "0"
+STATS_DIR = "/tmp/x1plus-dds-stats"
+STATS_INTERVAL = 5.0
+
+# Upper bounds of the message size buckets (64 bytes to 64 KB, in powers
+# of two), and of the buckets for the time between messages; anything
+# bigger goes in an overflow bucket.
+SIZE_BUCKETS = [64 << i for i in range(11)]
+INTERVAL_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+
 subscribed = {}
-msgqs = []
 publishers = []
 
+# topic (as bytes, which is what the receive callback gets) -> tuple of
+# Subscriptions.  The tuples get replaced, never changed, so the callback
+# can look a topic up and walk its subscribers without taking a lock.
+subscribers = {}
+subscribers_lock = threading.Lock()
+
+class Subscription(Queue):
+    """
+    A Queue of the JSON strings that arrive on one topic, for one
+    subscriber, holding at most maxsize of them; see DROP_OLDEST and BLOCK
+    for what happens when it fills up.  Also counts how many messages it
+    has been handed (received), how many it threw away (dropped), and the
+    most it has ever had waiting (high_water).
+    """
+
+    def __init__(self, topic, maxsize = DEFAULT_MAXSIZE, policy = DROP_OLDEST):
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError(f"unknown queue policy {policy}")
+        super().__init__(maxsize)
+        self.topic = topic
+        self.policy = policy
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+
+    def offer(self, msg):
+        "Called from the DDS receive thread with each new message."
+        if self.policy == BLOCK:
+            self.put(msg)
+            with self.mutex:
+                self.received += 1
+                self.high_water = max(self.high_water, self._qsize())
+            return
+        with self.mutex:
+            if self.maxsize > 0 and self._qsize() >= self.maxsize:
+                self._get()
+                self.dropped += 1
+            self._put(msg)
+            self.unfinished_tasks += 1
+            self.received += 1
+            self.high_water = max(self.high_water, self._qsize())
+            self.not_empty.notify()
+
+    def stats(self):
+        with self.mutex:
+            return {
+                "topic": self.topic,
+                "policy": self.policy,
+                "maxsize": self.maxsize,
+                "queued": self._qsize(),
+                "received": self.received,
+                "dropped": self.dropped,
+                "high_water": self.high_water,
+            }
+
+class AsyncSubscription:
+    """
+    The asyncio equivalent of a Subscription: an async iterator of the
+    JSON strings that arrive on topic, delivered into the event loop that
+    it was created in, with the same maxsize, policy, and counters.
+
+    Messages that come in while the loop is busy pile up here, and the
+    loop only gets woken up once for the lot of them, rather than once
+    per message.
+    """
+
+    def __init__(self, topic, loop, maxsize = DEFAULT_MAXSIZE, policy = DROP_OLDEST):
+        if policy not in (DROP_OLDEST, BLOCK):
+            raise ValueError(f"unknown queue policy {policy}")
+        self.topic = topic
+        self.loop = loop
+        self.maxsize = maxsize
+        self.policy = policy
+        self.received = 0
+        self.dropped = 0
+        self.high_water = 0
+        self._pending = collections.deque()
+        self._cond = threading.Condition()
+        self._wake_scheduled = False
+        self._ready = asyncio.Event()
+        self._closed = False
+
+    def offer(self, msg):
+        "Called from the DDS receive thread with each new message."
+        with self._cond:
+            if self._closed:
+                return
+            if self.maxsize > 0:
+                if self.policy == BLOCK:
+                    while len(self._pending) >= self.maxsize and not self._closed:
+                        self._cond.wait()
+                elif len(self._pending) >= self.maxsize:
+                    self._pending.popleft()
+                    self.dropped += 1
+            self._pending.append(msg)
+            self.received += 1
+            self.high_water = max(self.high_water, len(self._pending))
+            if self._wake_scheduled:
+                return
+            self._wake_scheduled = True
+        try:
+            self.loop.call_soon_threadsafe(self._wake)
+        except RuntimeError:
+            # The loop is closed; nobody is listening any more.
+            pass
+
+    def _wake(self):
+        with self._cond:
+            self._wake_scheduled = False
+        self._ready.set()
+
+    def get_nowait(self):
+        "Returns the next message, or None if there is not one waiting."
+        with self._cond:
+            if not self._pending:
+                return None
+            self._cond.notify()
+            return self._pending.popleft()
+
+    async def get(self):
+        """
+        Returns the next message, waiting for one if need be.  Once the
+        subscription has been closed and everything that came in before
+        that has been got, raises StopAsyncIteration.
+        """
+        while True:
+            with self._cond:
+                if self._pending:
+                    self._cond.notify()
+                    return self._pending.popleft()
+                if self._closed:
+                    raise StopAsyncIteration
+                self._ready.clear()
+            await self._ready.wait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.get()
+
+    def close(self):
+        "Stop getting messages (and let go of a blocked receive thread)."
+        unsubscribe(self)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        # Wake up anyone waiting in get(), so that they find out.
+        try:
+            self.loop.call_soon_threadsafe(self._ready.set)
+        except RuntimeError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def stats(self):
+        with self._cond:
+            return {
+                "topic": self.topic,
+                "policy": self.policy,
+                "maxsize": self.maxsize,
+                "queued": len(self._pending),
+                "received": self.received,
+                "dropped": self.dropped,
+                "high_water": self.high_water,
+            }
+
+class TopicStats:
+    """
+    What has gone by on one topic, in one direction, in this process: how
+    many messages, how big, how far apart, and how long we spent on them
+    (handing them to subscribers, or to DDS to send).
+
+    add() is on the receive path for every message, so it does not take a
+    lock; if two threads publish on the same topic at the same moment, an
+    update might go missing, which is close enough for statistics.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.sizes = [0] * (len(SIZE_BUCKETS) + 1)
+        self.intervals = [0] * (len(INTERVAL_BUCKETS_MS) + 1)
+        self.last = None
+        self.min_interval = None
+        self.max_interval = None
+        self.snapshot = (0, 0, 0.0)
+
+    def add(self, nbytes, now, seconds):
+        self.count += 1
+        self.bytes += nbytes
+        self.seconds += seconds
+        # SIZE_BUCKETS are powers of two, so there is no need to search.
+        self.sizes[min(max(0, (nbytes - 1).bit_length() - 6), len(SIZE_BUCKETS))] += 1
+        last, self.last = self.last, now
+        if last is not None:
+            gap = now - last
+            self.intervals[bisect.bisect_left(INTERVAL_BUCKETS_MS, gap * 1000)] += 1
+            if self.min_interval is None or gap < self.min_interval:
+                self.min_interval = gap
+            if self.max_interval is None or gap > self.max_interval:
+                self.max_interval = gap
+
+    def as_dict(self, elapsed):
+        """
+        Also works out the rates since the last call, elapsed seconds ago,
+        so this is only for the stats writer to call.
+        """
+        count, nbytes, seconds = self.snapshot
+        self.snapshot = (self.count, self.bytes, self.seconds)
+        return {
+            "count": self.count,
+            "bytes": self.bytes,
+            "seconds": self.seconds,
+            "rate": (self.count - count) / elapsed if elapsed > 0 else None,
+            "byte_rate": (self.bytes - nbytes) / elapsed if elapsed > 0 else None,
+            "load": (self.seconds - seconds) / elapsed if elapsed > 0 else None,
+            "sizes": list(self.sizes),
+            "intervals": list(self.intervals),
+            "min_interval": self.min_interval,
+            "max_interval": self.max_interval,
+        }
+
+# topic (as bytes) -> TopicStats, for messages received and sent.
+rx_stats = {}
+tx_stats = {}
+_stats_lock = threading.Lock()
+_stats_thread = None
+
+def _topic_stats(table, topic):
+    stats = table.get(topic)
+    if stats is None:
+        with _stats_lock:
+            stats = table.setdefault(topic, TopicStats())
+    return stats
+
+def stats_snapshot(elapsed = 0):
+    "Everything that goes in this process's stats file."
+    return {
+        "pid": os.getpid(),
+        "argv": sys.argv,
+        "backend": backend,
+        "time": time.time(),
+        "interval": elapsed,
+        "topics": {
+            "rx": {t.decode(): s.as_dict(elapsed) for t, s in list(rx_stats.items())},
+            "tx": {t.decode(): s.as_dict(elapsed) for t, s in list(tx_stats.items())},
+        },
+        "subscribers": subscriber_stats(),
+    }
+
+def _write_stats(elapsed):
+    path = os.path.join(STATS_DIR, f"{os.getpid()}.json")
+    os.makedirs(STATS_DIR, exist_ok = True)
+    with open(f"{path}.new", "w") as f:
+        json.dump(stats_snapshot(elapsed), f)
+    os.replace(f"{path}.new", path)
+
+def _stats_writer():
+    global stats_enabled
+    last = time.monotonic()
+    while stats_enabled:
+        time.sleep(STATS_INTERVAL)
+        now = time.monotonic()
+        try:
+            _write_stats(now - last)
+        except Exception as e:
+            print(f"not writing DDS stats any more: {e}")
+            stats_enabled = False
+        last = now
+
+def _start_stats():
+    global _stats_thread
+    if not stats_enabled:
+        return
+    with _stats_lock:
+        if _stats_thread is None:
+            _stats_thread = threading.Thread(target = _stats_writer, name = "dds-stats", daemon = True)
+            _stats_thread.start()
+            atexit.register(_remove_stats)
+
+def _remove_stats():
+    try:
+        os.unlink(os.path.join(STATS_DIR, f"{os.getpid()}.json"))
+    except OSError:
+        pass
+
 @c.CFUNCTYPE(None, c.c_char_p, c.c_char_p)
 def data_available_cb(topic, json):
-    global msgqs
-    print(f"DDS RX: {topic} <- {json}")
-    for (t,q,) in msgqs:
-        if t == topic.decode():
-            q.put(json.decode())
+    if debug:
+        print(f"DDS RX: {topic} <- {json}")
+    t0 = time.perf_counter()
+    subs = subscribers.get(topic)
+    if subs:
+        msg = json.decode()
+        for q in subs:
+            q.offer(msg)
+    if stats_enabled:
+        stats = rx_stats.get(topic) or _topic_stats(rx_stats, topic)
+        stats.add(len(json), t0, time.perf_counter() - t0)
 
 @c.CFUNCTYPE(None, c.c_char_p, c.c_int)
 def sub_matched_cb(topic, change):
-    print("sub matched", topic, change)
+    if debug:
+        print("sub matched", topic, change)
 
 @c.CFUNCTYPE(None, c.c_char_p, c.c_int)
 def pub_matched_cb(topic, change):
-    print("pub matched", topic, change)
+    if debug:
+        print("pub matched", topic, change)
 
-dds_intf = c.CDLL(os.path.join(os.path.dirname(__file__), "libdds_intf.so"))
-dds_intf.initDDS(3)
+def _bytes(s):
+    return s.value if isinstance(s, c.c_char_p) else s
+
+class LoopbackDDS:
+    """
+    A stand-in for libdds_intf.so, with the same createJSONSubscriber,
+    createJSONPublisher, and publishJSON, for the loopback backend.  Like
+    the real thing, it calls subscribers' callbacks from a thread of its
+    own, rather than from whoever published the message.  (It never calls
+    the matched callbacks, since there is nobody else to match with.)
+    """
+
+    def __init__(self):
+        self.callbacks = {}
+        self.topics = {}
+        self.handles = itertools.count(1)
+        self.lock = threading.Lock()
+        self.thread = None
+        self.queue = Queue()
+
+    def initDDS(self, _domain):
+        self.thread = threading.Thread(target = self._receive, name = "dds-loopback", daemon = True)
+        self.thread.start()
+
+    def createJSONSubscriber(self, topic, data_cb, matched_cb):
+        with self.lock:
+            self.callbacks[_bytes(topic)] = self.callbacks.get(_bytes(topic), ()) + (data_cb,)
+        return next(self.handles)
+
+    def createJSONPublisher(self, topic, matched_cb):
+        handle = next(self.handles)
+        self.topics[handle] = _bytes(topic)
+        return handle
+
+    def publishJSON(self, handle, json):
+        self._send(self.topics[handle], _bytes(json))
+        return 0
+
+    def _send(self, topic, json):
+        self.queue.put((topic, json))
+
+    def _deliver(self, topic, json):
+        for cb in self.callbacks.get(topic, ()):
+            cb(topic, json)
+
+    def _receive(self):
+        while True:
+            self._deliver(*self.queue.get())
+
+class UDPDDS(LoopbackDDS):
+    """
+    The udp backend: the same as LoopbackDDS, except that messages go by
+    way of a multicast group (one datagram each, with the topic and the
+    JSON separated by a NUL), so every process using the udp backend on
+    the same group sees everyone's messages, including its own.  Messages
+    too big for a datagram are dropped (and counted in oversize_drops).
+    """
+
+    def __init__(self, group = None, iface = None):
+        super().__init__()
+        host, port = (group or os.environ.get("X1PLUS_DDS_UDP_GROUP", DEFAULT_UDP_GROUP)).rsplit(":", 1)
+        self.group = (host, int(port))
+        self.iface = iface or os.environ.get("X1PLUS_DDS_UDP_IFACE", DEFAULT_UDP_IFACE)
+        self.oversize_drops = 0
 
-dds_intf.createJSONSubscriber.restype = c.c_void_p
-dds_intf.createJSONPublisher.restype = c.c_void_p
+        self.tx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # Stay on this machine unless asked to go somewhere else.
+        self.tx.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 0 if self.iface == DEFAULT_UDP_IFACE else 1)
+        self.tx.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+        self.tx.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(self.iface))
 
-def subscribe(topic):
-    if topic not in subscribed:
-        p = dds_intf.createJSONSubscriber(c.c_char_p(topic.encode()), data_available_cb, sub_matched_cb)
-        if p is not None:
-            subscribed[topic] = p
-    q = Queue()
-    msgqs.append((topic, q,))
+        self.rx = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.rx.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        # Room for a good burst of messages while our thread is busy.
+        self.rx.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, UDP_RCVBUF)
+        self.rx.bind(("", self.group[1]))
+        self.rx.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, socket.inet_aton(host) + socket.inet_aton(self.iface))
+
+    def _send(self, topic, json):
+        datagram = topic + b"\0" + json
+        if len(datagram) > UDP_MAX_DATAGRAM:
+            self.oversize_drops += 1
+            return
+        self.tx.sendto(datagram, self.group)
+
+    def _receive(self):
+        while True:
+            datagram = self.rx.recv(UDP_MAX_DATAGRAM)
+            topic, sep, json = datagram.partition(b"\0")
+            if sep:
+                self._deliver(topic, json)
+
+if backend == BACKEND_NATIVE:
+    dds_intf = c.CDLL(os.path.join(os.path.dirname(__file__), "libdds_intf.so"))
+    dds_intf.createJSONSubscriber.restype = c.c_void_p
+    dds_intf.createJSONPublisher.restype = c.c_void_p
+elif backend == BACKEND_LOOPBACK:
+    dds_intf = LoopbackDDS()
+elif backend == BACKEND_UDP:
+    dds_intf = UDPDDS()
+else:
+    raise ImportError(f"unknown X1PLUS_DDS_BACKEND {backend}")
+dds_intf.initDDS(3)
+
+def attach(q):
+    """
+    Start handing messages on q.topic to q.offer(), from the DDS receive
+    thread, until unsubscribe(q).  subscribe() and subscribe_async() are
+    built on this; anything else with a topic and an offer(msg) (say, a
+    recorder) can use it too, as long as offer() is quick about it.
+    """
+    _start_stats()
+    key = q.topic.encode()
+    with subscribers_lock:
+        subscribers[key] = subscribers.get(key, ()) + (q,)
+        if q.topic not in subscribed:
+            p = dds_intf.createJSONSubscriber(c.c_char_p(key), data_available_cb, sub_matched_cb)
+            if p is not None:
+                subscribed[q.topic] = p
     return q
 
-def publisher(topic):
+def subscribe(topic, maxsize = DEFAULT_MAXSIZE, policy = DROP_OLDEST):
+    """
+    Returns a Subscription (a Queue) that gets every message on topic from
+    now on, as a JSON string; see Subscription for what maxsize and policy
+    do.
+    """
+    _keep_alive()
+    return attach(Subscription(topic, maxsize, policy))
+
+def subscribe_async(topic, maxsize = DEFAULT_MAXSIZE, policy = DROP_OLDEST):
+    """
+    Returns an AsyncSubscription that delivers every message on topic from
+    now on into the running event loop:
+
+        with x1plus.dds.subscribe_async("device/report/print") as sub:
+            async for msg in sub:
+                ...
+    """
+    return attach(AsyncSubscription(topic, asyncio.get_running_loop(), maxsize, policy))
+
+def unsubscribe(q):
+    "Stop delivering messages to q, from subscribe() or attach()."
+    key = q.topic.encode()
+    with subscribers_lock:
+        subscribers[key] = tuple(s for s in subscribers.get(key, ()) if s is not q)
+
+def subscriber_stats():
+    "Subscription.stats() for every current subscriber."
+    return [q.stats() for subs in list(subscribers.values()) for q in subs]
+
+def _publish_fn(topic):
+    _start_stats()
     p = dds_intf.createJSONPublisher(c.c_char_p(topic.encode()), pub_matched_cb)
     publishers.append(p)
-    return lambda json: dds_intf.publishJSON(p, c.c_char_p(json.encode()))
+    stats = _topic_stats(tx_stats, topic.encode())
+    def publish(json):
+        data = json.encode()
+        t0 = time.perf_counter()
+        rv = dds_intf.publishJSON(p, c.c_char_p(data))
+        if stats_enabled:
+            stats.add(len(data), t0, time.perf_counter() - t0)
+        return rv
+    return publish
+
+def publisher(topic):
+    _keep_alive()
+    return _publish_fn(topic)
+
+# publishJSON can block (if the reader on the other end is slow to
+# acknowledge), so async publishers hand it off to this, which has just the
+# one thread so that messages go out in the order that they were sent.
+_publish_executor = None
 
+def publisher_async(topic):
+    """
+    Like publisher(), but returns a coroutine function, which returns once
+    the message has been handed to DDS, without holding up the event loop
+    in the meantime.
+    """
+    global _publish_executor
+    if _publish_executor is None:
+        _publish_executor = concurrent.futures.ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "dds-publish")
+    publish_now = _publish_fn(topic)
+    async def publish(json):
+        return await asyncio.get_running_loop().run_in_executor(_publish_executor, publish_now, json)
+    return publish
+
+# Scripts that use the thread-based API above get a non-daemon thread that
+# keeps the process alive until they call shutdown(); asyncio users have
+# their event loop for that, so they do not get one.
 shutdownq = Queue() # if all you have is a hammer...
 def sleep_in_background():
     shutdownq.get()
-t1 = threading.Thread(target = sleep_in_background)
-t1.start()
+t1 = None
+_t1_lock = threading.Lock()
+
+def _keep_alive():
+    global t1
+    with _t1_lock:
+        if t1 is None:
+            t1 = threading.Thread(target = sleep_in_background)
+            t1.start()
 
 def shutdown():
 #    print("cleaning up subscribers...")
@@ -62,7 +599,7 @@ def shutdown():
 #        dds_intf.deleteJSONPublisher(pub)
 #    print("shutting down DDS")
 #    dds_intf.stopDDS()
-    print("shutting down Python DDS thread")
+    print("shutting down Python DDS thread", file=sys.stderr)
     shutdownq.put(True)
 
 
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+# Benchmark for the OTA engine's downloader.
+#
+# Serves a file of random data from scripts/ota_stand_in_server.py with a
+# per-connection rate limit (like the CDN that the base firmware comes
+# from), and then has an OTAService download it with one connection, and
+# with each of the given numbers of segmented connections, printing how
+# long each one took.  --drop-every makes the server drop connections too,
+# to see what that costs, and --no-range makes it ignore Range requests, so
+# that the segmented downloads have to fall back to one connection.
+#
+# Run it on a development machine with:
+#
+#   dbus-run-session -- scripts/bench_ota_download.py [--size MB] [--rate KB/s] [--connections 2 4 8]
+
+import os
+import sys
+import time
+import signal
+import socket
+import asyncio
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+ROOTPATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, f"{ROOTPATH}/images/cfw/opt/x1plus/lib/python")
+sys.path.insert(0, f"{ROOTPATH}/images/site-packages")
+
+from x1plus.services.x1plusd.dbus import *
+from x1plus.services.x1plusd.ota import OTAService
+
+
+class BenchSettings(dict):
+    "Just enough of SettingsService for OTAService."
+
+    def on(self, key, cb):
+        pass
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("stand-in server did not start")
+
+
+async def bench(args, scratch, url, md5):
+    router = await get_dbus_router()
+    async with router:
+        settings = BenchSettings()
+        svc = OTAService(settings=settings, router=router)
+        svc.hashcache.filename = os.path.join(scratch, "ota_hashes.json")
+
+        for connections in [1] + args.connections:
+            settings["ota.download_connections"] = connections
+            dest = os.path.join(scratch, "out", f"download.{connections}")
+            t0 = time.monotonic()
+            await svc._download_file(url, dest, md5)
+            elapsed = time.monotonic() - t0
+            print(f"{connections} connection(s): {elapsed:.2f} s, {args.size / elapsed:.2f} MB/s")
+            os.unlink(dest)
+    await router._conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark single-stream and segmented OTA downloads against a throttled server")
+    parser.add_argument("--size", type=int, default=32, help="size of the file to download, in MB")
+    parser.add_argument("--rate", type=int, default=2048, help="per-connection rate limit, in KB/s")
+    parser.add_argument("--connections", type=int, nargs="*", default=[2, 4, 8], help="numbers of connections to try segmented downloads with")
+    parser.add_argument("--drop-every", type=int, default=0, metavar="N", help="have the server drop connections after every N bytes")
+    parser.add_argument("--no-range", action="store_true", help="have the server ignore Range requests, to check the fallback")
+    parser.add_argument("--port", type=int, default=8001)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scratch:
+        data = os.urandom(args.size * 1024 * 1024)
+        path = os.path.join(scratch, "payload.bin")
+        with open(path, "wb") as f:
+            f.write(data)
+        md5 = hashlib.md5(data).hexdigest()
+
+        server = subprocess.Popen([
+            sys.executable, f"{ROOTPATH}/scripts/ota_stand_in_server.py",
+            "--base", path, "--port", str(args.port),
+            "--rate", str(args.rate * 1024), "--drop-every", str(args.drop_every),
+        ] + (["--no-range"] if args.no_range else []))
+        try:
+            wait_for_port(args.port)
+            asyncio.run(bench(args, scratch, f"http://127.0.0.1:{args.port}/payload.bin", md5))
+        finally:
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+#!/bin/bash
+
+# Benchmark for boot-time settings lookups in init scripts.
+#
+# Each init script that reads a setting used to find the serial number with
+# a cat | xargs | grep | sed pipeline, and then run jq on settings.json,
+# every time it called x1p_get_setting.  Now functions.sh parses the serial
+# with builtins and sources the settings.sh view that x1plusd writes.  This
+# runs a pretend init script (source functions.sh, look up a few boot.*
+# settings) many times each way, in a scratch printer directory, and prints
+# how long each one took.
+#
+# Run it from the root of the tree with:
+#
+#   scripts/bench_settings_view.sh [iterations]
+#
+# The init scripts are run with $SH (bash by default; busybox sh, like the
+# printer has, also works, but dash does not understand the == in
+# functions.sh).
+
+set -e
+
+ROOTPATH="$(cd "$(dirname "$0")/.." && pwd)"
+ITERATIONS="${1:-200}"
+SH="${SH:-bash}"
+SCRATCH="$(mktemp -d)"
+trap 'rm -rf "${SCRATCH}"' EXIT
+
+export X1P_PRINTERS_DIR="${SCRATCH}/printers"
+SN="$(cat /proc/cmdline | xargs -n1 | grep "bbl_serial=" | sed "s|bbl_serial=||")"
+SN="${SN:-00M00A000000000}"
+mkdir -p "${X1P_PRINTERS_DIR}/${SN}"
+
+PYTHONPATH="${ROOTPATH}/images/cfw/opt/x1plus/lib/python" python3 - "${X1P_PRINTERS_DIR}/${SN}/settings.json" <<'EOF'
+import sys, json
+import x1plus.settingsview as sv
+
+settings = { f"ota.option{i}": i for i in range(40) }
+settings.update({ "boot.sdcard_syslog": True, "boot.perf_log": False, "boot.dump_emmc": False, "boot.wifi_driver.bcmdhd": False })
+with open(sys.argv[1], "w") as f:
+    json.dump(settings, f)
+shell_filename, bin_filename = sv.view_filenames(sys.argv[1])
+with open(shell_filename, "wb") as f:
+    f.write(sv.render_shell(settings))
+with open(bin_filename, "wb") as f:
+    f.write(sv.render_binary(settings))
+EOF
+
+cat > "${SCRATCH}/old.sh" <<EOF
+x1p_sn() {
+    echo \$(cat /proc/cmdline | xargs -n1 | grep "bbl_serial=" | sed "s|bbl_serial=||")
+}
+x1p_get_setting() {
+    SETTING_JSON_FILE="${X1P_PRINTERS_DIR}/\$(x1p_sn)/settings.json"
+    [ -f "\${SETTING_JSON_FILE}" ] || SETTING_JSON_FILE="${X1P_PRINTERS_DIR}/${SN}/settings.json"
+    SETTING_VALUE=\$(jq ".\"\${1}\" // false" \${SETTING_JSON_FILE})
+    [ "\${SETTING_VALUE}" == "true" ]
+}
+x1p_get_setting boot.sdcard_syslog
+x1p_get_setting boot.perf_log
+x1p_get_setting boot.dump_emmc
+x1p_get_setting boot.wifi_driver.bcmdhd
+true
+EOF
+
+cat > "${SCRATCH}/new.sh" <<EOF
+X1P_SN="${SN}"
+. "${ROOTPATH}/images/cfw/opt/x1plus/libexec/functions.sh"
+x1p_get_setting boot.sdcard_syslog
+x1p_get_setting boot.perf_log
+x1p_get_setting boot.dump_emmc
+x1p_get_setting boot.wifi_driver.bcmdhd
+true
+EOF
+
+# Make sure the two agree before timing anything.
+for k in boot.sdcard_syslog boot.perf_log boot.dump_emmc boot.wifi_driver.bcmdhd ota.option3 nonexistent; do
+    OLD=$(jq -c ".\"${k}\" // false" "${X1P_PRINTERS_DIR}/${SN}/settings.json")
+    NEW=$(X1P_SN="${SN}"; . "${ROOTPATH}/images/cfw/opt/x1plus/libexec/functions.sh"; x1p_get_setting "${k}" && echo "${SETTING_VALUE}" || echo "${SETTING_VALUE}")
+    NEW=$(echo "${NEW}" | tail -1)
+    if [ "${OLD}" != "${NEW}" ]; then
+        echo "mismatch for ${k}: jq says ${OLD}, view says ${NEW}" >&2
+        exit 1
+    fi
+done
+
+bench() {
+    local start end
+    start=$(date +%s%N)
+    for i in $(seq "${ITERATIONS}"); do
+        ${SH} "${SCRATCH}/$1.sh" > /dev/null
+    done
+    end=$(date +%s%N)
+    echo "$1: $(( (end - start) / ITERATIONS / 1000 )) us per init script (4 lookups each)"
+}
+
+bench old
+bench new
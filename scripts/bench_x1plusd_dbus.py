@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+# Benchmark for x1plusd DBus method dispatch.
+#
+# Stands up an X1PlusDBusService on the session bus with a GetStatus, a
+# GetSettings, and a deliberately slow method, then measures how long the
+# fast calls take while the slow one is in flight.  It runs once with
+# max_inflight=1 (which is equivalent to the old handle-each-call-inline
+# dispatcher) and once with the default concurrent dispatcher.
+#
+# Run it on a development machine with:
+#
+#   dbus-run-session -- scripts/bench_x1plusd_dbus.py
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import statistics
+
+ROOTPATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, f"{ROOTPATH}/images/cfw/opt/x1plus/lib/python")
+sys.path.insert(0, f"{ROOTPATH}/images/site-packages")
+
+from jeepney import DBusAddress, new_method_call, MessageType
+from jeepney.io.asyncio import open_dbus_connection, DBusRouter
+from x1plus.services.x1plusd.dbus import *
+
+BENCH_INTERFACE = "x1plus.bench"
+BENCH_PATH = "/x1plus/bench"
+
+
+class BenchService(X1PlusDBusService):
+    def __init__(self, slow_seconds, **kwargs):
+        self.slow_seconds = slow_seconds
+        self.settings = {f"bench.key{i}": i for i in range(100)}
+        super().__init__(dbus_interface=BENCH_INTERFACE, dbus_path=BENCH_PATH, **kwargs)
+
+    async def dbus_GetStatus(self, req):
+        return {"status": "IDLE", "download": {"bytes": 0, "bytes_total": 0}}
+
+    async def dbus_GetSettings(self, req):
+        return self.settings
+
+    async def dbus_Slow(self, req):
+        await asyncio.sleep(self.slow_seconds)
+        return {"status": "ok"}
+
+
+async def call(router, method, param=None):
+    addr = DBusAddress(BENCH_PATH, bus_name=BUS_NAME, interface=BENCH_INTERFACE)
+    reply = await router.send_and_get_reply(new_method_call(addr, method, "s", (json.dumps(param),)))
+    if reply.header.message_type == MessageType.error:
+        raise RuntimeError(reply.body)
+    return json.loads(reply.body[0])
+
+
+async def run(max_inflight, args):
+    router = await get_dbus_router()
+    client = DBusRouter(await open_dbus_connection("SESSION"))
+    async with router, client:
+        await bench(router, client, max_inflight, args)
+    await router._conn.close()
+    await client._conn.close()
+
+
+async def bench(router, client, max_inflight, args):
+    svc = BenchService(slow_seconds=args.slow, router=router, max_inflight=max_inflight)
+    svc_task = asyncio.create_task(svc.task())
+    await asyncio.sleep(0.1)
+
+    slow = asyncio.create_task(call(client, "Slow"))
+    await asyncio.sleep(0.05)
+
+    latencies = []
+
+    async def one(method):
+        t0 = time.monotonic()
+        await call(client, method)
+        latencies.append(time.monotonic() - t0)
+
+    t0 = time.monotonic()
+    await asyncio.gather(*[one(m) for _ in range(args.calls) for m in ("GetStatus", "GetSettings")])
+    wall = time.monotonic() - t0
+    await slow
+
+    svc_task.cancel()
+
+    latencies.sort()
+    print(f"max_inflight={max_inflight}: {len(latencies)} calls in {wall * 1000:.1f} ms; "
+          f"p50 {statistics.median(latencies) * 1000:.1f} ms, "
+          f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.1f} ms, "
+          f"max {latencies[-1] * 1000:.1f} ms")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark x1plusd DBus dispatch with a slow handler in flight")
+    parser.add_argument("--calls", type=int, default=200, help="number of GetStatus/GetSettings pairs to issue")
+    parser.add_argument("--slow", type=float, default=2.0, help="seconds that the slow handler takes")
+    args = parser.parse_args()
+
+    await run(1, args)
+    await run(DEFAULT_MAX_INFLIGHT, args)
+
+
+asyncio.run(main())
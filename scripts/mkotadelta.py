@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Generate xdelta3 patches from older .x1p files to a new one, and add them
+# to the ota.json that scripts/mkotajson.py made for the new one, so that
+# printers running one of the older versions can download just the patch.
+#
+#   scripts/mkotadelta.py NEW.x1p ota.json OLD.x1p [OLD.x1p ...]
+#
+# Each patch is written next to NEW.x1p as OLDVERSION-NEWVERSION.x1p.xdelta,
+# and needs to be uploaded to the same place as NEW.x1p.  A patch that
+# does not save much over just downloading NEW.x1p (payload.tar.gz is one
+# big gzip stream, so a change near the beginning of it can make the rest
+# of it look completely different) is not worth the trouble, and gets
+# left out.
+
+import sys
+import os
+import json
+import hashlib
+import zipfile
+import subprocess
+
+# Patches that are bigger than this fraction of the full .x1p get dropped.
+MAX_DELTA_FRACTION = 0.75
+
+
+def x1p_info(path):
+    with zipfile.ZipFile(path, 'r') as zf:
+        with zf.open('info.json') as f:
+            return json.load(f)
+
+
+def md5_file(path):
+    return hashlib.md5(open(path, 'rb').read()).hexdigest()
+
+
+new_path, ota_json_path = sys.argv[1], sys.argv[2]
+new_info = x1p_info(new_path)
+new_size = os.path.getsize(new_path)
+
+with open(ota_json_path, 'r') as f:
+    ota = json.load(f)
+
+deltas = []
+for old_path in sys.argv[3:]:
+    old_info = x1p_info(old_path)
+    name = f"{old_info['cfwVersion']}-{new_info['cfwVersion']}.x1p.xdelta"
+    delta_path = os.path.join(os.path.dirname(new_path), name)
+
+    # -D, so that xdelta3 does not try to be clever about the gzip stream
+    # inside; the printer would need to recompress it bit-for-bit the same
+    # way to apply the patch.
+    subprocess.check_call(["xdelta3", "-e", "-f", "-9", "-D", "-s", old_path, new_path, delta_path])
+
+    size = os.path.getsize(delta_path)
+    print(f"{old_info['cfwVersion']} -> {new_info['cfwVersion']}: {size} bytes ({100 * size / new_size:.1f}% of {new_size})")
+    if size > new_size * MAX_DELTA_FRACTION:
+        print(f"  ... not worth it; leaving it out")
+        os.unlink(delta_path)
+        continue
+
+    deltas.append({
+        "from_version": old_info['cfwVersion'],
+        "from_md5": md5_file(old_path),
+        "url": f"https://github.com/X1Plus/X1Plus/releases/download/x1plus%2F{new_info['cfwVersion']}/{name}",
+        "md5": md5_file(delta_path),
+        "size": size,
+    })
+
+ota['ota_deltas'] = deltas
+json.dump(ota, open(ota_json_path, "w"), indent = 4)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+# Stand-in for the X1Plus OTA server, for exercising the OTA engine's
+# downloader on a development machine.
+#
+# It serves an ota.json that offers the given .x1p and base firmware files
+# (any files will do; nothing checks that they are real), with support for
+# conditional requests for ota.json, and for single Range requests and
+# If-Range for the files, and can misbehave in the ways that real networks
+# do:
+#
+#   --drop-every N     close the connection after every N bytes of a
+#                      response, like a Wi-Fi dropout
+#   --stall-every N    go quiet for 30 seconds (without closing anything)
+#                      after every N bytes of a response, like a server
+#                      that has wedged
+#   --rate N           send at most N bytes per second per connection
+#   --no-range         ignore Range requests, like some CDNs and proxies
+#
+# --delta OLD.x1p=PATCH offers PATCH (from scripts/mkotadelta.py) in
+# ota_deltas, as a way to get the --x1p file from OLD.x1p.
+#
+# To try it against x1plusd in emulation mode:
+#
+#   scripts/ota_stand_in_server.py --x1p some.x1p --base some.zip.sig --drop-every 3000000 &
+#   x1plus ota set-url http://127.0.0.1:8000/ota.json
+#   x1plus ota check
+#   x1plus ota download --base
+#
+# When it exits, it prints how many requests (and how many of them were
+# Range requests, or answered with a 304) it served for each file.
+
+import os
+import sys
+import json
+import time
+import asyncio
+import hashlib
+import zipfile
+import argparse
+import collections
+from email.utils import formatdate
+
+ROOTPATH = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+sys.path.insert(0, f"{ROOTPATH}/images/site-packages")
+
+from aiohttp import web
+
+SEND_CHUNK_SIZE = 65536
+
+# How long --stall-every goes quiet for; longer than any timeout the OTA
+# engine has.
+STALL_SECONDS = 30
+
+
+class ServedFile:
+    def __init__(self, path, urlname):
+        self.path = path
+        self.urlname = urlname
+        with open(path, "rb") as f:
+            self.data = f.read()
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.etag = f'"{self.md5}"'
+        self.last_modified = formatdate(os.stat(path).st_mtime, usegmt=True)
+
+
+class StandInServer:
+    def __init__(self, args):
+        self.args = args
+        self.files = {}
+        self.requests = collections.Counter()
+        self.range_requests = collections.Counter()
+        self.drops = collections.Counter()
+        self.stalls = collections.Counter()
+        self.not_modified = 0
+        self.started = time.time()
+        self.deltas = []
+
+    def add(self, path, urlname):
+        f = ServedFile(path, urlname)
+        self.files[urlname] = f
+        return f
+
+    def base_url(self):
+        return f"http://{self.args.host}:{self.args.port}"
+
+    def make_ota_json(self):
+        x1p = self.files.get(os.path.basename(self.args.x1p)) if self.args.x1p else None
+        base = self.files.get(os.path.basename(self.args.base)) if self.args.base else None
+        self.ota_json_body = json.dumps({
+            "cfwVersion": self.args.version,
+            "date": time.strftime("%Y-%m-%d", time.localtime(self.started)),
+            "buildTimestamp": self.started,
+            "notes": "Stand-in OTA server",
+            "ota_url": f"{self.base_url()}/{x1p.urlname}" if x1p else None,
+            "ota_md5": x1p.md5 if x1p else None,
+            "base_update_url": f"{self.base_url()}/{base.urlname}" if base else None,
+            "base_update_md5": base.md5 if base else None,
+            "ota_deltas": [
+                {
+                    "from_version": from_version,
+                    "from_md5": from_md5,
+                    "url": f"{self.base_url()}/{patch.urlname}",
+                    "md5": patch.md5,
+                    "size": len(patch.data),
+                }
+                for from_version, from_md5, patch in self.deltas
+            ],
+        })
+        self.ota_json_etag = f'"{hashlib.md5(self.ota_json_body.encode()).hexdigest()}"'
+        self.ota_json_last_modified = formatdate(self.started, usegmt=True)
+
+    async def ota_json(self, request):
+        self.requests["ota.json"] += 1
+        headers = {"ETag": self.ota_json_etag, "Last-Modified": self.ota_json_last_modified}
+        if request.headers.get("If-None-Match") == self.ota_json_etag or \
+           request.headers.get("If-None-Match") is None and request.headers.get("If-Modified-Since") == self.ota_json_last_modified:
+            self.not_modified += 1
+            return web.Response(status=304, headers=headers)
+        return web.Response(text=self.ota_json_body, content_type="application/json", headers=headers)
+
+    def _parse_range(self, request, f):
+        """
+        Returns the (start, end) of the range to send, end exclusive, or
+        None to send the whole file.
+        """
+
+        rng = request.headers.get("Range")
+        if rng is None or self.args.no_range:
+            return None
+        if_range = request.headers.get("If-Range")
+        if if_range is not None and if_range not in (f.etag, f.last_modified):
+            return None
+        if not rng.startswith("bytes=") or "," in rng or "-" not in rng:
+            raise web.HTTPBadRequest(text="only single byte ranges are supported")
+        first, last = rng[len("bytes="):].split("-", 1)
+        start = int(first)
+        end = min(int(last) + 1, len(f.data)) if last else len(f.data)
+        return start, end
+
+    async def serve_file(self, request):
+        f = self.files.get(request.match_info["name"])
+        if f is None:
+            raise web.HTTPNotFound()
+        self.requests[f.urlname] += 1
+
+        rng = self._parse_range(request, f)
+        headers = {"ETag": f.etag, "Last-Modified": f.last_modified, "Accept-Ranges": "bytes"}
+        if rng is None:
+            start, end = 0, len(f.data)
+            status = 200
+        else:
+            self.range_requests[f.urlname] += 1
+            start, end = rng
+            if start >= end:
+                raise web.HTTPRequestRangeNotSatisfiable(headers={"Content-Range": f"bytes */{len(f.data)}"})
+            status = 206
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(f.data)}"
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+
+        sent = 0
+        t0 = time.monotonic()
+        for ofs in range(start, end, SEND_CHUNK_SIZE):
+            chunk = f.data[ofs:min(ofs + SEND_CHUNK_SIZE, end)]
+            if self.args.drop_every and sent + len(chunk) > self.args.drop_every:
+                chunk = chunk[:self.args.drop_every - sent]
+                await response.write(chunk)
+                self.drops[f.urlname] += 1
+                request.transport.close()
+                return response
+            if self.args.stall_every and (sent + len(chunk)) // self.args.stall_every > sent // self.args.stall_every:
+                self.stalls[f.urlname] += 1
+                await asyncio.sleep(STALL_SECONDS)
+            await response.write(chunk)
+            sent += len(chunk)
+            if self.args.rate:
+                ahead = sent / self.args.rate - (time.monotonic() - t0)
+                if ahead > 0:
+                    await asyncio.sleep(ahead)
+
+        await response.write_eof()
+        return response
+
+    def report(self):
+        print(f"ota.json: {self.requests['ota.json']} requests, {self.not_modified} of them not modified", file=sys.stderr)
+        for name in self.files:
+            print(f"{name}: {self.requests[name]} requests, {self.range_requests[name]} of them ranged, {self.drops[name]} dropped, {self.stalls[name]} stalled", file=sys.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stand-in X1Plus OTA server for testing the downloader")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--x1p", help="file to offer as the X1Plus update")
+    parser.add_argument("--base", help="file to offer as the base firmware")
+    parser.add_argument("--delta", action="append", default=[], metavar="OLD.x1p=PATCH", help="offer PATCH as an xdelta3 patch from OLD.x1p to the --x1p file")
+    parser.add_argument("--version", default="99.99", help="cfwVersion to put in ota.json")
+    parser.add_argument("--drop-every", type=int, default=0, metavar="N", help="drop the connection after every N bytes of a response")
+    parser.add_argument("--stall-every", type=int, default=0, metavar="N", help="stop sending for a while after every N bytes of a response")
+    parser.add_argument("--rate", type=int, default=0, metavar="N", help="limit each connection to N bytes per second")
+    parser.add_argument("--no-range", action="store_true", help="ignore Range requests")
+    args = parser.parse_args()
+
+    server = StandInServer(args)
+    for path in [args.x1p, args.base]:
+        if path:
+            server.add(path, os.path.basename(path))
+    for delta in args.delta:
+        old_x1p, _, patch = delta.partition("=")
+        with zipfile.ZipFile(old_x1p, "r") as zf, zf.open("info.json") as f:
+            from_version = json.load(f)["cfwVersion"]
+        with open(old_x1p, "rb") as f:
+            from_md5 = hashlib.md5(f.read()).hexdigest()
+        server.deltas.append((from_version, from_md5, server.add(patch, os.path.basename(patch))))
+    server.make_ota_json()
+
+    app = web.Application()
+    app.router.add_get("/ota.json", server.ota_json)
+    app.router.add_get("/{name}", server.serve_file)
+    try:
+        web.run_app(app, host=args.host, port=args.port, print=lambda *a: None)
+    finally:
+        server.report()
+
+
+if __name__ == "__main__":
+    main()